@@ -0,0 +1,147 @@
+"""
+Benchmark of the propagation of an annotated slice to the superregions.
+
+Compares the previous `annotate_from_slice` (a full-volume mask per label,
+built by comparing the volume with every selected superregion, and a history
+shift per label) with the current one, which applies a superregion to label
+lookup table chunk by chunk, with and without the region index of the
+superregions. The supervoxels are jittered blocks of `--supervoxel` voxels,
+about 100k of them for the default 1k cubed volume, and the slice is
+annotated with `--labels` discs.
+
+Usage:
+
+    python benchmarks/bench_annotate_from_slice.py --shape 1024 1024 1024 --supervoxel 22
+    python benchmarks/bench_annotate_from_slice.py --shape 256 256 256 --supervoxel 12
+
+The previous implementation needs several copies of the volume in memory
+(about 16 GB at 1k cubed) and compares it once per selected superregion, so
+it is skipped with `--skip-legacy`.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from scipy.ndimage import binary_erosion
+
+from survos2.api.annotate import _MaskCopy, _MaskPrev, _MaskSize, annotate_from_slice, get_order
+from survos2.improc.utils import optimal_chunksize
+from survos2.model.dataset import Dataset
+from survos2.model.region_index import build_region_index, load_region_index
+
+
+def legacy_annotate_from_slice(dataset, region, source_slice, slice_num, viewer_order=(0, 1, 2)):
+    """The previous implementation, returning the annotated volume."""
+    reg = region[:]
+    ds = dataset[:]
+
+    viewer_order_str = "".join(map(str, viewer_order))
+    if viewer_order_str != "012" and len(viewer_order_str) == 3:
+        ds_t = np.transpose(ds, viewer_order)
+        reg_t = np.transpose(reg, viewer_order)
+    else:
+        ds_t = ds
+        reg_t = reg
+
+    for label_idx in np.unique(source_slice):
+        mask = np.zeros_like(reg_t).astype(np.uint32)
+        slice_mask = (source_slice == label_idx) * 1
+        slice_mask = binary_erosion(slice_mask, iterations=2)
+        masked_regions = slice_mask * reg[slice_num]
+        for r_idx in map(int, np.unique(masked_regions)):
+            mask += reg_t == r_idx
+        mask = mask > 0
+        ds_t = (ds_t & _MaskCopy) | (ds_t << _MaskSize)
+        ds_t[mask] = (ds_t[mask] & _MaskPrev) | int(label_idx)
+
+    if viewer_order_str != "012" and len(viewer_order_str) == 3:
+        return np.transpose(ds_t, get_order(viewer_order))
+    return ds_t
+
+
+def make_supervoxels(shape, size, seed=0):
+    """Labels (from 1) of blocks of `size` voxels whose boundaries are jittered along every axis."""
+    rng = np.random.default_rng(seed)
+    nblocks = [-(-s // size) for s in shape]
+    labels = np.empty(shape, np.uint32)
+    for z in range(shape[0]):
+        coords = np.indices(shape[1:])
+        jitter = rng.integers(-size // 4, size // 4 + 1, size=2)
+        y = np.clip((coords[0] + jitter[0]) // size, 0, nblocks[1] - 1)
+        x = np.clip((coords[1] + jitter[1]) // size, 0, nblocks[2] - 1)
+        labels[z] = 1 + (min(z // size, nblocks[0] - 1) * nblocks[1] + y) * nblocks[2] + x
+    return labels
+
+
+def make_slice(shape, nlabels, seed=0):
+    """Slice annotated with `nlabels` discs over a background of label 0."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.indices(shape)
+    source = np.zeros(shape, np.uint32)
+    for label in range(1, nlabels + 1):
+        cy, cx = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        radius = rng.integers(min(shape) // 16, min(shape) // 6)
+        source[(yy - cy) ** 2 + (xx - cx) ** 2 < radius**2] = label
+    return source
+
+
+def timeit(func):
+    t0 = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shape", type=int, nargs=3, default=[1024, 1024, 1024])
+    parser.add_argument("--supervoxel", type=int, default=22, help="side of the supervoxels")
+    parser.add_argument("--labels", type=int, default=4)
+    parser.add_argument("--chunk-size", type=float, default=32, help="chunk size in MB")
+    parser.add_argument("--skip-legacy", action="store_true")
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    shape = tuple(args.shape)
+    chunks = optimal_chunksize(shape, args.chunk_size)
+    slice_num = shape[0] // 2
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        supervoxels = make_supervoxels(shape, args.supervoxel)
+        nsv = int(supervoxels.max())
+        region = Dataset.create(os.path.join(workdir, "regions"), data=supervoxels, chunks=chunks)
+        del supervoxels
+        source = make_slice(shape[1:], args.labels)
+        print("volume {}, chunks {}, {} supervoxels".format("x".join(map(str, shape)), chunks, nsv))
+
+        results = dict()
+        levels = dict()
+        for name in ("legacy", "lookup", "lookup+index"):
+            if name == "legacy" and args.skip_legacy:
+                continue
+            level = Dataset.create(os.path.join(workdir, name), shape=shape, dtype="uint32", chunks=chunks)
+            level.set_attr("modified", [0] * level.total_chunks)
+            if name == "legacy":
+                _, t = timeit(lambda: level.load(legacy_annotate_from_slice(level, region, source, slice_num)))
+            else:
+                if name == "lookup+index":
+                    _, t_index = timeit(lambda: build_region_index(region._path))
+                    assert load_region_index(region) is not None
+                    print("{:<20} {:>10.2f} s".format("region index", t_index))
+                _, t = timeit(lambda: annotate_from_slice(level, region, source, slice_num))
+            results[name] = t
+            levels[name] = level
+            print("{:<20} {:>10.2f} s".format(name, t))
+
+        reference = levels["lookup"][:] & _MaskCopy
+        for name, level in levels.items():
+            assert np.array_equal(level[:] & _MaskCopy, reference), "{} differs".format(name)
+        print("{} voxels annotated, results agree".format(int(np.count_nonzero(reference))))
+        if "legacy" in results:
+            for name in ("lookup", "lookup+index"):
+                print("{:<20} {:>9.1f}x".format("speedup " + name, results["legacy"] / results[name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmark of chunk compression codecs for SuRVoS Datasets.
+
+For every workspace group (features, annotations, superregions, pipelines)
+a representative volume is written with each codec, and the disk footprint,
+write time and full-volume / single-slice read throughput are reported.
+Blosc codecs are skipped if `hdf5plugin` is not installed.
+
+Usage:
+
+    python benchmarks/bench_compression.py --shape 128 256 256 --chunk-size 32
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from survos2.model.dataset import Dataset, DatasetException
+
+CODECS = [
+    ("none", False),
+    ("lzf", False),
+    ("lzf", True),
+    ("gzip:1", True),
+    ("gzip:4", True),
+    ("blosc:lz4", True),
+    ("blosc:zstd", True),
+]
+
+
+def make_volumes(shape, seed=0):
+    """Synthetic volumes with the statistics of each workspace group."""
+    rng = np.random.RandomState(seed)
+    raw = ndi.gaussian_filter(rng.rand(*shape).astype(np.float32), 2)
+    feature = ndi.gaussian_filter(raw, 1) + 0.01 * rng.rand(*shape).astype(np.float32)
+
+    # sparse scribbles, with the history nibble of annotations levels
+    annotation = np.zeros(shape, np.uint16)
+    for _ in range(20):
+        z, y, x = [rng.randint(s) for s in shape]
+        annotation[max(z - 2, 0) : z + 2, max(y - 8, 0) : y + 8, max(x - 8, 0) : x + 8] = rng.randint(1, 8)
+    annotation |= annotation << 4
+
+    # supervoxel-like label field
+    seeds = np.zeros(shape, np.uint32)
+    npoints = int(np.prod(shape) / 10 ** 3)
+    seeds[tuple(rng.randint(0, s, npoints) for s in shape)] = np.arange(1, npoints + 1)
+    _, indices = ndi.distance_transform_edt(seeds == 0, return_indices=True)
+    superregion = seeds[tuple(indices)]
+
+    # dense segmentation with a handful of classes
+    pipeline = (raw > np.percentile(raw, 30)).astype(np.uint16) + (raw > np.percentile(raw, 80))
+
+    return dict(features=feature, annotations=annotation, superregions=superregion, pipelines=pipeline)
+
+
+def disk_usage(path):
+    return sum(e.stat().st_size for e in os.scandir(path) if e.name.endswith(".h5"))
+
+
+def bench(path, data, codec, shuffle, chunks, repeat):
+    t0 = time.perf_counter()
+    Dataset.create(path, data=data, chunks=chunks, compression=codec, shuffle=shuffle, sparse=False)
+    t_write = time.perf_counter() - t0
+    ds = Dataset(path, readonly=True)
+
+    t_read = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = ds[:]
+        t_read.append(time.perf_counter() - t0)
+    assert np.array_equal(result, data)
+
+    t_slice = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        ds.get_slice(ds.shape[0] // 2)
+        t_slice.append(time.perf_counter() - t0)
+
+    size = disk_usage(path)
+    ds.close()
+    shutil.rmtree(path)
+    return size, t_write, min(t_read), min(t_slice)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shape", type=int, nargs=3, default=[128, 256, 256])
+    parser.add_argument("--chunk-size", type=float, default=32, help="chunk size in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="survos_bench_")
+    volumes = make_volumes(args.shape)
+
+    header = "{:<13} {:<11} {:>7} | {:>10} {:>7} | {:>10} {:>11} {:>10}"
+    print(header.format("group", "codec", "shuffle", "disk (MB)", "ratio", "write (s)", "read (MB/s)", "slice (ms)"))
+    for group, data in volumes.items():
+        for codec, shuffle in CODECS:
+            path = os.path.join(workdir, "{}_{}".format(group, codec.replace(":", "_")))
+            try:
+                size, t_write, t_read, t_slice = bench(path, data, codec, shuffle, args.chunk_size, args.repeat)
+            except DatasetException as e:
+                print("{:<13} {:<11} skipped: {}".format(group, codec, e))
+                continue
+            print(
+                "{:<13} {:<11} {:>7} | {:>10.2f} {:>6.1f}x | {:>10.2f} {:>11.1f} {:>10.2f}".format(
+                    group,
+                    codec,
+                    "yes" if shuffle else "no",
+                    size / 2**20,
+                    data.nbytes / size,
+                    t_write,
+                    data.nbytes / 2**20 / t_read,
+                    t_slice * 1e3,
+                )
+            )
+        print()
+
+    if args.workdir is None:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark of the chunk layout planner `optimal_chunksize`.
+
+Plans the chunks of 1k to 8k cubed volumes (and a few anisotropic ones) for
+every access pattern and compares the planner with the previous exhaustive
+search over every combination of chunk counts per axis, which is only run
+when the number of candidates it would evaluate is below `--max-candidates`.
+
+Usage:
+
+    python benchmarks/bench_optimal_chunksize.py --chunk-size 32 --repeat 5
+"""
+
+import argparse
+import time
+from itertools import product
+from math import ceil
+
+import numpy as np
+
+from survos2.improc.utils import optimal_chunksize
+
+SHAPES = [
+    (1024, 1024, 1024),
+    (2048, 2048, 2048),
+    (4096, 4096, 4096),
+    (8192, 8192, 8192),
+    (256, 2048, 2048),
+    (40000, 2048, 2048),
+]
+
+
+def legacy_candidates(shape, max_size, item_size=4):
+    shape = np.asarray(shape, np.float64)
+    weight = shape / shape.min()
+    axis_weight = 1 + weight / weight.max()
+    total_chunks = int(ceil(np.prod(shape) * item_size / (max_size * 2**20)))
+    return [int(ceil(total_chunks / p)) for p in axis_weight]
+
+
+def legacy_optimal_chunksize(shape, max_size, item_size=4):
+    """The previous implementation: an exhaustive search of chunk counts."""
+    shape = np.asarray(shape, np.int64)
+    sizeMB = max_size * (2**20)
+    weight = shape / float(np.min(shape))
+    axis_weight = 1 + weight / np.max(weight)
+    max_chunk_iter = [range(1, total + 1) for total in legacy_candidates(shape, max_size, item_size)]
+    best_chunk = shape
+    best_chunk_err = np.inf
+
+    for nchunks in product(*max_chunk_iter):
+        chunks = np.ceil(shape / nchunks).astype(int)
+        chunk_size = np.prod(chunks) * item_size
+        chunk_size_err = (sizeMB - chunk_size) / (2**20)
+        chunk_axis_err = np.abs(chunks / float(chunks.min()) - axis_weight).sum()
+        chunk_err = chunk_size_err + chunk_axis_err
+        if chunk_size < sizeMB and chunk_err < best_chunk_err:
+            best_chunk = chunks
+            best_chunk_err = chunk_err
+
+    return tuple(map(int, best_chunk))
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - t0)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunk-size", type=float, default=32, help="chunk size in MB")
+    parser.add_argument("--pad", type=int, default=8, help="padding of the cubic pattern")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-candidates", type=float, default=2e6)
+    args = parser.parse_args()
+
+    header = "{:<18} {:<8} | {:<18} {:>9} {:>10} | {:<18} {:>9} {:>10}"
+    print(header.format("shape", "pattern", "chunks", "size (MB)", "time (ms)", "legacy", "size (MB)", "time (ms)"))
+    for shape in SHAPES:
+        candidates = int(np.prod(legacy_candidates(shape, args.chunk_size), dtype=np.float64))
+        if candidates <= args.max_candidates:
+            legacy, t_legacy = timeit(lambda: legacy_optimal_chunksize(shape, args.chunk_size), 1)
+            legacy_cols = (str(legacy), "{:.1f}".format(np.prod(legacy) * 4 / 2**20), "{:.1f}".format(t_legacy * 1e3))
+        else:
+            legacy_cols = ("skipped", "", "{:.1e} cand.".format(candidates))
+
+        for pattern in (None, "cubic", "slice"):
+            pad = args.pad if pattern == "cubic" else 0
+            chunks, t_plan = timeit(
+                lambda: optimal_chunksize(shape, args.chunk_size, pattern=pattern, pad=pad), args.repeat
+            )
+            print(
+                "{:<18} {:<8} | {:<18} {:>9.1f} {:>10.3f} | {:<18} {:>9} {:>10}".format(
+                    "x".join(map(str, shape)),
+                    pattern or "default",
+                    str(chunks),
+                    np.prod(chunks) * 4 / 2**20,
+                    t_plan * 1e3,
+                    *(legacy_cols if pattern is None else ("", "", ""))
+                )
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark of viewer slice retrieval from a chunked SuRVoS Dataset.
+
+Compares the previous `get_slice` path (read the whole volume, transpose
+and index) against `Dataset.get_slice`, which only touches the chunks
+intersecting the requested plane. Reports latency, bytes read from the
+chunk files and number of chunk files touched for every axes order.
+
+Usage:
+
+    python benchmarks/bench_slice.py --shape 256 256 256 --chunk-size 32
+"""
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from survos2.model.dataset import Dataset
+
+
+class CountingDataset(Dataset):
+    """Dataset that keeps track of the chunk reads it performs."""
+
+    def reset_counters(self):
+        self.bytes_read = 0
+        self.chunks_read = set()
+
+    def get_chunk_data(self, idx, slices=None):
+        data = super().get_chunk_data(idx, slices=slices)
+        if self.has_chunk(idx):
+            self.bytes_read += np.asarray(data).nbytes
+            self.chunks_read.add(tuple(idx))
+        return data
+
+
+def full_volume_slice(ds, slice_idx, order):
+    data = np.transpose(ds[:], order)
+    return data[slice_idx]
+
+
+def run(ds, func, slice_idx, order, repeat):
+    timings = []
+    for _ in range(repeat):
+        ds.reset_counters()
+        t0 = time.perf_counter()
+        result = func(ds, slice_idx, order)
+        timings.append(time.perf_counter() - t0)
+    return result, min(timings), ds.bytes_read, len(ds.chunks_read)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 256])
+    parser.add_argument("--chunk-size", type=float, default=32, help="chunk size in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="survos_bench_")
+    path = os.path.join(workdir, "bench_slice")
+    data = np.random.rand(*args.shape).astype(np.float32)
+    Dataset.create(path, data=data, chunks=args.chunk_size)
+    ds = CountingDataset(path, readonly=True)
+    print(f"Dataset {tuple(ds.shape)} float32, chunk size {ds.chunk_size}, grid {ds.chunk_grid}")
+
+    header = "{:>9} | {:>14} {:>12} {:>7} | {:>14} {:>12} {:>7} | {:>8}"
+    print(header.format("order", "full (ms)", "MB read", "chunks", "sliced (ms)", "MB read", "chunks", "speedup"))
+    for order in itertools.permutations(range(3)):
+        slice_idx = ds.shape[order[0]] // 2
+        expected, t_full, b_full, c_full = run(ds, full_volume_slice, slice_idx, order, args.repeat)
+        result, t_slice, b_slice, c_slice = run(
+            ds, lambda d, i, o: d.get_slice(i, o), slice_idx, order, args.repeat
+        )
+        assert np.array_equal(expected, result)
+        print(
+            "{:>9} | {:>14.2f} {:>12.2f} {:>7d} | {:>14.2f} {:>12.2f} {:>7d} | {:>7.1f}x".format(
+                "".join(map(str, order)),
+                t_full * 1e3,
+                b_full / 2**20,
+                c_full,
+                t_slice * 1e3,
+                b_slice / 2**20,
+                c_slice,
+                t_full / t_slice,
+            )
+        )
+
+    if args.workdir is None:
+        ds.delete()
+
+
+if __name__ == "__main__":
+    main()
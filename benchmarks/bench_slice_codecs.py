@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the slice codecs of `encode_numpy_slice`.
+
+Encodes and decodes 2048x2048 slices with the statistics of features
+(float32), annotations (uint16) and superregions (uint32) with every codec,
+and reports the encoded size, the encode and decode times and the maximum
+reconstruction error. Codecs that are not available (e.g. `lz4` without
+the `lz4` package) or not applicable fall back to `raw`.
+
+Usage:
+
+    python benchmarks/bench_slice_codecs.py --size 2048 --repeat 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from survos2.utils import SLICE_CODECS, decode_numpy_slice, encode_numpy_slice
+
+
+def make_slices(size, seed=0):
+    rng = np.random.RandomState(seed)
+    feature = ndi.gaussian_filter(rng.rand(size, size).astype(np.float32), 2)
+
+    annotation = np.zeros((size, size), np.uint16)
+    for _ in range(30):
+        y, x = rng.randint(size, size=2)
+        annotation[max(y - 40, 0) : y + 40, max(x - 40, 0) : x + 40] = rng.randint(1, 8)
+    annotation |= annotation << 4
+
+    seeds = np.zeros((size, size), np.uint32)
+    npoints = size * size // 400
+    seeds[rng.randint(0, size, npoints), rng.randint(0, size, npoints)] = np.arange(1, npoints + 1)
+    _, indices = ndi.distance_transform_edt(seeds == 0, return_indices=True)
+    superregion = seeds[tuple(indices)]
+
+    return dict(features=feature, annotations=annotation, superregions=superregion)
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - t0)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    header = "{:<13} {:<6} {:<6} | {:>10} {:>7} | {:>11} {:>11} | {:>10}"
+    print(header.format("slice", "codec", "used", "size (KB)", "ratio", "encode (ms)", "decode (ms)", "max error"))
+    for name, data in make_slices(args.size).items():
+        for codec in SLICE_CODECS:
+            encoded, t_encode = timeit(lambda: encode_numpy_slice(data, codec=codec), args.repeat)
+            decoded, t_decode = timeit(lambda: decode_numpy_slice(dict(encoded)), args.repeat)
+            if encoded["codec"] == "jpeg":  # rescaled to [0, 1] floats
+                error = "lossy"
+            else:
+                error = "{:.2e}".format(np.abs(decoded.astype(np.float64) - data).max())
+            print(
+                "{:<13} {:<6} {:<6} | {:>10.1f} {:>6.1f}x | {:>11.2f} {:>11.2f} | {:>10}".format(
+                    name,
+                    codec,
+                    encoded["codec"],
+                    len(encoded["data"]) / 2**10,
+                    data.nbytes / len(encoded["data"]),
+                    t_encode * 1e3,
+                    t_decode * 1e3,
+                    error,
+                )
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
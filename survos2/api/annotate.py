@@ -1,12 +1,23 @@
+import os
+import threading
+from collections import OrderedDict
+
 from matplotlib.pyplot import box
 import numpy as np
 from loguru import logger
 from scipy.ndimage import binary_erosion
 
+from survos2.config import Config
+from survos2.model.dataset import Dataset, read_array
+from survos2.model.journal import JOURNAL_DEPTH, JournalEntry, UndoJournal
+from survos2.model.region_index import load_region_index
+
 _MaskSize = 4  # 4 bits per history label
 _MaskCopy = 15  # 0000 1111
 _MaskPrev = 240  # 1111 0000
 
+PARENT_MASK_CACHE_SIZE = Config["api.parent_mask_cache"]
+
 
 def get_order(viewer_order):
     """Calculate the new order of the axes. Follows napari viewer order.
@@ -33,6 +44,121 @@ def get_order(viewer_order):
     return new_order
 
 
+class ParentMaskCache(object):
+    """
+    LRU cache of the bit-packed label masks of the chunks of parent levels,
+    bounded by their total size (in MB). Every entry keeps the stamp of the
+    chunk it was computed from and is recomputed once the chunk is modified.
+    """
+
+    def __init__(self, max_size=PARENT_MASK_CACHE_SIZE):
+        self._max_bytes = max_size * 2**20
+        self._nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != version:
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, version, bits):
+        if bits.nbytes > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= self._items.pop(key)[1].nbytes
+            self._items[key] = (version, bits)
+            self._nbytes += bits.nbytes
+            while self._nbytes > self._max_bytes:
+                _, (_, old) = self._items.popitem(last=False)
+                self._nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+
+__parent_masks__ = ParentMaskCache()
+
+
+class ParentMask(object):
+    """
+    Mask of the voxels of the parent level `dataset` annotated with `label`,
+    computed chunk by chunk on demand: constraining a stroke only reads the
+    parent chunks its voxels fall in, and the masks of those chunks are
+    cached (see `ParentMaskCache`) until the parent level is modified.
+    """
+
+    def __init__(self, dataset, label, cache=__parent_masks__):
+        self.dataset = dataset
+        self.label = int(label)
+        self._cache = cache
+        self._key = (os.path.realpath(dataset._path), self.label)
+
+    @property
+    def shape(self):
+        return tuple(self.dataset.shape)
+
+    def chunk_mask(self, flat_idx):
+        """Mask of the chunk `flat_idx` of the parent level, of the shape of its bounds."""
+        idx = self.dataset.unravel_chunk_index(int(flat_idx))
+        chunk_slices = self.dataset.global_chunk_bounds(idx)
+        shape = tuple(s.stop - s.start for s in chunk_slices)
+        key = self._key + (int(flat_idx),)
+        version = self.dataset.chunk_version(idx)
+        bits = self._cache.get(key, version)
+        if bits is None:
+            mask = (self.dataset[chunk_slices] & _MaskCopy) == self.label
+            bits = np.packbits(mask, axis=None)
+            self._cache.put(key, version, bits)
+            return mask
+        return np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape).astype(bool)
+
+    def contains(self, coords):
+        """Whether each of the voxels at `coords` (`(voxels, 3)`, storage order) is in the mask."""
+        result = np.zeros(len(coords), bool)
+        if len(coords) == 0:
+            return result
+        flat_idxs, order, splits = _chunk_groups(self.dataset, coords)
+        chunk_size = np.asarray(self.dataset.chunk_size)
+        for flat_idx, points in zip(flat_idxs, np.split(order, splits)):
+            local = coords[points] - chunk_size * self.dataset.unravel_chunk_index(int(flat_idx))
+            result[points] = self.chunk_mask(flat_idx)[tuple(local.T)]
+        return result
+
+    def crop(self, slices=Ellipsis):
+        """Mask of the region `slices` (the whole volume by default), from the chunks it covers."""
+        slices = self.dataset._process_slices(slices)
+        out = np.zeros([s.stop - s.start for s in slices], bool)
+        ranges = [
+            range(s.start // c, max(s.start, s.stop - 1) // c + 1) for s, c in zip(slices, self.dataset.chunk_size)
+        ]
+        for idx in np.ndindex(*[len(r) for r in ranges]):
+            idx = tuple(r[i] for r, i in zip(ranges, idx))
+            bounds = self.dataset.global_chunk_bounds(idx)
+            inter = [slice(max(b.start, s.start), min(b.stop, s.stop)) for b, s in zip(bounds, slices)]
+            mask = self.chunk_mask(self.dataset.ravel_chunk_index(idx))
+            out[tuple(slice(i.start - s.start, i.stop - s.start) for i, s in zip(inter, slices))] = mask[
+                tuple(slice(i.start - b.start, i.stop - b.start) for i, b in zip(inter, bounds))
+            ]
+        return out
+
+
+def _in_parent(coords, parent_mask):
+    """Whether the voxels at `coords` (storage order) are in `parent_mask`, an array or a `ParentMask`."""
+    if isinstance(parent_mask, ParentMask):
+        return parent_mask.contains(coords)
+    return parent_mask[tuple(coords.T)] > 0
+
+
 def annotate_voxels(
     dataset,
     slice_idx=0,
@@ -50,91 +176,351 @@ def annotate_voxels(
         yy (list, optional): List of y-coordinates to annotate. Defaults to None.
         xx (list, optional): List of x-coordinates to annotate. Defaults to None.
         label (int, optional): Label value to set. Defaults to 0.
-        parent_mask (np.ndarray, optional): Mask image. Defaults to None.
+        parent_mask (np.ndarray or ParentMask, optional): Mask image. Defaults to None.
         viewer_order (tuple, optional): Axes order. Defaults to (0, 1, 2).
     Raises:
         ValueError: Label index must be less than 16 and greater than 0.
-    """
-    mbit = 2 ** (np.dtype(dataset.dtype).itemsize * 8 // _MaskSize) - 1
-    modified = dataset.get_attr("modified")
-    modified = [0]
 
+    Only the chunks containing voxels of the stroke are read, have their
+    history shifted and are written back. They are recorded in the
+    `modified` chunk bitmap of the dataset, used by `undo_annotation`.
+    """
     if label >= 16 or label < 0 or type(label) != int:
         raise ValueError("Label has to be in bounds [0, 15]")
 
-    ds = dataset[:]
-    # original_shape = ds.shape
-    if len(viewer_order) == 3:
-        ds_t = np.transpose(ds, viewer_order)
-    else:
-        ds_t = ds
+    coords = _storage_coords(slice_idx, yy, xx, viewer_order)
+    if parent_mask is not None:
+        coords = coords[_in_parent(coords, parent_mask)]
+
+    _write_labels(dataset, coords, label)
 
-    ds_t = (ds_t & _MaskCopy) | (ds_t << _MaskSize)
-    #    box_half_dim = int(brush_size // 2)
 
-    data_slice = ds_t[slice_idx, :]
-    data_slice[yy, xx] = (data_slice[yy, xx] & _MaskPrev) | label
+def annotate_strokes(dataset, strokes, parent_mask=None, viewer_order=(0, 1, 2)):
+    """Annotate a batch of strokes in a dataset, as a single edit.
 
+    Args:
+        dataset (Dataset): Dataset object.
+        strokes (list): `Stroke`s painted in the viewer, in painting order.
+        parent_mask (np.ndarray or ParentMask, optional): Mask image. Defaults to None.
+        viewer_order (tuple, optional): Axes order. Defaults to (0, 1, 2).
+    Raises:
+        ValueError: Label index must be less than 16 and greater than 0.
+
+    Voxels painted by several strokes get the label of the last one. Every
+    chunk covered by the batch is read and written once, and the batch is
+    undone at once, as a single stroke of `annotate_voxels`.
+    """
+    if len(strokes) == 0:
+        return
+    coords, labels = [], []
+    for stroke in strokes:
+        if stroke.label >= 16 or stroke.label < 0:
+            raise ValueError("Label has to be in bounds [0, 15]")
+        yy, xx = stroke.points()
+        coords.append(_storage_coords(stroke.slice_idx, yy, xx, viewer_order))
+        labels.append(np.full(len(yy), stroke.label, dtype=dataset.dtype))
+    coords, labels = np.concatenate(coords), np.concatenate(labels)
+
+    # last stroke painting each voxel
+    flat = np.ravel_multi_index(tuple(coords.T), dataset.shape)
+    _, last = np.unique(flat[::-1], return_index=True)
+    keep = np.sort(len(flat) - 1 - last)
+    coords, labels = coords[keep], labels[keep]
     if parent_mask is not None:
-        parent_mask_t = np.transpose(parent_mask, viewer_order)
-        mask = parent_mask_t
-        mask = mask > 0
-        mask = mask[slice_idx, :]
-        data_slice = data_slice * mask
+        inside = _in_parent(coords, parent_mask)
+        coords, labels = coords[inside], labels[inside]
 
-    ds_t[slice_idx, :] = data_slice
+    _write_labels(dataset, coords, labels)
 
-    if len(viewer_order) == 3:
-        new_order = get_order(viewer_order)
-        ds_o = np.transpose(ds_t, new_order)
-    else:
-        ds_o = ds_t
-    dataset[:] = ds_o
 
-def annotate_from_slice(dataset, region, source_slice, slice_num, viewer_order=(0, 1, 2)):
+def _storage_coords(slice_idx, yy, xx, viewer_order=(0, 1, 2)):
+    """Coordinates (`(voxels, 3)`, storage order) of the voxels `(yy, xx)` of a slice in viewer order."""
+    yy = np.asarray(yy, dtype=int).ravel()
+    xx = np.asarray(xx, dtype=int).ravel()
+    if len(viewer_order) != 3:
+        viewer_order = (0, 1, 2)
 
-    reg = region[:]
-    ds = dataset[:]
+    coords = [None] * 3
+    for axis, c in zip(viewer_order, (np.full(len(yy), slice_idx), yy, xx)):
+        coords[axis] = c
+    return np.stack(coords, axis=1)
 
-    viewer_order_str = "".join(map(str, viewer_order))
-    if viewer_order_str != "012" and len(viewer_order_str) == 3:
-        ds_t = np.transpose(ds, viewer_order)
-        reg_t = np.transpose(reg, viewer_order)
+
+def annotate_indexed_regions(
+    dataset, index, r=None, label=0, parent_mask=None, bb=None, viewer_order=(0, 1, 2)
+):
+    """Annotate superregions in a dataset using their `RegionIndex`.
+
+    Args:
+        dataset (Dataset): Dataset object
+        index (RegionIndex): Index of the voxels of every superregion
+        r (list, optional): Region indexes. Defaults to None.
+        label (int, optional): Label value. Defaults to 0.
+        parent_mask (np.ndarray or ParentMask, optional): Mask image. Defaults to None.
+        bb (list, optional): Bounding box coordinates. Defaults to None.
+        viewer_order (tuple, optional): Viewer axes order. Defaults to (0, 1, 2).
+
+    Raises:
+        ValueError: If the labels are greater than 15 or less than 0.
+
+    Same as `annotate_regions`, but only the voxels of the regions are
+    visited and only the chunks they cover are read and written, which are
+    recorded in the `modified` chunk bitmap as in `annotate_voxels`.
+    """
+    if label >= 16 or label < 0 or type(label) != int:
+        raise ValueError("Label has to be in bounds [0, 15]")
+    if r is None or len(r) == 0:
+        return
+    if len(viewer_order) != 3:
+        viewer_order = (0, 1, 2)
+
+    bounds = None
+    if bb and bb[0] != -1:
+        # bounding box in viewer order, mapped back to storage order
+        bounds = [0] * 6
+        for i, axis in enumerate(viewer_order):
+            bounds[axis], bounds[axis + 3] = int(bb[i]), int(bb[i + 3])
+    coords = index.coords(r, bounds=bounds)
+    if bounds is not None:
+        coords = coords[((coords >= bounds[:3]) & (coords < bounds[3:])).all(axis=1)]
+    if parent_mask is not None:
+        coords = coords[_in_parent(coords, parent_mask)]
+
+    _write_labels(dataset, coords, label)
+
+
+def _journal(dataset):
+    """
+    The `UndoJournal` of the dataset if its history is kept in one (the
+    `history` attribute set by `add_level`), `None` if in its history bits.
+    """
+    if not isinstance(dataset, Dataset) or dataset.get_metadata("history", "bits") != "journal":
+        return None
+    return UndoJournal(dataset._path, depth=dataset.get_metadata("history_depth", JOURNAL_DEPTH))
+
+
+def _write_labels(dataset, coords, label):
+    """
+    Sets `label` (a label or one per voxel) on the voxels at `coords`
+    (`(voxels, 3)`, storage order), recorded in the journal or in the history
+    bits of the dataset.
+    """
+    _write_chunk_labels(dataset, _chunk_points(dataset, coords, label))
+
+
+def _write_chunk_labels(dataset, groups):
+    """
+    Sets the labels of `groups` of voxels, `(flat chunk index, coordinates,
+    labels)` with one group per chunk, as a single edit recorded in the
+    journal or in the history bits of the dataset.
+    """
+    journal = _journal(dataset)
+    if journal is None:
+        _update_modified(dataset, _annotate_points(dataset, groups))
     else:
-        ds_t = ds
-        reg_t = reg
+        _set_points(dataset, groups, journal)
 
-    label_idxs = np.unique(source_slice)
-    print(f"LABEL INDEXES: {label_idxs}")
 
-    for label_idx in label_idxs:        
-        mask = np.zeros_like(reg_t).astype(np.uint32)
+def _chunk_groups(dataset, coords):
+    """Flat chunk indexes of the voxels at `coords` and the voxel order grouping them by chunk."""
+    chunk_ids = np.ravel_multi_index(tuple((coords // np.asarray(dataset.chunk_size)).T), dataset.chunk_grid)
+    order = np.argsort(chunk_ids, kind="stable")
+    flat_idxs, starts = np.unique(chunk_ids[order], return_index=True)
+    return flat_idxs, order, starts[1:]
 
-        slice_mask = ((source_slice == label_idx) * 1) 
-        slice_mask = binary_erosion(slice_mask, iterations=2)
-        masked_regions = slice_mask * reg[slice_num]
-        
-        
-        r = np.unique(masked_regions)
-        r = list(map(int, r))
-        for r_idx in r:
-            mask += reg_t == r_idx
-                
-        mask = (mask > 0) * 1
-        print(f"MASK SHAPE: {mask.shape}")
-        print(ds_t.shape)
-        
-        mask = mask > 0
 
-        ds_t = (ds_t & _MaskCopy) | (ds_t << _MaskSize)
-        ds_t[mask] = (ds_t[mask] & _MaskPrev) | int(label_idx)
+def _chunk_points(dataset, coords, label):
+    """
+    Groups the voxels at `coords` (`(voxels, 3)`, storage order) and their
+    label (a label or one per voxel) by chunk, see `_write_chunk_labels`.
+    """
+    flat_idxs, order, splits = _chunk_groups(dataset, coords)
+    labels = np.broadcast_to(np.asarray(label, dtype=dataset.dtype), len(coords))
+    return zip(flat_idxs, np.split(coords[order], splits), np.split(labels[order], splits))
 
-    if viewer_order_str != "012" and len(viewer_order_str) == 3:
-        new_order = get_order(viewer_order)
-        ds_o = np.transpose(ds_t, new_order) 
+
+def _set_points(dataset, groups, journal):
+    """
+    Sets the labels of `groups` of voxels (see `_write_chunk_labels`) without
+    history and records the voxels that changed as an edit of the `journal`.
+    """
+    offsets, old, new, chunk_ids = [], [], [], []
+    for flat_idx, points, pvalues in groups:
+        chunk_slices = dataset.global_chunk_bounds(dataset.unravel_chunk_index(int(flat_idx)))
+        data = dataset[chunk_slices]
+        local = tuple((points - [s.start for s in chunk_slices]).T)
+        previous = data[local]
+        changed = previous != pvalues
+        if not changed.any():
+            continue
+        data[local] = pvalues
+        dataset[chunk_slices] = data
+
+        offsets.append(np.ravel_multi_index(tuple(points[changed].T), dataset.shape))
+        old.append(previous[changed])
+        new.append(pvalues[changed])
+        chunk_ids.append(np.full(changed.sum(), flat_idx))
+    if len(offsets) > 0:
+        entry = JournalEntry.create(*map(np.concatenate, (offsets, old, new, chunk_ids)), dataset.chunk_size)
+        journal.record(entry)
+
+
+def _apply_entry(dataset, entry, values):
+    """
+    Writes `values` (`entry.old` or `entry.new`) on the voxels of a journal
+    entry, grouped again by chunk if it was recorded with another layout.
+    """
+    coords = np.stack(np.unravel_index(entry.offsets, dataset.shape), axis=1)
+    if entry.chunk_size == tuple(dataset.chunk_size):
+        flat_idxs, order, splits = entry.chunks, slice(None), entry.indptr[1:-1]
     else:
-        ds_o = ds_t
-    return ds_o
+        flat_idxs, order, splits = _chunk_groups(dataset, coords)
+    for flat_idx, points, pvalues in zip(flat_idxs, np.split(coords[order], splits), np.split(values[order], splits)):
+        chunk_slices = dataset.global_chunk_bounds(dataset.unravel_chunk_index(int(flat_idx)))
+        data = dataset[chunk_slices]
+        data[tuple((points - [s.start for s in chunk_slices]).T)] = pvalues
+        dataset[chunk_slices] = data
+
+
+def _annotate_points(dataset, groups):
+    """
+    Sets the labels of `groups` of voxels (see `_write_chunk_labels`),
+    shifting the history of the chunks that contain them only. Returns the
+    flat indexes of those chunks.
+    """
+    touched = set()
+    for flat_idx, points, plabels in groups:
+        idx = dataset.unravel_chunk_index(int(flat_idx))
+        chunk_slices = dataset.global_chunk_bounds(idx)
+        data = dataset[chunk_slices]
+        data = (data & _MaskCopy) | (data << _MaskSize)
+
+        points = tuple((points - [s.start for s in chunk_slices]).T)
+        data[points] = (data[points] & _MaskPrev) | plabels
+        dataset[chunk_slices] = data
+        touched.add(dataset.ravel_chunk_index(idx))
+    return touched
+
+
+def _update_modified(dataset, touched):
+    """
+    Pushes a new entry to the per-chunk history bitmap `modified` of the
+    dataset, with the bit set for the chunks (flat indexes) in `touched`.
+    A single `[1]` entry (whole volume modified) is expanded to every chunk.
+    """
+    mbit = 2 ** (np.dtype(dataset.dtype).itemsize * 8 // _MaskSize) - 1
+    modified = dataset.get_attr("modified", [0])
+    if len(modified) != dataset.total_chunks:
+        modified = [modified[0] if len(modified) > 0 else 0] * dataset.total_chunks
+    modified = [
+        ((int(m) << 1) & mbit) | int(i in touched) for i, m in enumerate(modified)
+    ]
+    dataset.set_attr("modified", modified)
+
+
+def store_annotation(dataset, anno):
+    """Stores the annotated volume `anno` of `annotate_regions` in the
+    dataset, as a whole-volume edit.
+
+    Args:
+        dataset (Dataset): Dataset object
+        anno (np.ndarray): Annotated volume, with the shifted history bits.
+
+    In journal mode only the current labels of `anno` are kept and only the
+    voxels they change are written and recorded in the journal.
+    """
+    journal = _journal(dataset)
+    if journal is None:
+        dataset[:] = anno
+        dataset.set_attr("modified", [1])
+        return
+    anno = anno & _MaskCopy
+    coords = np.argwhere(dataset[:] != anno)
+    _set_points(dataset, _chunk_points(dataset, coords, anno[tuple(coords.T)]), journal)
+
+
+def slice_region_labels(source_slice, region_slice, erosion=2):
+    """Superregion to label lookup table of an annotated slice.
+
+    Args:
+        source_slice (np.ndarray): Labels of the slice.
+        region_slice (np.ndarray): Superregions of the same slice.
+        erosion (int, optional): Erosion iterations of the mask of every label. Defaults to 2.
+
+    Returns:
+        np.ndarray: Label of every superregion up to the largest selected one, -1 if not selected.
+
+    A superregion is selected by a label if it intersects the eroded mask of
+    the label in the slice. Superregions selected by several labels get the
+    largest one, as if the labels were painted in increasing order.
+    Superregion 0 is selected like any other one, only by the labels whose
+    mask it intersects.
+    """
+    source_slice = np.asarray(source_slice)
+    region_slice = np.asarray(region_slice).astype(np.int64)
+    regions, labels = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)]
+    for label in np.unique(source_slice):
+        mask = binary_erosion(source_slice == label, iterations=erosion)
+        selected = np.unique(region_slice[mask])
+        regions.append(selected)
+        labels.append(np.full(len(selected), label, np.int64))
+    regions, labels = np.concatenate(regions), np.concatenate(labels)
+    lut = np.full(regions.max() + 1 if len(regions) > 0 else 0, -1, np.int64)
+    np.maximum.at(lut, regions, labels)
+    return lut
+
+
+def _region_chunks(dataset, region, regions):
+    """Flat indexes of the chunks of the dataset covered by `regions`, all of them without region index."""
+    index = load_region_index(region)
+    if index is None:
+        return range(dataset.total_chunks)
+    bounds = np.asarray(index.bounds[regions[regions < index.nr]])
+    bounds = bounds[(bounds[:, :3] < bounds[:, 3:]).all(axis=1)]
+    chunk_size = np.asarray(dataset.chunk_size)
+    grid = np.zeros(dataset.chunk_grid, bool)
+    for lo, hi in zip(bounds[:, :3] // chunk_size, (bounds[:, 3:] - 1) // chunk_size + 1):
+        grid[tuple(slice(a, b) for a, b in zip(lo, hi))] = True
+    return np.flatnonzero(grid)
+
+
+def _region_label_points(dataset, region, lut):
+    """Groups of the voxels of the superregions with a label in `lut`, see `_write_chunk_labels`."""
+    for flat_idx in _region_chunks(dataset, region, np.flatnonzero(lut >= 0)):
+        chunk_slices = dataset.global_chunk_bounds(dataset.unravel_chunk_index(int(flat_idx)))
+        regions = np.asarray(read_array(region, chunk_slices)).astype(np.int64)
+        labels = lut[np.minimum(regions, len(lut) - 1)]
+        labels[regions >= len(lut)] = -1
+        points = np.nonzero(labels >= 0)
+        if len(points[0]) == 0:
+            continue
+        coords = np.stack(points, axis=1) + [s.start for s in chunk_slices]
+        yield flat_idx, coords, labels[points].astype(dataset.dtype)
+
+
+def annotate_from_slice(dataset, region, source_slice, slice_num, viewer_order=(0, 1, 2)):
+    """Propagate the labels of an annotated slice to the superregions it covers.
+
+    Args:
+        dataset (Dataset): Dataset object to annotate.
+        region (Dataset or np.ndarray): Region image.
+        source_slice (np.ndarray): Labels of slice `slice_num` along the first storage axis.
+        slice_num (int): Index of the slice.
+        viewer_order (tuple, optional): Viewer axes order, unused as the slice is in
+            storage order. Defaults to (0, 1, 2).
+
+    Every superregion selected by a label of the slice (see
+    `slice_region_labels`) is annotated with it, as a single edit. The labels
+    are applied with the lookup table chunk by chunk, only to the chunks
+    covered by the selected superregions if the region index is available,
+    and the history of the chunks modified is shifted once.
+    """
+    region_slice = read_array(region, (slice(slice_num, slice_num + 1),))[0]
+    lut = slice_region_labels(source_slice, region_slice)
+    if not (lut >= 0).any():
+        return
+    _write_chunk_labels(dataset, _region_label_points(dataset, region, lut))
+
 
 def annotate_regions(
     dataset, region, r=None, label=0, parent_mask=None, bb=None, viewer_order=(0, 1, 2)
@@ -146,7 +532,7 @@ def annotate_regions(
         region (np.ndarray): Region image
         r (int, optional): Region index. Defaults to None.
         label (int, optional): Label value. Defaults to 0.
-        parent_mask (np.ndarray, optional): Mask image. Defaults to None.
+        parent_mask (np.ndarray or ParentMask, optional): Mask image. Defaults to None.
         bb (list, optional): Bounding box coordinates. Defaults to None.
         viewer_order (tuple, optional): Viewer axes order. Defaults to (0, 1, 2).
 
@@ -187,6 +573,8 @@ def annotate_regions(
     mask = (mask > 0) * 1.0
 
     if parent_mask is not None:
+        if isinstance(parent_mask, ParentMask):
+            parent_mask = parent_mask.crop()
         parent_mask_t = np.transpose(parent_mask, viewer_order)
         mask = mask * parent_mask_t
 
@@ -207,7 +595,17 @@ def undo_annotation(dataset):
 
     Args:
         dataset (Dataset): Dataset object
+
+    In journal mode only the voxels changed by the last annotation are
+    restored, and the annotation can be redone with `redo_annotation`.
     """
+    journal = _journal(dataset)
+    if journal is not None:
+        entry = journal.undo()
+        if entry is not None:
+            _apply_entry(dataset, entry, entry.old)
+        return
+
     modified = dataset.get_attr("modified")
 
     #    logger.debug("Undoing annotation")
@@ -229,10 +627,26 @@ def undo_annotation(dataset):
             # data = (data << _MaskSize) | (data >> _MaskSize)
             data = data >> _MaskSize
             dataset[chunk_slices] = data
+        modified = [int(m) >> 1 for m in modified]
 
     dataset.set_attr("modified", modified)
 
 
+def redo_annotation(dataset):
+    """Redo the last undone annotation, in journal mode only.
+
+    Args:
+        dataset (Dataset): Dataset object
+    """
+    journal = _journal(dataset)
+    if journal is None:
+        logger.debug("Annotations without journal cannot be redone")
+        return
+    entry = journal.redo()
+    if entry is not None:
+        _apply_entry(dataset, entry, entry.new)
+
+
 def erase_label(dataset, label=0):
     """Erase label with particular value from the dataset.
 
@@ -246,6 +660,18 @@ def erase_label(dataset, label=0):
 
     if label >= 16 or label < 0 or type(label) != int:
         raise ValueError("Label has to be in bounds [0, 15]")
+    journal = _journal(dataset)
+    if journal is not None:  # only the current labels, and those of the journal
+        for i in range(dataset.total_chunks):
+            chunk_slices = dataset.global_chunk_bounds(dataset.unravel_chunk_index(i))
+            data_chunk = dataset[chunk_slices]
+            rmask = data_chunk == label
+            if np.any(rmask):
+                data_chunk[rmask] = 0
+                dataset[chunk_slices] = data_chunk
+        journal.replace(label, 0)
+        return
+
     lmask = _MaskCopy - label
     # remove label from all history
     nbit = np.dtype(dataset.dtype).itemsize * 8
@@ -1,17 +1,28 @@
 import numpy as np
 from loguru import logger
 import ast
+import json
+import threading
+from functools import partial
+from itertools import groupby
 from survos2.api import workspace as ws
-from survos2.api.utils import APIException, dataset_repr
+from survos2.api.utils import APIException, dataset_repr, array_response, encoded_slice
 from survos2.config import Config
 from survos2.data_io import dataset_from_uri
 from survos2.utils import encode_numpy
 from survos2.model import DataModel
+from survos2.model.dataset import read_array
+from survos2.model.pyramid import get_level_slice, level_region, roi_slices
+from survos2.model.region_index import load_region_index
 from survos2.improc.utils import DatasetManager
-from survos2.frontend.view_fn import get_level_from_server
+from survos2.api.annotate import ParentMask
 from survos2.api.annotate import annotate_voxels as _annotate_voxels
 from survos2.api.annotate import annotate_regions as _annotate_regions
+from survos2.api.annotate import annotate_indexed_regions as _annotate_indexed_regions
 from survos2.api.annotate import annotate_from_slice as _annotate_from_slice
+from survos2.api.annotate import annotate_strokes as _annotate_strokes
+from survos2.api.annotate import store_annotation
+from survos2.api.strokes import StrokeQueue, decode_strokes
 
 import pickle
 from fastapi import APIRouter, Body, File, UploadFile, Query
@@ -65,26 +76,26 @@ def set_volume(src: str, vol_array):
 
 
 @annotations.get("/get_volume")
-def get_volume(src: str):
+def get_volume(src: str, level: int = 0):
     ds = dataset_from_uri(src, mode="r")
-    data = ds[:]
-    return encode_numpy(data)
+    return array_response(*level_region(ds, level, [slice(None)] * ds.ndim))
 
 
 @annotations.get("/get_slice")
-def get_slice(src: str, slice_idx: int, order: tuple = Query()):
-    ds = dataset_from_uri(src, mode="r")[:]
-    order = tuple(int(e) for e in order)
-    ds = np.transpose(ds, order)
-    data = ds[slice_idx]
+def get_slice(
+    src: str, slice_idx: int, order: tuple = Query(), level: int = 0, codec: str = None
+):
+    ds = dataset_from_uri(src, mode="r")
+    if codec is not None:
+        return encoded_slice(ds, slice_idx, order, level, codec=codec)
+    data = get_level_slice(ds, slice_idx, order, level)
     return encode_numpy(data)
 
 
 @annotations.get("/get_crop")
-def get_crop(src: str, roi: list):
+def get_crop(src: str, roi: list, level: int = 0):
     ds = dataset_from_uri(src, mode="r")
-    data = ds[roi[0] : roi[1], roi[2] : roi[3], roi[4] : roi[5]]
-    return encode_numpy(data)
+    return array_response(*level_region(ds, level, roi_slices(roi, level)))
 
 
 @annotations.get("/set_label_parent")
@@ -140,10 +151,23 @@ def add_level(workspace: str):
     logger.debug(ds)
     ds.set_attr("kind", "level")
     ds.set_attr("modified", [0] * ds.total_chunks)
+    ds.set_attr("history", Config["computing.annotation_history"])
+    ds.set_attr("history_depth", Config["computing.annotation_journal_depth"])
 
     return dataset_repr(ds)
 
 
+def parent_mask(workspace: str, parent_level: str, parent_label_idx: int):
+    """
+    `ParentMask` of the parent label constraining an annotation, or `None`
+    if there is no parent level. Only the parent chunks under a stroke are
+    read, and their masks are cached until the parent level is modified.
+    """
+    if parent_level == "-1" or parent_level == -1:
+        return None
+    return ParentMask(get_level(workspace, parent_level), parent_label_idx)
+
+
 @annotations.get("/get_level")
 def get_level(workspace: str, level: str, full: bool = False):
     if full == False:
@@ -273,39 +297,65 @@ def annotate_voxels(
     viewer_order: tuple = Body(),
 ):
 
+    stroke_queue(workspace, level).wait()  # after the strokes queued so far
     ds = get_level(workspace, level, full)
 
-    from survos2.frontend.frontend import get_level_from_server
-
-    if parent_level != "-1" and parent_level != -1:
-        parent_arr, parent_annotations_dataset = get_level_from_server(
-            {"level_id": parent_level}, retrieval_mode="volume"
-        )
-
-        if isinstance(parent_arr, np.ndarray):
-            parent_arr = parent_arr & 15
-            parent_mask = parent_arr == parent_label_idx
-        else:
-            parent_arr = None
-            parent_mask = None
-    else:
-        parent_arr = None
-        parent_mask = None
-
     _annotate_voxels(
         ds,
         slice_idx=slice_idx,
         yy=yy,
         xx=xx,
         label=label,
-        parent_mask=parent_mask,
+        parent_mask=parent_mask(workspace, parent_level, parent_label_idx),
         viewer_order=viewer_order,
     )
     DataModel.g.current_workspace = workspace
-    dst = DataModel.g.dataset_uri(level, group="annotations")
-    modified_ds = dataset_from_uri(dst, mode="r")
-    modified = [1]
-    modified_ds.set_attr("modified", modified)
+
+__stroke_queues__ = dict()
+__stroke_queues_lock__ = threading.Lock()
+
+
+def stroke_queue(workspace: str, level: str):
+    """`StrokeQueue` of the strokes painted on `level`, created on first use."""
+    with __stroke_queues_lock__:
+        key = (workspace, level)
+        if key not in __stroke_queues__:
+            __stroke_queues__[key] = StrokeQueue(partial(_apply_strokes, workspace, level))
+        return __stroke_queues__[key]
+
+
+def _apply_strokes(workspace: str, level: str, batches: list):
+    ds = get_level(workspace, level)
+    # consecutive batches sharing their parameters are written at once
+    for _, group in groupby(batches, key=lambda batch: json.dumps(batch[1], sort_keys=True)):
+        group = list(group)
+        params = group[0][1]
+        _annotate_strokes(
+            ds,
+            [stroke for strokes, _ in group for stroke in strokes],
+            parent_mask=parent_mask(workspace, params["parent_level"], params["parent_label_idx"]),
+            viewer_order=tuple(params["viewer_order"]),
+        )
+
+
+@annotations.post("/queue_strokes")
+def queue_strokes(file: UploadFile = File(...)):
+    """Queue a batch of strokes encoded by `survos2.api.strokes.encode_strokes`,
+    with the `workspace`, `level`, `parent_level`, `parent_label_idx` and
+    `viewer_order` parameters. Returns as soon as the batch is queued, with
+    the ticket to wait for it (see `wait_strokes`).
+    """
+    strokes, params = decode_strokes(file.file.read())
+    ticket = stroke_queue(params["workspace"], params["level"]).submit((strokes, params))
+    return dict(ticket=ticket)
+
+
+@annotations.get("/wait_strokes")
+def wait_strokes(workspace: str, level: str, ticket: int = 0, timeout: float = 10):
+    """Waits until the batch `ticket` (every batch queued so far if `0`) is applied."""
+    done, error = stroke_queue(workspace, level).wait(ticket or None, timeout=timeout)
+    return dict(done=done, error=error)
+
 
 @annotations.get("/annotate_from_slice")
 def annotate_from_slice(
@@ -317,25 +367,16 @@ def annotate_from_slice(
     viewer_order: tuple = Body(),
 ):
     DataModel.g.current_workspace = workspace
+    stroke_queue(workspace, target_level).wait()
     target_ds = get_level(workspace, target_level, False)
     source_ds = get_level(workspace, source_level, False)
 
     region_uri = DataModel.g.dataset_uri(region, group="superregions")
     region_ds = dataset_from_uri(region_uri, mode="r")
-    source_std_label = source_ds[:] & 15
-    source_slice = source_std_label[slice_num,:]
-
-    anno = _annotate_from_slice(target_ds,
-                                region_ds, 
-                                source_slice,
-                                slice_num, 
-                                viewer_order)
-    
-    dst = DataModel.g.dataset_uri(target_level, group="annotations")
-    target_ds[:] = anno
-    modified_ds = dataset_from_uri(dst, mode="rw")
-    modified = [1]
-    modified_ds.set_attr("modified", modified)
+    source_slice = read_array(source_ds, (slice(slice_num, slice_num + 1),))[0] & 15
+
+    _annotate_from_slice(target_ds, region_ds, source_slice, slice_num, viewer_order)
+
 
 @annotations.get("/annotate_regions")
 def annotate_regions(
@@ -351,39 +392,49 @@ def annotate_regions(
     viewer_order: tuple = Body(),
 ):
     DataModel.g.current_workspace = workspace
+    stroke_queue(workspace, level).wait()
     ds = get_level(workspace, level, full)
     region = dataset_from_uri(region, mode="r")
-
-    if parent_level != "-1" and parent_level != -1:
-        parent_arr, parent_annotations_dataset = get_level_from_server(
-            {"level_id": parent_level}, retrieval_mode="volume"
+    parent = parent_mask(workspace, parent_level, parent_label_idx)
+
+    index = load_region_index(region)
+    if index is not None:
+        _annotate_indexed_regions(
+            ds,
+            index,
+            r=r,
+            label=label,
+            parent_mask=parent,
+            bb=bb,
+            viewer_order=viewer_order,
         )
-        parent_arr = parent_arr & 15
-        parent_mask = parent_arr == parent_label_idx
-    else:
-        parent_arr = None
-        parent_mask = None
+        return
 
     anno = _annotate_regions(
         ds,
         region,
         r=r,
         label=label,
-        parent_mask=parent_mask,
+        parent_mask=parent,
         bb=bb,
         viewer_order=viewer_order,
     )
-
-    dst = DataModel.g.dataset_uri(level, group="annotations")
-    ds[:] = anno
-    modified_ds = dataset_from_uri(dst, mode="rw")
-    modified = [1]
-    modified_ds.set_attr("modified", modified)
+    store_annotation(ds, anno)
 
 
 @annotations.get("/annotate_undo")
 def annotate_undo(workspace: str, level: str, full: bool = False):
     from survos2.api.annotate import undo_annotation
 
+    stroke_queue(workspace, level).wait()
     ds = get_level(workspace, level, full)
     undo_annotation(ds)
+
+
+@annotations.get("/annotate_redo")
+def annotate_redo(workspace: str, level: str, full: bool = False):
+    from survos2.api.annotate import redo_annotation
+
+    stroke_queue(workspace, level).wait()
+    ds = get_level(workspace, level, full)
+    redo_annotation(ds)
@@ -4,12 +4,15 @@ from loguru import logger
 from survos2.api import workspace as ws
 
 from survos2.api.utils import dataset_repr, get_function_api
-from survos2.api.utils import save_metadata, dataset_repr
+from survos2.api.utils import save_metadata, dataset_repr, array_response, encoded_slice, cache_result
+from survos2.api.utils import get_default_args, record_metadata
 from survos2.improc import map_blocks
 from survos2.data_io import dataset_from_uri
 from survos2.utils import encode_numpy, decode_numpy, encode_numpy_slice
 from survos2.model import DataModel
-from survos2.improc.utils import DatasetManager
+from survos2.model.cache import FeatureCache
+from survos2.model.pyramid import level_region, roi_slices
+from survos2.improc.utils import DatasetManager, map_filter_bank
 from survos2.model import DataModel
 
 from typing import Union, List, Optional
@@ -32,6 +35,44 @@ def rescale_denan(img):
     return img
 
 
+__filter_specs__ = dict()
+
+
+def filter_spec(name):
+    """
+    Registers the block filter of the feature endpoint `name`: a function of
+    the parameters of the endpoint returning the filter (see `_filter`). The
+    endpoint computes it with `map_blocks` and `/batch` in a filter bank.
+    """
+
+    def register(spec):
+        __filter_specs__[name] = spec
+        return spec
+
+    return register
+
+
+def _filter(func, pad=0, normalize=False, inplace=False, **kwargs):
+    """
+    Block filter applying `func` with `kwargs`, the padding and normalization
+    of `map_blocks`, and whether `func` modifies its input (see `map_filter_bank`).
+    """
+    return dict(func=func, kwargs=kwargs, pad=pad, normalize=normalize, inplace=inplace)
+
+
+def _map_filter(spec, src, dst):
+    """Computes the block filter `spec` of `src` into `dst`."""
+    map_blocks(spec["func"], src, out=dst, pad=spec["pad"], normalize=spec["normalize"], **spec["kwargs"])
+
+
+def _sigma(sigma):
+    return [sigma] * 3 if isinstance(sigma, (int, float)) else sigma
+
+
+def _sigma_pad(sigma):
+    return max(4, int(np.max(sigma) * 2))
+
+
 @features.post("/upload")
 def upload(file: UploadFile = File(...)):
     """Upload features layer as an array (via Launcher) to the current workspace.
@@ -55,36 +96,23 @@ def upload(file: UploadFile = File(...)):
 
 
 @features.get("/get_volume")
-def get_volume(src: str):
+def get_volume(src: str, level: int = 0):
     logger.debug("Getting feature volume")
     ds = dataset_from_uri(src, mode="r")
-    data = ds[:]
-    return encode_numpy(data)
+    return array_response(*level_region(ds, level, [slice(None)] * ds.ndim))
 
 
 @features.get("/get_crop")
-def get_crop(src: str, roi: list):
+def get_crop(src: str, roi: list, level: int = 0):
     logger.debug("Getting feature crop")
     ds = dataset_from_uri(src, mode="r")
-    data = ds[roi[0] : roi[1], roi[2] : roi[3], roi[4] : roi[5]]
-    return encode_numpy(data)
+    return array_response(*level_region(ds, level, roi_slices(roi, level)))
 
 
 @features.get("/get_slice")
-def get_slice(src: str, slice_idx: int, order: tuple):
-    order = np.array(order)
-    ds = dataset_from_uri(src, mode="r")[:]
-    ds = np.transpose(ds, order).astype(np.float32)
-    data = ds[slice_idx]
-    return encode_numpy_slice(data.astype(np.float32))
-
-
-def simple_norm(dst):
-    with DatasetManager(dst, out=None, dtype="float32", fillvalue=0) as DM:
-        arr = DM.sources[0][:]
-        arr -= np.min(arr)
-        arr /= np.max(arr)
-    map_blocks(pass_through, arr, out=dst, normalize=False)
+def get_slice(src: str, slice_idx: int, order: tuple, level: int = 0, codec: str = "jpeg"):
+    ds = dataset_from_uri(src, mode="r")
+    return encoded_slice(ds, slice_idx, order, level, codec=codec, dtype=np.float32)
 
 
 @features.get("/feature_composite")
@@ -117,25 +145,40 @@ def feature_composite(
     map_blocks(pass_through, result, out=dst, normalize=False)
 
 
+@filter_spec("structure_tensor_determinant")
+def _structure_tensor_determinant(sigma):
+    from ..server.filtering.blob import compute_structure_tensor_determinant
+
+    return _filter(compute_structure_tensor_determinant, sigma=sigma, pad=_sigma_pad(sigma), normalize="minmax")
+
+
 @features.get("/structure_tensor_determinant")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def structure_tensor_determinant(src: str, dst: str, sigma: List[int] = Query()) -> "BLOB":
-    from ..server.filtering.blob import compute_structure_tensor_determinant
+    _map_filter(_structure_tensor_determinant(sigma), src, dst)
 
-    map_blocks(
-        compute_structure_tensor_determinant,
-        src,
-        out=dst,
-        sigma=sigma,
-        pad=max(4, int((max(sigma) * 2))),
-        normalize=True,
-    )
 
-    simple_norm(dst)
+@filter_spec("frangi")
+def _frangi(scale_min, scale_max, **params):
+    from ..server.filtering.blob import compute_frangi
+
+    return _filter(
+        compute_frangi,
+        scale_range=(scale_min, scale_max),
+        scale_step=1.0,
+        alpha=0.5,
+        beta=0.5,
+        gamma=15,
+        dark_response=True,
+        normalize="minmax",
+        pad=max(4, int((scale_max * 2))),
+    )
 
 
 @features.get("/frangi")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def frangi(
     src: str,
     dst: str,
@@ -146,62 +189,56 @@ def frangi(
     beta: float = 0.5,
     gamma=15,
 ) -> "BLOB":
-    from ..server.filtering.blob import compute_frangi
+    _map_filter(_frangi(scale_min, scale_max), src, dst)
 
-    map_blocks(
-        compute_frangi,
-        src,
-        out=dst,
-        scale_range=(scale_min, scale_max),
-        scale_step=1.0,
-        alpha=0.5,
-        beta=0.5,
-        gamma=15,
-        dark_response=True,
-        normalize=True,
-        pad=max(4, int((scale_max * 2))),
-    )
 
-    simple_norm(dst)
+@filter_spec("hessian_eigenvalues")
+def _hessian_eigenvalues(sigma):
+    from ..server.filtering.blob import hessian_eigvals_image
+
+    return _filter(hessian_eigvals_image, sigma=sigma, pad=_sigma_pad(sigma), normalize="minmax")
 
 
 @features.get("/hessian_eigenvalues")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def hessian_eigenvalues(src: str, dst: str, sigma: List[int] = Query()) -> "BLOB":
-    from ..server.filtering.blob import hessian_eigvals_image
-
-    map_blocks(
-        hessian_eigvals_image,
-        src,
-        out=dst,
-        pad=max(4, int((max(sigma) * 2))),
-        sigma=sigma,
-        normalize=True,
-    )
-
-    simple_norm(dst)
+    _map_filter(_hessian_eigenvalues(sigma), src, dst)
 
 
 def pass_through(x):
     return x
 
 
+@filter_spec("raw")
+def _raw():
+    return _filter(pass_through, normalize=True)
+
+
 @features.get("/raw")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def raw(src: str, dst: str) -> "BASE":
-    map_blocks(pass_through, src, out=dst, normalize=True)
+    _map_filter(_raw(), src, dst)
 
 
-@features.get("/simple_invert")
-@save_metadata
-def simple_invert(src: str, dst: str) -> "BASE":
+@filter_spec("simple_invert")
+def _simple_invert():
     from ..server.filtering import simple_invert
 
-    map_blocks(simple_invert, src, out=dst, normalize=True)
+    return _filter(simple_invert, normalize=True)
+
+
+@features.get("/simple_invert")
+@save_metadata(incremental=True)
+@cache_result
+def simple_invert(src: str, dst: str) -> "BASE":
+    _map_filter(_simple_invert(), src, dst)
 
 
 @features.get("/invert_threshold")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def invert_threshold(src: str, dst: str, thresh: float = 0.5) -> "BASE":
     from ..server.filtering import invert_threshold
 
@@ -213,7 +250,8 @@ def invert_threshold(src: str, dst: str, thresh: float = 0.5) -> "BASE":
 
 
 @features.get("/threshold")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def threshold(src: str, dst: str, threshold: float = 0.5) -> "BASE":
     from ..server.filtering import threshold as threshold_fn
 
@@ -225,7 +263,8 @@ def threshold(src: str, dst: str, threshold: float = 0.5) -> "BASE":
 
 
 @features.get("/rescale")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def rescale(src: str, dst: str) -> "BASE":
 
     logger.debug(f"Rescaling src {src}")
@@ -237,76 +276,83 @@ def rescale(src: str, dst: str) -> "BASE":
     map_blocks(pass_through, filtered, out=dst, normalize=False)
 
 
+@filter_spec("gamma_correct")
+def _gamma_correct(gamma):
+    from ..server.filtering import gamma_adjust
+
+    return _filter(gamma_adjust, gamma=gamma, normalize=True)
+
+
 @features.get("/gamma_correct")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def gamma_correct(src: str, dst: str, gamma: float = 1.0) -> "BASE":
-    from ..server.filtering import gamma_adjust
+    _map_filter(_gamma_correct(gamma), src, dst)
 
-    map_blocks(gamma_adjust, src, gamma=gamma, out=dst, normalize=True)
+
+@filter_spec("dilation")
+def _dilation(num_iter):
+    from ..server.filtering import dilate
+
+    # dilate shifts its input in place
+    return _filter(dilate, num_iter=num_iter, normalize=True, pad=max(4, int(num_iter * 2)), inplace=True)
 
 
 @features.get("/dilation")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def dilation(src: str, dst: str, num_iter: int = 1) -> "MORPHOLOGY":
-    from ..server.filtering import dilate
+    _map_filter(_dilation(num_iter), src, dst)
 
-    map_blocks(
-        dilate,
-        src,
-        num_iter=num_iter,
-        out=dst,
-        normalize=True,
-        pad=max(4, int(num_iter * 2)),
-    )
+
+@filter_spec("erosion")
+def _erosion(num_iter):
+    from ..server.filtering import erode
+
+    # erode shifts its input in place
+    return _filter(erode, num_iter=num_iter, normalize=True, pad=max(4, int(num_iter * 2)), inplace=True)
 
 
 @features.get("/erosion")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def erosion(src: str, dst: str, num_iter: int = 1) -> "MORPHOLOGY":
-    from ..server.filtering import erode
+    _map_filter(_erosion(num_iter), src, dst)
 
-    map_blocks(
-        erode,
-        src,
-        num_iter=num_iter,
-        out=dst,
-        normalize=True,
-        pad=max(4, int(num_iter * 2)),
-    )
+
+@filter_spec("opening")
+def _opening(num_iter):
+    from ..server.filtering import opening
+
+    # opening shifts its input in place
+    return _filter(opening, num_iter=num_iter, normalize=True, pad=max(4, int(num_iter * 2)), inplace=True)
 
 
 @features.get("/opening")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def opening(src: str, dst: str, num_iter: int = 1) -> "MORPHOLOGY":
-    from ..server.filtering import opening
+    _map_filter(_opening(num_iter), src, dst)
 
-    map_blocks(
-        opening,
-        src,
-        num_iter=num_iter,
-        out=dst,
-        normalize=True,
-        pad=max(4, int(num_iter * 2)),
-    )
+
+@filter_spec("closing")
+def _closing(num_iter):
+    from ..server.filtering import closing
+
+    # closing shifts its input in place
+    return _filter(closing, num_iter=num_iter, normalize=True, pad=max(4, int(num_iter * 2)), inplace=True)
 
 
 @features.get("/closing")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def closing(src: str, dst: str, num_iter: int = 1) -> "MORPHOLOGY":
-    from ..server.filtering import closing
-
-    map_blocks(
-        closing,
-        src,
-        num_iter=num_iter,
-        out=dst,
-        normalize=True,
-        pad=max(4, int(num_iter * 2)),
-    )
+    _map_filter(_closing(num_iter), src, dst)
 
 
 @features.get("/distance_transform_edt")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def distance_transform_edt(src: str, dst: str) -> "MORPHOLOGY":
     from ..server.filtering import distance_transform_edt
 
@@ -319,7 +365,8 @@ def distance_transform_edt(src: str, dst: str) -> "MORPHOLOGY":
 
 
 @features.get("/skeletonize")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def skeletonize(src: str, dst: str) -> "MORPHOLOGY":
     from ..server.filtering import skeletonize
 
@@ -331,21 +378,12 @@ def skeletonize(src: str, dst: str) -> "MORPHOLOGY":
     map_blocks(pass_through, filtered, out=dst, normalize=False)
 
 
-@features.get("/tvdenoise")
-@save_metadata
-def tvdenoise(
-    src: str,
-    dst: str,
-    regularization_amount: float = 0.001,
-    pad: int = 8,
-    max_iter: int = 100,
-) -> "DENOISING":
+@filter_spec("tvdenoise")
+def _tvdenoise(regularization_amount, pad, max_iter):
     from ..server.filtering.blur import tvdenoise_kornia
 
-    map_blocks(
+    return _filter(
         tvdenoise_kornia,
-        src,
-        out=dst,
         regularization_amount=regularization_amount,
         max_iter=max_iter,
         pad=pad,
@@ -353,144 +391,142 @@ def tvdenoise(
     )
 
 
-@features.get("/spatial_gradient_3d")
-@save_metadata
-def spatial_gradient_3d(src: str, dst: str, dim: int = 0) -> "EDGES":
+@features.get("/tvdenoise")
+@save_metadata(incremental=True)
+@cache_result
+def tvdenoise(
+    src: str,
+    dst: str,
+    regularization_amount: float = 0.001,
+    pad: int = 8,
+    max_iter: int = 100,
+) -> "DENOISING":
+    _map_filter(_tvdenoise(regularization_amount, pad, max_iter), src, dst)
+
+
+@filter_spec("spatial_gradient_3d")
+def _spatial_gradient_3d(dim):
     from ..server.filtering import spatial_gradient_3d
 
-    map_blocks(
-        spatial_gradient_3d,
-        src,
-        out=dst,
-        dim=dim,
-        normalize=True,
-    )
+    return _filter(spatial_gradient_3d, dim=dim, normalize="minmax")
+
 
-    simple_norm(dst)
+@features.get("/spatial_gradient_3d")
+@save_metadata(incremental=True)
+@cache_result
+def spatial_gradient_3d(src: str, dst: str, dim: int = 0) -> "EDGES":
+    _map_filter(_spatial_gradient_3d(dim), src, dst)
 
 
-@features.get("/difference_of_gaussians")
-@save_metadata
-def difference_of_gaussians(
-    src: str, dst: str, sigma: List[int] = Query(), sigma_ratio: float = 2
-) -> "EDGES":
+@filter_spec("difference_of_gaussians")
+def _difference_of_gaussians(sigma, sigma_ratio):
     from ..server.filtering.edge import compute_difference_gaussians
 
-    if isinstance(sigma, float) or isinstance(sigma, int):
-        sigma = np.array([sigma] * 3)
-    map_blocks(
+    sigma = _sigma(sigma)
+    # negates its input in place for dark responses
+    return _filter(
         compute_difference_gaussians,
-        src,
-        out=dst,
         sigma=sigma,
         sigma_ratio=sigma_ratio,
-        pad=max(4, int((np.max(sigma) * 2))),
-        normalize=True,
+        pad=_sigma_pad(sigma),
+        normalize="minmax",
+        inplace=True,
     )
-    simple_norm(dst)
 
 
-@features.get("/gaussian_blur")
-@save_metadata
-def gaussian_blur(src: str, dst: str, sigma: List[int] = Query()) -> "DENOISING":
-    from ..server.filtering import gaussian_blur_kornia
+@features.get("/difference_of_gaussians")
+@save_metadata(incremental=True)
+@cache_result
+def difference_of_gaussians(
+    src: str, dst: str, sigma: List[int] = Query(), sigma_ratio: float = 2
+) -> "EDGES":
+    _map_filter(_difference_of_gaussians(sigma, sigma_ratio), src, dst)
 
-    if isinstance(sigma, float) or isinstance(sigma, int):
-        sigma = np.array([sigma] * 3)
 
+@filter_spec("gaussian_blur")
+def _gaussian_blur(sigma):
+    from ..server.filtering import gaussian_blur_kornia
+
+    sigma = _sigma(sigma)
     if sigma[0] == 0:
         from skimage.filters import gaussian
 
-        map_blocks(
-            gaussian,
-            src,
-            out=dst,
-            sigma=(1.0, sigma[1], sigma[2]),
-            pad=0,
-            normalize=False,
-        )
+        return _filter(gaussian, sigma=(1.0, sigma[1], sigma[2]), pad=0, normalize=False)
+    return _filter(gaussian_blur_kornia, sigma=sigma, pad=_sigma_pad(sigma), normalize=False)
 
-    else:
-        map_blocks(
-            gaussian_blur_kornia,
-            src,
-            out=dst,
-            sigma=sigma,
-            pad=max(4, int((max(sigma) * 2))),
-            normalize=False,
-        )
+
+@features.get("/gaussian_blur")
+@save_metadata(incremental=True)
+@cache_result
+def gaussian_blur(src: str, dst: str, sigma: List[int] = Query()) -> "DENOISING":
+    _map_filter(_gaussian_blur(sigma), src, dst)
+
+
+@filter_spec("laplacian")
+def _laplacian(sigma):
+    from ..server.filtering import ndimage_laplacian
+
+    return _filter(ndimage_laplacian, kernel_size=sigma, pad=_sigma_pad(sigma), normalize="minmax")
 
 
 @features.get("/laplacian")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def laplacian(src: str, dst: str, sigma: List[int] = Query()) -> "EDGES":
-    from ..server.filtering import ndimage_laplacian
+    _map_filter(_laplacian(sigma), src, dst)
 
-    map_blocks(
-        ndimage_laplacian,
-        src,
-        out=dst,
-        kernel_size=sigma,
-        # pad=max(4, int(max(np.array(kernel_size))) * 3),
-        pad=max(4, int((max(sigma) * 2))),
-        normalize=False,
-    )
 
-    simple_norm(dst)
+@filter_spec("gaussian_norm")
+def _gaussian_norm(sigma):
+    from ..server.filtering.blur import gaussian_norm
+
+    return _filter(gaussian_norm, sigma=sigma, pad=_sigma_pad(sigma), normalize="minmax")
 
 
 @features.get("/gaussian_norm")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def gaussian_norm(src: str, dst: str, sigma: List[int] = Query()) -> "NEIGHBORHOOD":
-    from ..server.filtering.blur import gaussian_norm
+    _map_filter(_gaussian_norm(sigma), src, dst)
 
-    map_blocks(
-        gaussian_norm,
-        src,
-        out=dst,
-        sigma=sigma,
-        pad=max(4, int((max(sigma) * 2))),
-        normalize=False,
-    )
 
-    simple_norm(dst)
+@filter_spec("gaussian_center")
+def _gaussian_center(sigma):
+    from ..server.filtering.blur import gaussian_center
+
+    return _filter(gaussian_center, sigma=sigma, pad=_sigma_pad(sigma), normalize="minmax")
 
 
 @features.get("/gaussian_center")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def gaussian_center(src: str, dst: str, sigma: List[int] = Query()) -> "NEIGHBORHOOD":
+    _map_filter(_gaussian_center(sigma), src, dst)
 
-    from ..server.filtering.blur import gaussian_center
 
-    map_blocks(
-        gaussian_center,
-        src,
-        out=dst,
-        sigma=sigma,
-        pad=max(4, int((max(sigma) * 2))),
-        normalize=False,
-    )
-    simple_norm(dst)
-
-
-@features.get("/median")
-@save_metadata
-def median(src: str, dst: str, median_size: int = 1, num_iter: int = 1) -> "DENOISING":
+@filter_spec("median")
+def _median(median_size, num_iter):
     from ..server.filtering import median
 
-    map_blocks(
+    return _filter(
         median,
-        src,
         median_size=median_size,
         num_iter=num_iter,
-        out=dst,
         pad=max(4, int((median_size * 2))),
         normalize=False,
     )
 
 
+@features.get("/median")
+@save_metadata(incremental=True)
+@cache_result
+def median(src: str, dst: str, median_size: int = 1, num_iter: int = 1) -> "DENOISING":
+    _map_filter(_median(median_size, num_iter), src, dst)
+
+
 @features.get("/wavelet")
-@save_metadata
+@save_metadata(incremental=True)
+@cache_result
 def wavelet(
     src: str,
     dst: str,
@@ -510,6 +546,41 @@ def wavelet(
     map_blocks(pass_through, result, out=dst, normalize=False)
 
 
+def batch_filter(name, params, dst):
+    """
+    The filter of the endpoint `name` with `params` (the defaults of the
+    endpoint for the missing ones) writing to `dst`, for `map_filter_bank`,
+    and the parameters it is computed with.
+    """
+    if name not in __filter_specs__:
+        raise ValueError("Feature '{}' can not be computed in a batch".format(name))
+    defaults = get_default_args(globals()[name])
+    defaults = {k: v for k, v in defaults.items() if isinstance(v, (bool, int, float, str, list))}
+    params = dict(defaults, **params)
+    if isinstance(params.get("sigma"), (int, float)):
+        params["sigma"] = [params["sigma"]] * 3
+    return dict(__filter_specs__[name](**params), out=dst), params
+
+
+@features.post("/batch")
+def batch(src: str = Body(), specs: List[dict] = Body()):
+    """
+    Computes a bank of features of `src` in a single pass over the data.
+    `specs` is a list of `{"filter": name, "params": {...}, "dst": uri}`,
+    where `name` is a filter endpoint (see `__filter_specs__`). Every block
+    of `src` is read and padded once for all the filters, and the Gaussian
+    blurs of the block are shared by the filters smoothing it with the same
+    sigma (see `shared_gaussian`).
+    """
+    from ..server.filtering.blur import shared_gaussian
+
+    if not specs:
+        return []
+    filters, params = zip(*[batch_filter(s["filter"], s.get("params", dict()), s["dst"]) for s in specs])
+    map_filter_bank(src, list(filters), block_context=shared_gaussian)
+    return [record_metadata(s["filter"], src, s["dst"], p) for s, p in zip(specs, params)]
+
+
 @features.get("/create")
 def create(workspace: str, feature_type: str):
     ds = ws.auto_create_dataset(
@@ -551,6 +622,18 @@ def rename(workspace: str, feature_id: str, new_name: str):
     return {"done": "ok"}
 
 
+@features.get("/cache")
+def cache(workspace: str):
+    """Lists the entries of the feature cache of the workspace."""
+    return FeatureCache(ws.get(workspace).path).entries()
+
+
+@features.get("/purge_cache")
+def purge_cache(workspace: str, key: Optional[str] = None):
+    """Removes the entry `key` of the feature cache, or all of them."""
+    return {"purged": FeatureCache(ws.get(workspace).path).purge(key)}
+
+
 @features.get("/group")
 def group():
     return __feature_group__
@@ -574,6 +657,9 @@ def available():
             "get_slice",
             "get_crop",
             "upload",
+            "cache",
+            "purge_cache",
+            "batch",
         ]:
             continue
         func = r.endpoint
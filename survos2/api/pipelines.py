@@ -12,6 +12,7 @@ import ntpath
 import os
 import random
 import sys
+from contextlib import ExitStack
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
@@ -289,17 +290,18 @@ def superregion_segment(
         src_dataset = DM.sources[0]
         supervoxel_image = src_dataset[:]
 
-    # get features
+    # get features, kept open as sr_predict reads them chunk by chunk
     features = []
+    feature_managers = ExitStack()
 
     for feature_id in feature_ids:
         src = DataModel.g.dataset_uri(feature_id, group="features")
         logger.debug(f"Getting features {src}")
 
-        with DatasetManager(src, out=None, dtype="float32", fillvalue=0) as DM:
-            src_dataset = DM.sources[0]
-            logger.debug(f"Adding feature of shape {src_dataset.shape}")
-            features.append(src_dataset[:])
+        DM = feature_managers.enter_context(DatasetManager(src, out=None, dtype="float32", fillvalue=0))
+        src_dataset = DM.sources[0]
+        logger.debug(f"Adding feature of shape {src_dataset.shape}")
+        features.append(src_dataset)
 
     logger.debug(
         f"sr_predict with {len(features)} features and anno of shape {anno_level.shape} and sr of shape {supervoxel_image.shape}"
@@ -332,15 +334,16 @@ def superregion_segment(
     else:
         mask = None
 
-    segmentation, conf_map = sr_predict(
-        supervoxel_image,
-        anno_level,
-        features,
-        mask,
-        superseg_cfg,
-        refine,
-        lam,
-    )
+    with feature_managers:
+        segmentation, conf_map = sr_predict(
+            supervoxel_image,
+            anno_level,
+            features,
+            mask,
+            superseg_cfg,
+            refine,
+            lam,
+        )
     conf_map = conf_map[:, :, :, 1]
     logger.info(f"Obtained conf map of shape {conf_map.shape}")
 
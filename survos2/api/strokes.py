@@ -0,0 +1,146 @@
+"""
+Batched submission of painted strokes.
+
+A stroke is the set of voxels painted with a label on a slice, stored as the
+bit-packed mask of its bounding box in the slice. A batch of strokes is sent
+to the server as a single `.npz` payload (see `encode_strokes`), together with
+the parameters shared by its strokes (level, parent label, viewer order), and
+queued in the `StrokeQueue` of the level: the request is acknowledged with a
+ticket as soon as it is queued, and the batches are applied in order by a
+background thread, every run of queued batches as a single write of the
+chunks they cover (see `annotate_strokes`). The errors of the last
+`STROKE_ERRORS` batches are kept for the clients waiting for them.
+
+"""
+
+import io
+import json
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+from loguru import logger
+
+STROKE_FIELDS = ("slice_idx", "label", "y0", "x0", "height", "width")
+STROKE_ERRORS = 1024  # batches whose error is kept until waited for
+
+
+class Stroke(namedtuple("Stroke", ("slice_idx", "label", "y0", "x0", "mask"))):
+    """Voxels painted with `label` on slice `slice_idx`: `mask` of the box starting at `(y0, x0)`."""
+
+    def points(self):
+        """Coordinates `(yy, xx)` of the painted voxels in the slice."""
+        yy, xx = np.nonzero(self.mask)
+        return yy + self.y0, xx + self.x0
+
+
+def stroke_from_points(slice_idx, yy, xx, label):
+    """`Stroke` of the voxels `(yy, xx)` of slice `slice_idx` painted with `label`."""
+    yy = np.asarray(yy, dtype=np.int64).ravel()
+    xx = np.asarray(xx, dtype=np.int64).ravel()
+    if len(yy) == 0:
+        return Stroke(int(slice_idx), int(label), 0, 0, np.zeros((0, 0), bool))
+    y0, x0 = int(yy.min()), int(xx.min())
+    mask = np.zeros((int(yy.max()) - y0 + 1, int(xx.max()) - x0 + 1), bool)
+    mask[yy - y0, xx - x0] = True
+    return Stroke(int(slice_idx), int(label), y0, x0, mask)
+
+
+def encode_strokes(strokes, **params):
+    """
+    Encodes a batch of `strokes` and the parameters they share (which have
+    to be json serializable) as bytes: a header row per stroke (see
+    `STROKE_FIELDS`) and the bit-packed masks of every stroke, concatenated.
+    """
+    header = np.array(
+        [(s.slice_idx, s.label, s.y0, s.x0) + tuple(s.mask.shape) for s in strokes], dtype=np.int64
+    ).reshape(-1, len(STROKE_FIELDS))
+    bits = [np.packbits(s.mask, axis=None) for s in strokes]
+    buffer = io.BytesIO()
+    np.savez(
+        buffer,
+        header=header,
+        bits=np.concatenate(bits) if bits else np.zeros(0, np.uint8),
+        params=np.array(json.dumps(params)),
+    )
+    return buffer.getvalue()
+
+
+def decode_strokes(data):
+    """Decodes a batch encoded by `encode_strokes`, returns the strokes and their parameters."""
+    with np.load(io.BytesIO(data), allow_pickle=False) as f:
+        header, bits, params = f["header"], f["bits"], json.loads(str(f["params"]))
+    strokes = []
+    offset = 0
+    for slice_idx, label, y0, x0, height, width in header.tolist():
+        size = height * width
+        nbytes = -(-size // 8)
+        mask = np.unpackbits(bits[offset : offset + nbytes], count=size).reshape(height, width)
+        strokes.append(Stroke(slice_idx, label, y0, x0, mask.astype(bool)))
+        offset += nbytes
+    return strokes, params
+
+
+class StrokeQueue(object):
+    """
+    Queue of stroke batches of a level, applied in order in a background
+    thread by `apply(batches)`, which receives every batch queued since the
+    last call, so that consecutive batches are written at once. `submit`
+    returns a ticket without waiting, `wait` blocks until it was applied.
+    Only the errors of the last `max_errors` batches are kept.
+    """
+
+    def __init__(self, apply, name="survos_strokes", max_errors=STROKE_ERRORS):
+        self._apply = apply
+        self._name = name
+        self._max_errors = max_errors
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._submitted = 0
+        self._done = 0
+        self._errors = dict()
+        self._thread = None
+
+    def submit(self, batch):
+        with self._cond:
+            self._submitted += 1
+            self._pending.append(batch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return self._submitted
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batches = list(self._pending)
+                self._pending.clear()
+                last = self._done + len(batches)
+            error = None
+            try:
+                self._apply(batches)
+            except Exception as e:
+                logger.warning("Unable to apply {} stroke batches: {}".format(len(batches), e))
+                error = str(e)
+            with self._cond:
+                if error is not None:
+                    first = max(self._done, last - self._max_errors) + 1
+                    self._errors.update({t: error for t in range(first, last + 1)})
+                for t in [t for t in self._errors if t <= last - self._max_errors]:
+                    del self._errors[t]
+                self._done = last
+                self._cond.notify_all()
+
+    def wait(self, ticket=None, timeout=None):
+        """
+        Waits until the batch `ticket` (every batch submitted so far by
+        default) was applied. Returns whether it was, and the error raised
+        while applying it, if any.
+        """
+        with self._cond:
+            ticket = self._submitted if ticket is None else ticket
+            done = self._cond.wait_for(lambda: self._done >= ticket, timeout=timeout)
+            return done, self._errors.pop(ticket, None)
@@ -4,10 +4,12 @@ from loguru import logger
 from skimage.segmentation import slic
 from survos2.api import workspace as ws
 from survos2.api.utils import dataset_repr, save_metadata, get_function_api
+from survos2.api.utils import array_response, encoded_slice
 from survos2.data_io import dataset_from_uri
 from survos2.improc import map_blocks
 from survos2.improc.utils import DatasetManager
 from survos2.model import DataModel
+from survos2.model.pyramid import get_level_slice, level_region, roi_slices
 from survos2.utils import encode_numpy
 from fastapi import APIRouter
 from pathlib import Path
@@ -23,27 +25,26 @@ superregions = APIRouter()
 
 
 @superregions.get("/get_volume")
-def get_volume(src: str):
+def get_volume(src: str, level: int = 0):
     logger.debug("Getting region volume")
     ds = dataset_from_uri(src, mode="r")
-    data = ds[:]
-    return encode_numpy(data)
+    return array_response(*level_region(ds, level, [slice(None)] * ds.ndim))
 
 
 @superregions.get("/get_slice")
-def get_slice(src: str, slice_idx: int, order: tuple):
-    ds = dataset_from_uri(src, mode="r")[:]
-    ds = np.transpose(ds, order)
-    data = ds[slice_idx]
+def get_slice(src: str, slice_idx: int, order: tuple, level: int = 0, codec: str = None):
+    ds = dataset_from_uri(src, mode="r")
+    if codec is not None:
+        return encoded_slice(ds, slice_idx, order, level, codec=codec)
+    data = get_level_slice(ds, slice_idx, order, level)
     return encode_numpy(data)
 
 
 @superregions.get("/get_crop")
-def get_crop(src: str, roi: list):
+def get_crop(src: str, roi: list, level: int = 0):
     logger.debug("Getting regions crop")
     ds = dataset_from_uri(src, mode="r")
-    data = ds[roi[0] : roi[1], roi[2] : roi[3], roi[4] : roi[5]]
-    return encode_numpy(data)
+    return array_response(*level_region(ds, level, roi_slices(roi, level)))
 
 
 @superregions.get("/supervoxels")
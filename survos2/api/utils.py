@@ -2,9 +2,22 @@ import hug
 import inspect
 import logging as log
 import os.path as op
-from functools import wraps
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import partial, wraps
+
+import numpy as np
+from fastapi.responses import StreamingResponse
+
 from survos2.data_io import dataset_from_uri
 from survos2.config import Config
+from survos2.improc.utils import incremental as incremental_blocks
+from survos2.model import Dataset
+from survos2.model.cache import FeatureCache, normalize_params
+from survos2.model.pyramid import get_level_slice, level_factor, level_version, schedule_pyramid
+from survos2.model.region_index import schedule_region_index
+from survos2.utils import encode_numpy, encode_numpy_slice
 
 from loguru import logger
 
@@ -13,12 +26,19 @@ CHUNK_SIZE = Config["computing.chunk_size"]
 CHUNK_PAD = Config["computing.chunk_padding"]
 SCALE = Config["computing.scale"]
 STRETCH = Config["computing.stretch"]
+PYRAMID_LEVELS = Config["computing.pyramid_levels"]
+PYRAMID_GROUPS = Config["computing.pyramid_groups"]
+REGION_INDEX_GROUPS = ["superregions"]
+STREAM_THRESHOLD = Config["api.stream_threshold"]
+SLICE_CACHE_SIZE = Config["api.slice_cache"]
 
 
 def dataset_repr(ds):
     metadata = dict()
     metadata.update(ds.metadata())
     metadata.pop("__data__", None)
+    metadata.pop("source_versions", None)
+    metadata.pop("chunk_versions", None)
     metadata.setdefault("id", ds.id)
     metadata.setdefault("name", op.basename(ds._path))
     metadata.setdefault("kind", "unknown")
@@ -47,11 +67,21 @@ def get_default_args(func):
     }
 
 
-def save_metadata(func):
+def save_metadata(func=None, incremental=False):
     """
     Decorator to save the arguments of a function call as
     metadata in the resulting dataset.
+
+    With `incremental=True` (`@save_metadata(incremental=True)`), the versions
+    of the chunks of the source are saved as well, so that calling the
+    function again with the same parameters does nothing if the source did
+    not change, and only recomputes the blocks of the result depending on
+    the changed source chunks otherwise (see `dirty_regions`). Only for
+    functions whose result depends on `src` and the parameters alone, not
+    on other datasets given in the parameters.
     """
+    if func is None:
+        return partial(save_metadata, incremental=incremental)
     fname = func.__name__
 
     @wraps(func)
@@ -61,31 +91,257 @@ def save_metadata(func):
 
         pprint(args)
         pprint(kwargs)
-        result = func(src, dst, *args, **kwargs)
-        ds = dataset_from_uri(dst, mode="r+")
-        if ds.supports_metadata():
-            for param in ["kind", "name"]:
-                if not ds.has_attr(param):
-                    print(f"Setting param {param} {fname}")
-                    ds.set_attr(param, fname)
-            for k, v in kwargs.items():
-                print(f"Setting key value {k}, {v}")
-                ds.set_attr(k, v)
-            if type(src) == list:
-                src_id = [dataset_from_uri(s, mode="r").id for s in src]
-            else:
-                src_id = dataset_from_uri(src, mode="r").id
-            ds.set_attr("source", src_id)
+        if not incremental:
+            func(src, dst, *args, **kwargs)
+            return record_metadata(fname, src, dst, kwargs)
+        versions = source_versions(src)
+        dirty = dirty_regions(fname, src, dst, kwargs, versions)
+        if dirty is not None and len(dirty) == 0:
+            logger.info("+ Up to date: {}".format(fname))
+            ds = dataset_from_uri(dst, mode="r")
+            result = dataset_repr(ds)
+            ds.close()
+            return result
+        with incremental_blocks(src, dst, dirty) if dirty is not None else nullcontext():
+            func(src, dst, *args, **kwargs)
+        return record_metadata(fname, src, dst, kwargs, versions)
+
+    return wrapper
+
+
+def source_versions(src):
+    """Versions of the chunks of the dataset `src`, `None` if not available."""
+    if type(src) == list:
+        return None
+    ds = dataset_from_uri(src, mode="r")
+    if not isinstance(ds, Dataset):
+        return None
+    ds.close()  # closing open writable handles updates the chunk files
+    return ds.chunk_versions()
+
+
+def dirty_regions(fname, src, dst, params, versions):
+    """
+    Regions (tuples of slices) of the source `src` that changed since `dst`
+    was computed from it by `fname` with the same `params`, given the
+    current `versions` of the chunks of `src`. Returns an empty list if
+    `dst` is up to date, or `None` if `dst` has to be computed as a whole.
+    """
+    if versions is None:
+        return None
+    ds = dataset_from_uri(dst, mode="r")
+    if not isinstance(ds, Dataset) or ds.get_metadata("function") != fname:
+        return None
+    recorded = ds.get_metadata("source_versions")
+    if recorded is None or len(recorded) != len(versions):
+        return None
+    source = dataset_from_uri(src, mode="r")
+    if ds.get_metadata("source") != source.id:
+        return None
+    if normalize_params(params) != normalize_params({k: ds.get_metadata(k) for k in params}):
+        return None
+    ds.close()
+    if ds.get_metadata("chunk_versions") != ds.chunk_versions():
+        return None  # modified since it was computed
+    return [
+        source.global_chunk_bounds(source.unravel_chunk_index(i))
+        for i, (old, new) in enumerate(zip(recorded, versions))
+        if old != new
+    ]
+
+
+def record_metadata(fname, src, dst, params, versions=None):
+    """
+    Saves the name of the function `fname` that computed `dst` from `src`,
+    and its `params`, as metadata of `dst`. See `save_metadata`.
+    """
+    ds = dataset_from_uri(dst, mode="r+")
+    if ds.supports_metadata():
+        for param in ["kind", "name"]:
+            if not ds.has_attr(param):
+                print(f"Setting param {param} {fname}")
+                ds.set_attr(param, fname)
+        for k, v in params.items():
+            print(f"Setting key value {k}, {v}")
+            ds.set_attr(k, v)
+        if type(src) == list:
+            src_id = [dataset_from_uri(s, mode="r").id for s in src]
         else:
-            logger.debug("Dataset doesn't support metadata.")
-        result = dataset_repr(ds)
+            src_id = dataset_from_uri(src, mode="r").id
+        ds.set_attr("source", src_id)
+        if isinstance(ds, Dataset) and versions is not None:
+            ds.close()
+            ds.set_attr("function", fname)
+            ds.set_attr("source_versions", versions)
+            ds.set_attr("chunk_versions", ds.chunk_versions())
+    else:
+        logger.debug("Dataset doesn't support metadata.")
+    result = dataset_repr(ds)
+    ds.close()
+    if isinstance(ds, Dataset) and PYRAMID_LEVELS > 0:
+        if op.basename(op.dirname(ds._path)) in PYRAMID_GROUPS:
+            schedule_pyramid(ds._path)
+    if isinstance(ds, Dataset) and op.basename(op.dirname(ds._path)) in REGION_INDEX_GROUPS:
+        schedule_region_index(ds._path)
+    logger.info("+ Computed: {}".format(fname))
+    return result
+
+
+def cache_result(func):
+    """
+    Decorator to reuse the result of a previous call with the same sources
+    (and content), parameters and code from the workspace `FeatureCache`.
+    On a cache hit the cached result is linked into `dst` and `func` is not
+    called. Only for functions whose result depends on `src` and the
+    parameters alone.
+    """
+
+    @wraps(func)
+    def wrapper(src, dst, *args, **kwargs):
+        ds = dataset_from_uri(dst, mode="r")
+        cache = FeatureCache.for_dataset(ds._path) if isinstance(ds, Dataset) else None
         ds.close()
-        logger.info("+ Computed: {}".format(fname))
+        key = None
+        if cache is not None:
+            srcs = [dataset_from_uri(s, mode="r") for s in (src if type(src) == list else [src])]
+            key = cache.key(func, srcs, dict(kwargs, args=list(args)))
+            if key is not None and cache.restore(key, ds._path):
+                logger.info("+ Reused cached result of {}".format(func.__name__))
+                return None
+        result = func(src, dst, *args, **kwargs)
+        if key is not None:
+            try:
+                cache.store(key, ds._path, function=func.__name__, source=[s.id for s in srcs], params=kwargs)
+            except Exception as e:
+                logger.warning("Unable to cache the result of {}: {}".format(func.__name__, e))
         return result
 
     return wrapper
 
 
+###############################################################################
+# Array transport
+
+
+def _region_shape(source, slices):
+    if slices is None:
+        return tuple(source.shape)
+    slices = tuple(slices) + (slice(None),) * (len(source.shape) - len(slices))
+    return tuple(len(range(*s.indices(n))) for s, n in zip(slices, source.shape))
+
+
+def iter_array_bytes(source, slices=None, block_size=None):
+    """
+    Yields the raw bytes (C order) of the region `slices` of `source` (a
+    `Dataset` or a numpy array, the whole array if `slices` is `None`), a
+    slab of `block_size` planes along the first axis at a time. Datasets
+    are read a row of chunks at a time.
+    """
+    shape = _region_shape(source, slices)
+    if slices is None:
+        slices = tuple(slice(0, n) for n in shape)
+    else:
+        slices = tuple(slices) + (slice(None),) * (len(shape) - len(slices))
+        slices = tuple(slice(*s.indices(n)[:2]) for s, n in zip(slices, source.shape))
+    if block_size is None:
+        block_size = source.chunk_size[0] if hasattr(source, "chunk_size") else 16
+    start, stop = slices[0].start, slices[0].stop
+    for i in range(start, stop, block_size):
+        block = source[(slice(i, min(i + block_size, stop)),) + slices[1:]]
+        yield np.ascontiguousarray(block).tobytes()
+
+
+def array_response(source, slices=None):
+    """
+    Response for the region `slices` of `source` (a `Dataset` or a numpy
+    array). Small regions (up to `api.stream_threshold` MB) are returned as
+    JSON with `encode_numpy`, larger ones are streamed as raw bytes
+    (`application/octet-stream`), with their dtype and shape in the
+    `X-Array-Dtype` and `X-Array-Shape` headers.
+    """
+    shape = _region_shape(source, slices)
+    dtype = np.dtype(source.dtype).name
+    if np.prod(shape) * np.dtype(dtype).itemsize <= STREAM_THRESHOLD * 2**20:
+        return encode_numpy(source[:] if slices is None else source[tuple(slices)])
+    headers = {"X-Array-Dtype": dtype, "X-Array-Shape": ",".join(map(str, shape))}
+    return StreamingResponse(
+        iter_array_bytes(source, slices), media_type="application/octet-stream", headers=headers
+    )
+
+
+class SliceCache(object):
+    """
+    LRU cache of encoded slices, bounded by the total size (in MB) of the
+    encoded data.
+    """
+
+    def __init__(self, max_size=SLICE_CACHE_SIZE):
+        self._max_bytes = max_size * 2**20
+        self._nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        nbytes = len(value["data"])
+        if nbytes > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= len(self._items.pop(key)["data"])
+            self._items[key] = value
+            self._nbytes += nbytes
+            while self._nbytes > self._max_bytes:
+                _, old = self._items.popitem(last=False)
+                self._nbytes -= len(old["data"])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+
+__slice_cache__ = SliceCache()
+
+
+def encoded_slice(ds, slice_idx, order=(0, 1, 2), level=0, codec="jpeg", dtype=None):
+    """
+    Returns the slice `slice_idx` along axis `order[0]` of the pyramid `level`
+    of `ds` (see `get_level_slice`), cast to `dtype` and encoded with the first
+    available of the comma separated `codec`s (see `encode_numpy_slice`).
+    Encoded slices of `Dataset`s are cached until any of the chunks they are
+    read from is modified or the pyramid is rebuilt.
+    """
+    key = None
+    if isinstance(ds, Dataset):
+        axis = int(order[0])
+        factor = level_factor(level)
+        start = slice_idx // factor * factor
+        region = [slice(None)] * ds.ndim
+        region[axis] = slice(start, min(start + factor, ds.shape[axis]))
+        version = (ds.region_version(region), level_version(ds, level))
+        key = (op.realpath(ds._path), tuple(order), slice_idx // factor, level, codec, dtype, version)
+        result = __slice_cache__.get(key)
+        if result is not None:
+            return result
+    data = get_level_slice(ds, slice_idx, order, level)
+    if dtype is not None:
+        data = data.astype(dtype)
+    result = encode_numpy_slice(data, codec=codec)
+    if key is not None:
+        __slice_cache__.put(key, result)
+    return result
+
+
 ###############################################################################
 # Session Handling
 
@@ -10,8 +10,11 @@ from survos2.api.utils import APIException
 from survos2.config import Config
 from survos2.data_io import dataset_from_uri
 from survos2.frontend.main import roi_ws
+from survos2.improc.scheduler import get_scheduler
 from survos2.improc.utils import DatasetManager
-from survos2.model import DataModel, Dataset, Workspace
+from survos2.model import DataModel, Dataset, DatasetException, Workspace
+from survos2.model.access import suggest_layout
+from survos2.model.rechunk import rechunk_status, schedule_rechunk
 
 workspace = APIRouter()
 
@@ -168,12 +171,18 @@ def add_dataset(
     fillvalue: int = 0,
     group: str = None,
     chunks: Union[int, None] = None,
+    compression: Union[str, None] = None,
 ):
     workspace, session = parse_workspace(workspace)
     if group:
         dataset_name = "{}/{}".format(group, dataset_name)
     return get(workspace).add_dataset(
-        dataset_name, dtype, session=session, fillvalue=fillvalue, chunks=chunks
+        dataset_name,
+        dtype,
+        session=session,
+        fillvalue=fillvalue,
+        chunks=chunks,
+        compression=compression,
     )
 
 
@@ -224,6 +233,62 @@ def metadata(workspace: str = Body(), dataset: str = Body()):
     return ds.get_metadata()
 
 
+@workspace.get("/compute_tasks")
+def compute_tasks():
+    """Queued, running and recently finished computations of the server, with their progress."""
+    scheduler = get_scheduler()
+    return dict(
+        scheduler=scheduler.scheduler,
+        memory_budget=scheduler.memory_budget,
+        memory_used=scheduler.memory_used,
+        tasks=scheduler.tasks(),
+    )
+
+
+### Chunk layout
+
+
+def _layout_dataset(workspace: str, dataset: str):
+    workspace, session = parse_workspace(workspace)
+    if dataset == Workspace.__dsname__:
+        return get(workspace).get_data()
+    return get(workspace).get_dataset(dataset, session=session)
+
+
+@workspace.get("/rechunk")
+def rechunk(
+    workspace: str,
+    dataset: str,
+    chunks: List[int] = Query(None),
+    chunk_size: float = None,
+    pattern: str = None,
+):
+    """
+    Rewrites `dataset` (or the workspace data, `__data__`) in the background
+    with chunks of shape `chunks`, or of up to `chunk_size` MB planned for
+    the access `pattern` (see `optimal_chunksize`). Readers keep working
+    during the migration, see `survos2.model.rechunk`.
+    """
+    ds = _layout_dataset(workspace, dataset)
+    target = chunks or chunk_size or Config["computing.chunk_size"]
+    try:
+        return schedule_rechunk(ds._path, target, pattern=pattern)
+    except DatasetException as e:
+        raise APIException(str(e))
+
+
+@workspace.get("/rechunk_status")
+def get_rechunk_status(workspace: str, dataset: str):
+    return rechunk_status(_layout_dataset(workspace, dataset)._path)
+
+
+@workspace.get("/suggest_layout")
+def get_suggested_layout(workspace: str, dataset: str, chunk_size: float = None):
+    """Chunk layout suggested by the recorded reads of `dataset`, see `suggest_layout`."""
+    ds = _layout_dataset(workspace, dataset)
+    return suggest_layout(ds, max_size=chunk_size or Config["computing.chunk_size"])
+
+
 def auto_create_dataset(
     workspace: str,
     name: str,
@@ -231,6 +296,7 @@ def auto_create_dataset(
     dtype: str,
     fill: int = 0,
     chunks: Union[int, None] = None,
+    compression: Union[str, None] = None,
 ):
     all_ds = existing_datasets(workspace, group)
     max_idx = 0
@@ -242,7 +308,9 @@ def auto_create_dataset(
     dataset_id = pattern.format(max_idx + 1, name)
     dataset_name = dataset_id.replace("_", " ").title()
     dataset_file = "{}/{}".format(group, dataset_id)
-    ds = add_dataset(workspace, dataset_file, dtype, fillvalue=fill, chunks=chunks)
+    ds = add_dataset(
+        workspace, dataset_file, dtype, fillvalue=fill, chunks=chunks, compression=compression
+    )
     ds.set_attr("name", dataset_name)
     return ds
 
@@ -11,12 +11,38 @@ class _Config(type):
             "port": 8000,
             "plugins": [],
             "renderer": "mpl",
+            "stream_threshold": 1,  # MB, larger arrays are streamed as raw bytes
+            "slice_codecs": "lz4,raw",  # preferred slice encodings, see encode_numpy_slice
+            "slice_cache": 256,  # MB of encoded slices cached by the server
+            "parent_mask_cache": 64,  # MB of parent label masks cached by the server, see ParentMask
         },
         "computing": {
+            "annotation_history": "bits",  # undo of annotations: bits (in every voxel) or journal (sparse)
+            "annotation_journal_depth": 32,  # annotations that can be undone in journal mode
             "chunks": True,
             "chunk_size": 32,
             "chunk_padding": 8,
             "chunk_size_sparse": 10,
+            "chunk_handles": 64,
+            "io_workers": 4,
+            "scheduler": "threads",  # executor of map_blocks: threads, processes or distributed
+            "workers": 0,  # workers of the executor, 0 for one per CPU
+            "memory_budget": 0,  # MB shared by concurrent computations, 0 for half the RAM, < 0 unbounded
+            "sparse_chunks": False,  # skip the chunks of fill values, opt-in for existing installs
+            "pyramid_levels": 3,
+            "pyramid_groups": ["features", "superregions", "pipelines"],
+            "rechunk_memory": 256,  # MB of the blocks copied at once when rechunking a dataset
+            "compression": "none",
+            "compression_shuffle": True,
+            # compression of the new datasets of a group, e.g. "gzip:4" for label groups
+            "group_compression": {
+                "annotations": "none",
+                "superregions": "none",
+                "pipelines": "none",
+                "features": "none",
+            },
+            "stream_store": True,
+            "feature_cache": 2048,  # MB of computed features kept per workspace, 0 to disable
             "scale": False,
             "stretch": False,
             "device": 0,
@@ -24,6 +50,9 @@ class _Config(type):
         "model": {
             "chroot": "/",  # default location to store data
             "dbtype": "yaml",
+            "backend": "hdf5",  # chunk storage engine of new workspaces: hdf5, zarr or npy
+            # engine of the uncompressed datasets of a group, instead of the workspace one
+            "group_backend": {"features": "npy"},
         },
         "logging": {
             "overall_level": "INFO",
@@ -106,6 +106,15 @@ class Launcher(QtCore.QObject):
             files={"file": data_as_bytes},
         )
 
+    def post_bytes(self, data, group, command, **kwargs):
+        logger.debug(f"Posting {len(data)} bytes to {group}/{command}")
+        response = requests.post(
+            "http://" + self.remote_ip_port + "/" + group + "/" + command,
+            files={"file": data},
+        )
+        response.raise_for_status()
+        return response.json()
+
     def post_file(self, fullname, group, **kwargs):
         with open(fullname, "rb") as file_handle:
             response = requests.post(
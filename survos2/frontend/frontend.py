@@ -59,6 +59,7 @@ def frontend(viewer):
     cfg.current_supervoxels = None
     cfg.supervoxels_cache = None
     cfg.supervoxels_cached = False
+    cfg.supervoxels_index = None
     cfg.supervoxel_size = 10
     cfg.brush_size = 10
     cfg.viewer_order=(0, 1, 2)
@@ -152,6 +153,14 @@ def frontend(viewer):
         if existing_layer:
             existing_layer[0].data = src_arr.astype(np.int32) & 15
 
+    def refresh_painted_level(msg):
+        if cfg.remote_annotation:
+            src_arr, _ = get_level_from_server(msg, retrieval_mode=cfg.retrieval_mode)
+        else:
+            src_arr = cfg.anno_data
+            logger.debug(f"replaced src array with array of shape {src_arr.shape}")
+        update_annotation_layer_in_viewer(msg["level_id"], src_arr)
+
     def refresh_annotations_in_viewer(msg):
         print(f"refresh_annotation {msg['level_id']}")
 
@@ -279,19 +288,16 @@ def frontend(viewer):
                             if len(anno_layer) > 0:
                                 anno_layer = anno_layer[0]
 
-                                def update_anno(msg):
-                                    if cfg.remote_annotation:
-                                        src_arr, _ = get_level_from_server(
-                                            msg, retrieval_mode=cfg.retrieval_mode
-                                        )
-                                    else:
-                                        src_arr = cfg.anno_data
-                                        logger.debug(
-                                            f"replaced src array with array of shape {src_arr.shape}"
-                                        )
-                                    update_annotation_layer_in_viewer(msg["level_id"], src_arr)
+                                def update_anno(queued, msg):
+                                    # queued strokes are refreshed once applied, see `strokes_applied`
+                                    if not queued:
+                                        refresh_painted_level(msg)
 
                                 update = partial(update_anno, msg=msg)
+                                applied = partial(
+                                    cfg.ppw.clientEvent.emit,
+                                    dict(msg, source="annotations", data="strokes_applied"),
+                                )
                                 viewer_order = viewer.window.qt_viewer.viewer.dims.order
                                 cfg.viewer_order = viewer_order
                                 paint_strokes_worker = paint_strokes(
@@ -301,6 +307,7 @@ def frontend(viewer):
                                     cfg.parent_level,
                                     cfg.parent_label_idx,
                                     viewer_order,
+                                    on_applied=applied,
                                 )
                                 paint_strokes_worker.returned.connect(update)
                                 paint_strokes_worker.start()
@@ -444,6 +451,8 @@ def frontend(viewer):
             paint_annotations(msg)
         elif msg["data"] == "update_annotations":
             update_annotations(msg)
+        elif msg["data"] == "strokes_applied":
+            refresh_painted_level(msg)
         elif msg["data"] == "remove_layer":
             layer_name = msg["layer_name"]
             remove_layer(viewer, layer_name)
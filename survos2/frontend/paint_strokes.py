@@ -1,3 +1,5 @@
+import threading
+
 import numpy as np
 from loguru import logger
 from napari.qt.threading import thread_worker
@@ -6,16 +8,93 @@ from skimage.draw import line
 from survos2.frontend.control.launcher import Launcher
 from survos2.improc.utils import DatasetManager
 from survos2.model import DataModel
+from survos2.model.dataset import read_array
+from survos2.model.region_index import load_region_index
 from survos2.server.state import cfg
 from survos2.frontend.plugins.annotations import dilate_annotations
 from survos2.utils import decode_numpy
 from survos2.api.annotate import get_order
+from survos2.api.strokes import encode_strokes, stroke_from_points
 
 _MaskSize = 4  # 4 bits per history label
 _MaskCopy = 15  # 0000 1111
 _MaskPrev = 240  # 1111 0000
 
 
+class StrokeSender(object):
+    """
+    Sends the strokes painted in the viewer to the annotation queue of the
+    server (see `survos2.api.strokes`) from a background thread. Strokes
+    painted while a batch is in flight are sent together in the next batch,
+    so painting does not wait for a round trip per stroke, nor for the
+    strokes to be applied: the view is refreshed from a callback instead.
+    """
+
+    def __init__(self, max_waits=30):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._max_waits = max_waits
+
+    def put(self, stroke, on_applied=None, **params):
+        """
+        Queues `stroke` without waiting, returns an event set once the server
+        has applied it, after calling `on_applied` (from the sender thread).
+        """
+        done = threading.Event()
+        with self._cond:
+            self._pending.append((params, stroke, (done, on_applied)))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="survos_stroke_sender", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return done
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            params = self._pending[0][0]
+            n = 1
+            while n < len(self._pending) and self._pending[n][0] == params:
+                n += 1
+            batch = self._pending[:n]
+            del self._pending[:n]
+        return params, batch
+
+    def _run(self):
+        while True:
+            params, batch = self._next_batch()
+            try:
+                data = encode_strokes([stroke for _, stroke, _ in batch], **params)
+                ticket = Launcher.g.post_bytes(data, "annotations", "queue_strokes")["ticket"]
+                for _ in range(self._max_waits):
+                    result = Launcher.g.run(
+                        "annotations",
+                        "wait_strokes",
+                        workspace=params["workspace"],
+                        level=params["level"],
+                        ticket=ticket,
+                    )
+                    if not result or result["done"]:
+                        break
+                if result and result["error"]:
+                    logger.warning(f"Unable to annotate {len(batch)} strokes: {result['error']}")
+            except Exception as e:
+                logger.warning(f"Unable to send {len(batch)} strokes: {e}")
+            finally:
+                for _, _, (done, on_applied) in batch:
+                    if on_applied is not None:
+                        try:
+                            on_applied()
+                        except Exception as e:
+                            logger.warning(f"Unable to refresh the painted strokes: {e}")
+                    done.set()
+
+
+__stroke_sender__ = StrokeSender()
+
+
 def get_line_points(drag_pts, anno_layer_shape, viewer_order):
     line_x, line_y = [], []
 
@@ -47,6 +126,7 @@ def annotate_voxels(
     parent_level,
     parent_label_idx,
     viewer_order,
+    on_applied=None,
 ):
     ########################################################################
     line_y, line_x = dilate_annotations(
@@ -55,25 +135,17 @@ def annotate_voxels(
         anno_shape,
         brush_size,
     )
-    params = dict(workspace=True, level=level, label=sel_label)
-    yy, xx = list(line_y), list(line_x)
-    yy = [int(e) for e in yy]
-    xx = [int(e) for e in xx]
-
-    # todo: preserve existing
-    params.update(
-        slice_idx=int(z),
-        yy=yy,
-        xx=xx,
+    # queued with the strokes painted meanwhile, `on_applied` once the server has applied it
+    __stroke_sender__.put(
+        stroke_from_points(int(z), line_y, line_x, sel_label),
+        on_applied=on_applied,
+        workspace=DataModel.g.current_workspace,
+        level=level,
         parent_level=parent_level,
         parent_label_idx=parent_label_idx,
-        full=False,
-        viewer_order=viewer_order,
-        workspace=DataModel.g.current_workspace,
+        viewer_order=[int(i) for i in viewer_order],
     )
 
-    result = Launcher.g.run("annotations", "annotate_voxels", json_transport=True, **params)
-
 
 def annotate_regions(
     line_x,
@@ -120,7 +192,8 @@ def annotate_regions(
             fillvalue=0,
         ) as DM:
             src_dataset = DM.sources[0]
-            sv_arr = src_dataset[:]
+            sv_arr = read_array(src_dataset)
+            cfg.supervoxels_index = load_region_index(src_dataset)
 
         cfg.supervoxels_cache = sv_arr
         cfg.supervoxels_cached = True
@@ -170,6 +243,7 @@ def annotate_regions(
             parent_label_idx=parent_label_idx,
             bb=bb,
             viewer_order=viewer_order,
+            index=cfg.supervoxels_index,
         )
 
 
@@ -181,9 +255,12 @@ def paint_strokes(
     parent_level=None,
     parent_label_idx=None,
     viewer_order=(0, 1, 2),
+    on_applied=None,
 ):
     """
-    Gather all information required from viewer and call annotation function
+    Gather all information required from viewer and call annotation function.
+    Returns whether the strokes were queued, in which case `on_applied` is
+    called once the server has applied them, instead of when returning.
     """
     level = msg["level_id"]
     anno_layer_shape = anno_layer.data.shape
@@ -224,7 +301,9 @@ def paint_strokes(
                     parent_level,
                     parent_label_idx,
                     viewer_order,
+                    on_applied=on_applied,
                 )
+                return True
             else:
                 annotate_regions(
                     line_x,
@@ -251,6 +330,7 @@ def _annotate_regions_local(
     parent_label_idx: int,
     bb: list,
     viewer_order=(0, 1, 2),
+    index=None,
 ):
     from survos2.frontend.frontend import get_level_from_server
 
@@ -293,12 +373,17 @@ def _annotate_regions_local(
             # print("No mask")
             bb = [0, 0, 0, ds_t.shape[0], ds_t.shape[1], ds_t.shape[2]]
 
-        # else:
-        # print(f"Masking using bb: {bb}")
-        for r_idx in r:
-            mask[bb[0] : bb[3], bb[1] : bb[4], bb[2] : bb[5]] += (
-                reg[bb[0] : bb[3], bb[1] : bb[4], bb[2] : bb[5]] == r_idx
-            )
+        if index is not None:
+            # voxels of the regions from the region index, in viewer order
+            coords = index.coords(r)[:, list(viewer_order)]
+            coords = coords[((coords >= bb[:3]) & (coords < bb[3:])).all(axis=1)]
+            mask[tuple(coords.T)] = 1
+        else:
+            # print(f"Masking using bb: {bb}")
+            for r_idx in r:
+                mask[bb[0] : bb[3], bb[1] : bb[4], bb[2] : bb[5]] += (
+                    reg[bb[0] : bb[3], bb[1] : bb[4], bb[2] : bb[5]] == r_idx
+                )
     except Exception as e:
         logger.debug(f"__annotate_regions_local exception {e}")
 
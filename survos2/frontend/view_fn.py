@@ -1,6 +1,7 @@
 from survos2.entity.entities import make_entity_df
 from loguru import logger
 import numpy as np
+from survos2.config import Config
 from survos2.improc.utils import DatasetManager
 from survos2.model import DataModel, Workspace
 from survos2.frontend.control.launcher import Launcher
@@ -60,6 +61,7 @@ def view_feature(viewer, msg, new_name=None):
             src=features_src,
             slice_idx=cfg.current_slice,
             order=cfg.order,
+            codec=Config["api.slice_codecs"],
         )
 
         result = Launcher.g.run("features", "get_slice", **params)
@@ -0,0 +1,366 @@
+"""
+Server-wide scheduler of the dask computations of `map_blocks`.
+
+Every computation is admitted against a global memory budget
+(`computing.memory_budget`, MB) with an estimate of its peak memory (see
+`ComputeScheduler.estimate`). Computations that do not fit wait in a FIFO
+queue until enough memory is released, instead of running out of memory
+when several requests are served at once. A computation larger than the whole
+budget is run alone.
+
+The dask graphs are executed by the executor selected with
+`computing.scheduler`:
+
+- `threads`: a thread pool shared by all the requests (default).
+- `processes`: a process pool shared by all the requests. Datasets are sent
+  to the workers by path (see `survos2.model.Dataset.__getstate__`).
+- `distributed`: a local `dask.distributed` cluster, which requires the
+  optional `distributed` package.
+
+with `computing.workers` workers (`0` for one per CPU). The progress of every
+admitted computation is tracked task by task (except with `distributed`,
+where only its state is) and listed by `ComputeScheduler.tasks`.
+
+"""
+
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import dask
+import dask.local
+import dask.multiprocessing
+import dask.threaded
+import numpy as np
+from dask.callbacks import Callback
+from loguru import logger
+
+from ..config import Config
+
+SCHEDULER = Config["computing.scheduler"]
+WORKERS = Config["computing.workers"]
+MEMORY_BUDGET = Config["computing.memory_budget"]
+
+SCHEDULERS = ("threads", "processes", "distributed")
+# intermediate arrays allocated by the mapped functions, in padded blocks
+BLOCK_OVERHEAD = 4
+THREAD_PREFIX = "survos_compute"
+
+
+def physical_memory():
+    """Size of the physical memory in bytes, or `None` if unknown."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _initialize_worker():
+    """
+    Initializer of the worker processes: chunk files are closed after every
+    access and opened without HDF5 file locks, so that the server process
+    and the workers can open the same chunks one after the other.
+    """
+    os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
+    from ..model.dataset import set_chunk_handles
+
+    set_chunk_handles(0)
+
+
+def _import_distributed():
+    try:
+        import distributed
+    except ImportError:
+        raise ValueError("The `distributed` scheduler requires the `distributed` package.")
+    return distributed
+
+
+class ComputeTask(object):
+    """A computation admitted (or waiting to be) by a `ComputeScheduler`."""
+
+    __ids__ = itertools.count(1)
+
+    def __init__(self, name, nbytes):
+        self.id = next(self.__ids__)
+        self.name = name
+        self.nbytes = int(nbytes)
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.ntasks = self.ndone = 0
+
+    @property
+    def progress(self):
+        if self.state == "done":
+            return 1.0
+        return self.ndone / self.ntasks if self.ntasks > 0 else 0.0
+
+    def describe(self):
+        return dict(
+            id=self.id,
+            name=self.name,
+            state=self.state,
+            memory=self.nbytes / 2 ** 20,
+            progress=self.progress,
+            tasks=self.ntasks,
+            tasks_done=self.ndone,
+            submitted=self.submitted,
+            started=self.started,
+            finished=self.finished,
+        )
+
+
+class _Progress(Callback):
+    """Counts the dask tasks of a computation into a `ComputeTask`."""
+
+    def __init__(self, task):
+        super().__init__()
+        self._task = task
+
+    def _start_state(self, dsk, state):
+        self._task.ntasks += sum(len(state[k]) for k in ("ready", "waiting", "running"))
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        self._task.ndone += 1
+
+
+class ComputeScheduler(object):
+    """
+    Admission control and execution of dask computations within a global
+    memory budget, see the module documentation.
+
+    Parameters
+    ----------
+    scheduler: string
+        One of `'threads'`, `'processes'` or `'distributed'`.
+        Default: `computing.scheduler` in the config file.
+    workers: int
+        Number of workers of the executor, `0` for one per CPU.
+        Default: `computing.workers` in the config file.
+    memory_budget: number
+        Memory budget in MB, `0` for half of the physical memory and a
+        negative value to disable admission control.
+        Default: `computing.memory_budget` in the config file.
+    history: int
+        Number of finished computations kept in `tasks`.
+    """
+
+    def __init__(self, scheduler=SCHEDULER, workers=WORKERS, memory_budget=MEMORY_BUDGET, history=32):
+        if scheduler not in SCHEDULERS:
+            raise ValueError("Unknown scheduler: {}, expected one of {}".format(scheduler, SCHEDULERS))
+        self._scheduler = scheduler
+        self._workers = int(workers) if workers else os.cpu_count() or 1
+        if memory_budget == 0:
+            memory = physical_memory()
+            self._budget = memory // 2 if memory else None
+        else:
+            self._budget = int(memory_budget * 2 ** 20) if memory_budget > 0 else None
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._running = dict()
+        self._finished = deque(maxlen=history)
+        self._used = 0
+        self._local = threading.local()
+        self._pool = self._process_pool = self._client = None
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def memory_budget(self):
+        """Budget in bytes, or `None` if unbounded."""
+        return self._budget
+
+    @property
+    def memory_used(self):
+        return self._used
+
+    def estimate(self, arrays, pad=0, nout=1, itemsize=4, in_memory=False):
+        """
+        Estimated peak memory, in bytes, of mapping a function with `nout`
+        outputs of `itemsize` bytes across the blocks of `arrays` (dask
+        arrays, or arrays processed as a whole) padded by `pad`: the padded
+        blocks in flight, one per worker, times `BLOCK_OVERHEAD`, plus the
+        whole result if it is computed `in_memory`.
+        """
+        arrays = [a for a in arrays if hasattr(a, "shape")]
+        if len(arrays) == 0:
+            return 0
+        shape = arrays[0].shape
+        chunks = getattr(arrays[0], "chunks", None)
+        if not isinstance(chunks, tuple) or len(chunks) != len(shape) or not all(isinstance(c, tuple) for c in chunks):
+            chunks = tuple((n,) for n in shape)
+        pads = np.broadcast_to(pad or 0, (len(shape),))
+        block = [max(c) + 2 * int(p) for c, p in zip(chunks, pads)]
+        nblocks = int(np.prod([len(c) for c in chunks]))
+        itemsizes = sum(np.dtype(a.dtype).itemsize for a in arrays) + nout * itemsize
+        nbytes = min(self._workers, nblocks) * int(np.prod(block)) * itemsizes * BLOCK_OVERHEAD
+        if in_memory:
+            nbytes += int(np.prod(shape)) * nout * itemsize
+        return nbytes
+
+    def _fits(self, nbytes):
+        return self._budget is None or len(self._running) == 0 or self._used + nbytes <= self._budget
+
+    @contextmanager
+    def admit(self, name, nbytes):
+        """
+        Context manager that waits until the computation `name`, needing
+        `nbytes` of memory, fits in the budget and holds them while running.
+        The dask computations run within the context (in this thread) are
+        accounted to the returned `ComputeTask`. Nested admissions reuse the
+        enclosing one.
+        """
+        current = getattr(self._local, "task", None)
+        if current is not None:
+            yield current
+            return
+
+        task = ComputeTask(name, nbytes)
+        with self._cond:
+            self._queue.append(task)
+            if not (self._queue[0] is task and self._fits(task.nbytes)):
+                logger.info(
+                    "Queueing {} ({:.1f} MB), {:.1f} MB in use".format(
+                        name, task.nbytes / 2 ** 20, self._used / 2 ** 20
+                    )
+                )
+            while not (self._queue[0] is task and self._fits(task.nbytes)):
+                self._cond.wait()
+            self._queue.popleft()
+            self._used += task.nbytes
+            self._running[task.id] = task
+            task.state = "running"
+            task.started = time.time()
+            self._cond.notify_all()  # the next one may fit as well
+
+        self._local.task = task
+        try:
+            yield task
+            task.state = "done"
+        except BaseException:
+            task.state = "failed"
+            raise
+        finally:
+            self._local.task = None
+            task.finished = time.time()
+            with self._cond:
+                self._used -= task.nbytes
+                del self._running[task.id]
+                self._finished.append(task)
+                self._cond.notify_all()
+
+    @contextmanager
+    def threaded(self):
+        """
+        Within the context, computations run in the shared thread pool
+        whatever the scheduler, e.g. when several blocks write into the same
+        chunk of a dataset, which is only serialized within a process.
+        """
+        previous = getattr(self._local, "threaded", False)
+        self._local.threaded = True
+        try:
+            yield
+        finally:
+            self._local.threaded = previous
+
+    def tasks(self):
+        """Description of the queued, running and recently finished computations."""
+        with self._cond:
+            tasks = list(self._queue) + list(self._running.values()) + list(self._finished)
+        return [task.describe() for task in tasks]
+
+    def _thread_pool(self):
+        with self._cond:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self._workers, thread_name_prefix=THREAD_PREFIX)
+            return self._pool
+
+    def _processes(self):
+        with self._cond:
+            if self._process_pool is None:
+                from dask.multiprocessing import get_context, initialize_worker_process
+
+                self._process_pool = ProcessPoolExecutor(
+                    self._workers,
+                    mp_context=get_context(),
+                    initializer=partial(initialize_worker_process, user_initializer=_initialize_worker),
+                )
+            return self._process_pool
+
+    def _distributed(self):
+        with self._cond:
+            if self._client is None:
+                distributed = _import_distributed()
+                cluster = distributed.LocalCluster(
+                    n_workers=self._workers,
+                    threads_per_worker=1,
+                    memory_limit=self._budget // self._workers if self._budget else "auto",
+                )
+                self._client = distributed.Client(cluster, set_as_default=False)
+                logger.info("Started local dask cluster at {}".format(self._client.dashboard_link))
+            return self._client
+
+    def get(self, dsk, keys, **kwargs):
+        """Dask scheduler function running the graph `dsk` with the executor."""
+        task = getattr(self._local, "task", None)
+        callbacks = list(kwargs.pop("callbacks", None) or [])
+        if task is not None:
+            callbacks.append(_Progress(task)._callback)
+
+        if threading.current_thread().name.startswith(THREAD_PREFIX):
+            # nested computation within a task, the pool may be exhausted
+            return dask.local.get_sync(dsk, keys, callbacks=callbacks, **kwargs)
+        if self._scheduler == "threads" or getattr(self._local, "threaded", False):
+            return dask.threaded.get(dsk, keys, pool=self._thread_pool(), callbacks=callbacks, **kwargs)
+        elif self._scheduler == "processes":
+            return dask.multiprocessing.get(dsk, keys, pool=self._processes(), callbacks=callbacks, **kwargs)
+        return self._distributed().get(dsk, keys, **kwargs)
+
+    def close(self):
+        """Shuts the executors down."""
+        with self._cond:
+            pool, process_pool, client = self._pool, self._process_pool, self._client
+            self._pool = self._process_pool = self._client = None
+        if pool is not None:
+            pool.shutdown()
+        if process_pool is not None:
+            process_pool.shutdown()
+        if client is not None:
+            cluster = client.cluster
+            client.close()
+            cluster.close()
+
+
+__scheduler__ = None
+__scheduler_lock__ = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Returns the server-wide `ComputeScheduler`, which is created on first use
+    and set as the default dask scheduler of the process.
+    """
+    global __scheduler__
+    with __scheduler_lock__:
+        if __scheduler__ is None:
+            __scheduler__ = ComputeScheduler()
+            dask.config.set(scheduler=__scheduler__.get)
+            logger.debug(
+                "Compute scheduler: {} with {} workers and a budget of {} MB".format(
+                    __scheduler__.scheduler,
+                    __scheduler__.workers,
+                    "unbounded" if __scheduler__.memory_budget is None else __scheduler__.memory_budget // 2 ** 20,
+                )
+            )
+        return __scheduler__
@@ -1,6 +1,8 @@
+import threading
 import time
+import warnings
+from contextlib import ExitStack, contextmanager, nullcontext
 
-from math import ceil
 from itertools import product
 from functools import wraps, partial
 import yaml
@@ -8,6 +10,7 @@ import numpy as np
 import dask.array as da
 from dask.array.core import slices_from_chunks
 from ..config import Config
+from .scheduler import get_scheduler
 from ..utils import format_yaml, parse_params
 
 CHUNK = Config["computing.chunks"]
@@ -15,6 +18,9 @@ CHUNK_SIZE = Config["computing.chunk_size"]
 CHUNK_PAD = Config["computing.chunk_padding"]
 SCALE = Config["computing.scale"]
 STRETCH = Config["computing.stretch"]
+STREAM_STORE = Config["computing.stream_store"]
+# chunks planned for slice access are this much thinner along the first axis
+SLICE_ASPECT = 4
 
 from loguru import logger
 
@@ -62,10 +68,19 @@ def asnparray(data, dtype=None, contiguous=True):
         return np.asarray(data[...], dtype=dtype)
 
 
-def optimal_chunksize(source, max_size, item_size=4, delta=0.1, axis_weight=None):
+def optimal_chunksize(
+    source, max_size, item_size=4, delta=0.1, axis_weight=None, pattern=None, pad=0
+):
     """
     Obtain the optimal chunk size to split a large dataset in.
 
+    The chunk shape is planned in closed form rather than searched: the
+    largest chunk with the aspect ratio given by `axis_weight` (or `pattern`)
+    that fits in `max_size` (including the `pad` around it) is found by
+    bisection over a single scale factor, and is then rounded to a balanced
+    number of chunks per axis by trying the two closest counts of each axis.
+    This takes `O(log(max(shape)) + 2 ** ndim)` steps whatever the shape.
+
     Parameters
     ----------
     source : iterable of integers (list, tuple) or Numpy array-like
@@ -78,13 +93,19 @@ def optimal_chunksize(source, max_size, item_size=4, delta=0.1, axis_weight=None
         The size (in bytes) of the data type. Only used if `source` does not contain
         a `dtype` attribute.
     delta: float
-        The amount by which to decrease the total shape iteratively. Smaller amounts
-        would allow for better optimal chunk sizes at the expenses of slower
-        computations.
+        Unused, kept for backwards compatibility.
     axis_weight : None or array-like
         Controls the weight of each of the axes. If `None` the importance of the axes
-        will be calculated from `source`'s shape, otherwise an array-like is
-        expected with a float value for each dimension.
+        will be calculated from `pattern` or, if not given, from `source`'s shape,
+        otherwise an array-like is expected with a float value for each dimension.
+    pattern : None or string
+        The access pattern the chunks are planned for, if `axis_weight` is not
+        given: `'cubic'` for 3D filters (isotropic chunks, which minimize the
+        padding overhead) or `'slice'` for viewing (chunks `SLICE_ASPECT` times
+        thinner along the first axis, so that reading a slice reads less data).
+    pad : int or array-like
+        The padding added to each side of a chunk when processing it (e.g. by
+        `map_blocks`). The padded chunk is the one that fits in `max_size`.
 
     Returns
     -------
@@ -93,31 +114,57 @@ def optimal_chunksize(source, max_size, item_size=4, delta=0.1, axis_weight=None
     """
     if hasattr(source, "shape") and hasattr(source, "dtype"):
         item_size = np.dtype(source.dtype).itemsize
-        # logger.debug(f"Calculating optimal chunksize using itemsize {item_size}")
-
-        shape = np.asarray(source.shape, np.int16)
+        shape = np.asarray(source.shape, np.int64)
     else:
-        # logger.debug(f"Calculating optimal chunksize using no itemsize")
-        shape = np.asarray(source, np.int16)
+        shape = np.asarray(source, np.int64)
 
-    sizeMB = max_size * (2**20)
-    if axis_weight is None:
-        axis_weight = shape / float(np.min(shape))
+    ndim = len(shape)
+    if ndim == 0 or shape.min() <= 0:
+        return tuple(map(int, shape))
+    pads = np.broadcast_to(np.asarray(pad or 0, np.int64), (ndim,))
+    budget = max_size * (2**20) / float(item_size)  # in elements
 
-    axis_weight = 1 + np.asarray(axis_weight, float) / np.max(axis_weight)
-    total_chunks = int(ceil(np.prod(shape).astype(np.float32) * item_size / sizeMB))
-    total_chunks_axis = [int(ceil(total_chunks / p)) for p in axis_weight]
-    max_chunk_iter = [range(1, total + 1) for total in total_chunks_axis]
-    best_chunk = shape
+    if axis_weight is None:
+        if pattern == "cubic":
+            axis_weight = np.ones(ndim)
+        elif pattern == "slice":
+            axis_weight = np.full(ndim, float(SLICE_ASPECT))
+            axis_weight[0] = 1
+        elif pattern is None:
+            weight = shape / float(np.min(shape))
+            axis_weight = 1 + weight / np.max(weight)
+        else:
+            raise ValueError("Unknown access pattern: {}".format(pattern))
+    axis_weight = np.asarray(axis_weight, float)
+    axis_weight = axis_weight / axis_weight.min()
+
+    def fits(chunks):
+        return np.prod((chunks + 2 * pads).astype(float)) <= budget
+
+    def scaled(scale):
+        return np.clip(np.floor(axis_weight * scale), 1, shape).astype(np.int64)
+
+    # largest scale whose (padded) chunk fits in the budget
+    lo, hi = 0.0, float(shape.max())
+    if fits(scaled(hi)):
+        lo = hi
+    while hi - lo > 0.5:
+        mid = (lo + hi) / 2
+        lo, hi = (mid, hi) if fits(scaled(mid)) else (lo, mid)
+    target = scaled(lo)
+
+    # balanced chunks, trying the closest counts of chunks per axis
+    nchunks = -(-shape // target)
+    best_chunk = -(-shape // nchunks)
     best_chunk_err = np.inf
-
-    for nchunks in product(*max_chunk_iter):
-        chunks = np.ceil(shape / nchunks).astype(int)
-        chunk_size = np.prod(chunks) * item_size
-        chunk_size_err = (sizeMB - chunk_size) / (2**20)
+    for counts in product(*[sorted({max(n - 1, 1), n}) for n in nchunks]):
+        chunks = -(-shape // np.asarray(counts))
+        if not fits(chunks):
+            continue
+        chunk_size_err = (budget - np.prod(chunks.astype(float))) * item_size / (2**20)
         chunk_axis_err = np.abs(chunks / float(chunks.min()) - axis_weight).sum()
         chunk_err = chunk_size_err + chunk_axis_err
-        if chunk_size < sizeMB and chunk_err < best_chunk_err:
+        if chunk_err < best_chunk_err:
             best_chunk = chunks
             best_chunk_err = chunk_err
 
@@ -179,7 +226,7 @@ def dask_relabel_chunks(A):
     return relabel
 
 
-def _chunk_datasets(datasets, chunk=CHUNK, chunk_size=CHUNK_SIZE, stack=False):
+def _chunk_datasets(datasets, chunk=CHUNK, chunk_size=CHUNK_SIZE, stack=False, pad=0):
     """
     Process a set of input datasets and returns chunked `Dask.Array`s
     if `chunk = True`. The optimal chunk size is estimated from the
@@ -198,10 +245,12 @@ def _chunk_datasets(datasets, chunk=CHUNK, chunk_size=CHUNK_SIZE, stack=False):
         If a tuple or list is given with length equals to the number of
         dimensions of the input datasets, it is used as the chunk size.
         If a number is given, the maximum size in MB is assumed, and
-        optimal chunking is estimated. See `optimal_chunksize` for more
-        details.
+        optimal chunking is estimated for 3D filters with a padding of
+        `pad`. See `optimal_chunksize` for more details.
     stack: bool
         If datasets are going to be stacked or not.
+    pad: int or iterable
+        The padding of the blocks, see `map_blocks`.
 
     Returns
     -------
@@ -218,12 +267,14 @@ def _chunk_datasets(datasets, chunk=CHUNK, chunk_size=CHUNK_SIZE, stack=False):
         elif np.isscalar(chunk_size):
             # if stack:
             #    chunk_size = chunk_size / float(len(datasets))
-            chunk_size = optimal_chunksize(datasets[0], chunk_size)
+            chunk_size = optimal_chunksize(datasets[0], chunk_size, pattern="cubic", pad=pad)
         elif len(chunk_size) != datasets[0].ndim:
             raise ValueError("Chunk size has different dimension than " "source volume.")
         for i in range(len(datasets)):
             if isinstance(datasets[i], da.Array):
                 newds.append(datasets[i])
+            elif hasattr(datasets[i], "to_dask") and tuple(datasets[i].chunk_size) == tuple(chunk_size):
+                newds.append(datasets[i].to_dask())
             else:
                 chunk_size = tuple(map(int, chunk_size))
                 newds.append(da.from_array(datasets[i], chunks=chunk_size))
@@ -271,6 +322,230 @@ def _preprocess_datasets(datasets, chunk=CHUNK, scale=SCALE, stretch=STRETCH):
     return newds
 
 
+def normalize_transform(vmin, vmax, normalize=True):
+    """
+    Returns the `(offset, scale)` that normalizes data in the `[vmin, vmax]`
+    range as `(data - offset) * scale`, or `None` if nothing has to be done.
+
+    `normalize` is either `True` (or `'maxabs'`), to divide by the maximum
+    absolute value, or `'minmax'` to rescale to the `[0, 1]` range.
+    """
+    if not np.isfinite(vmin) or not np.isfinite(vmax):
+        return None
+    if normalize in (True, "maxabs"):
+        vabs = max(abs(vmin), abs(vmax))
+        return None if vabs == 0 else (0, 1.0 / vabs)
+    elif normalize == "minmax":
+        return (vmin, 1.0 if vmax == vmin else 1.0 / (vmax - vmin))
+    raise ValueError("Unknown normalization: {}".format(normalize))
+
+
+def _intersects(a, b):
+    return all(x.start < y.stop and y.start < x.stop for x, y in zip(a, b))
+
+
+def _set_normalization(out, transform):
+    if getattr(out, "supports_metadata", lambda: False)():
+        out.set_attr("normalization", [float(v) for v in transform])
+
+
+def _block_sources(x, blocks, selected):
+    """`(source, region)` pairs to store the `selected` `blocks` of `x`."""
+    if len(selected) == len(blocks):
+        return [(x, tuple(slice(0, n) for n in x.shape))]
+    return [(x.blocks[idx], slices) for idx, slices in selected]
+
+
+def store_blocks(result, out, normalize=False, align=True, regions=None):
+    """
+    Stores the dask array `result` into `out` a block at a time, writing
+    each block as soon as it is computed, so that only the blocks in flight
+    are held in memory instead of the whole result.
+
+    Parameters
+    ----------
+    result: dask.Array or list of dask.Array
+        The lazy result to be stored. Several results (sharing intermediate
+        computations) are stored in a single pass if a list is given.
+    out: numpy array-like or list of numpy array-like
+        The destination, e.g. a `survos2.model.Dataset`, one per result.
+    normalize: boolean, string or list of them
+        If not `False` the output is normalized (see `normalize_transform`).
+        The minimum and maximum are reduced from the blocks as they are
+        written, in the same pass, and the output is then rescaled in place a block at a time, so that
+        `result` is only computed once and never held in memory as a whole.
+        The transform applied is saved as the `normalization` metadata of
+        `out` (if supported).
+    align: boolean
+        If `True` and `out` is chunked (has a `chunk_size`), `result` is
+        rechunked to the chunks of `out` so that every block is written into
+        exactly one chunk of the destination.
+    regions: list of tuples of slices
+        If given, only the blocks intersecting any of `regions` are computed
+        and stored, the rest of `out` is assumed to be up to date. Normalized
+        outputs are then rescaled as a whole if their range changes, which
+        needs the `normalization` metadata of a previous full store.
+    """
+    if not isinstance(result, (list, tuple)):
+        result, out, normalize = [result], [out], [normalize]
+    elif not isinstance(normalize, (list, tuple)):
+        normalize = [normalize] * len(result)
+
+    plans = []
+    sources, targets, targets_regions, stats = [], [], [], []
+    for r, o, norm in zip(result, out, normalize):
+        chunk_size = getattr(o, "chunk_size", None)
+        if align and chunk_size is not None and len(chunk_size) == r.ndim:
+            chunks = da.core.normalize_chunks(tuple(chunk_size), r.shape)
+            if chunks != r.chunks:
+                r = r.rechunk(chunks)
+        blocks = list(zip(product(*(range(n) for n in r.numblocks)), slices_from_chunks(r.chunks)))
+        previous = None
+        if regions is not None and norm:
+            previous = o.get_metadata("normalization") if hasattr(o, "get_metadata") else None
+        if regions is not None and (not norm or previous is not None):
+            dirty = [b for b in blocks if any(_intersects(b[1], region) for region in regions)]
+        else:
+            dirty = blocks
+        first = len(stats)
+        for source, slices in _block_sources(r, blocks, dirty):
+            sources.append(source)
+            targets.append(o)
+            targets_regions.append(slices)
+            if norm:
+                stats += [da.nanmin(source), da.nanmax(source)]
+        plans.append((r, o, norm, slice(first, len(stats)), blocks, dirty, previous))
+
+    if len(sources) > 0:
+        # the reductions share the blocks of the store, which are computed once
+        stored = da.store(sources, targets, regions=targets_regions, lock=False, compute=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN blocks
+            stats = da.compute(stored, *stats)[1:]
+
+    for r, o, norm, stats_slice, blocks, dirty, previous in plans:
+        if not norm or len(dirty) == 0:
+            continue
+        ranges = stats[stats_slice]
+        vmin = np.nanmin((np.inf,) + ranges[0::2])
+        vmax = np.nanmax((-np.inf,) + ranges[1::2])
+        stored = da.from_array(o, chunks=r.chunks)
+        clean = [b for b in blocks if b not in dirty]
+        if len(clean) > 0:
+            # range of the up to date blocks, before their previous normalization
+            offset, scale = previous
+            ranges = da.compute(*[f(stored.blocks[idx]) for idx, _ in clean for f in (da.nanmin, da.nanmax)])
+            vmin = np.nanmin([vmin, np.nanmin(ranges[0::2]) / scale + offset])
+            vmax = np.nanmax([vmax, np.nanmax(ranges[1::2]) / scale + offset])
+        transform = normalize_transform(vmin, vmax, norm) or (0, 1)
+        logger.debug(f"Rescaling stored output as (x - {transform[0]}) * {transform[1]}")
+
+        # freshly stored blocks are not normalized, the rest were with `previous`
+        updates = [((0, 1), _block_sources(stored, blocks, dirty))] if tuple(transform) != (0, 1) else []
+        if len(clean) > 0 and tuple(previous) != tuple(transform):
+            updates.append((previous, _block_sources(stored, blocks, clean)))
+        sources, regions = [], []
+        for (offset, scale), block_sources in updates:
+            for source, slices in block_sources:
+                raw = source if (offset, scale) == (0, 1) else source / scale + offset
+                sources.append(((raw - transform[0]) * transform[1]).astype(o.dtype))
+                regions.append(slices)
+        da.store(sources, [o] * len(sources), regions=regions, lock=False)
+        _set_normalization(o, transform)
+
+
+def _process_safe(sources, outs):
+    """
+    Whether blocks of `sources` can be read, and written into `outs`, from
+    other processes: datasets are reopened by path and arrays are copied.
+    """
+    from ..model.dataset import Dataset
+
+    return all(isinstance(s, (Dataset, np.ndarray)) for s in sources) and all(
+        o is None or isinstance(o, Dataset) for o in outs
+    )
+
+
+def _filter_bank_block(block, bank=(), context=None):
+    # shared by the filters: readonly, copied for the filters modifying their input
+    block = block.view()
+    block.setflags(write=False)
+
+    def apply():
+        return np.stack(
+            [
+                asnparray(func(block.copy() if inplace else block, **kwargs), dtype=np.float32)
+                for func, kwargs, inplace in bank
+            ]
+        )
+
+    if context is None:
+        return apply()
+    with context(block):
+        return apply()
+
+
+def map_filter_bank(src, filters, chunk_size=CHUNK_SIZE, block_context=None):
+    """
+    Computes a bank of filters over `src` in a single pass over the data: each
+    block of `src` is read and padded once (with the largest padding of the
+    bank), all the filters are applied to it and their results are written
+    to their respective outputs.
+
+    Parameters
+    ----------
+    src: numpy array-like or string
+        The source dataset (or its URI).
+    filters: list of dict
+        The filters, as dictionaries with a `func` to map across blocks, its
+        `out` dataset (or URI) and, optionally, its `kwargs`, `pad` and
+        `normalize` (see `map_blocks`). Outputs are `float32`. The block is
+        readonly, filters modifying their input in place have to be flagged
+        with `inplace=True` to get a copy of it.
+    chunk_size: int or tuple
+        See `map_blocks`.
+    block_context: callable
+        If given, the filters are applied to each padded block within the
+        context `block_context(block)`, e.g. to share the Gaussian blurs of
+        the block between filters (see `survos2.server.filtering.blur.shared_gaussian`).
+    """
+    with ExitStack() as stack:
+        DM = stack.enter_context(DatasetManager(src))
+        outs = [
+            stack.enter_context(DatasetManager(src, out=f["out"], dtype=np.float32, fillvalue=0)).out
+            for f in filters
+        ]
+        pad = max(int(np.max(f.get("pad") or 0)) for f in filters)
+        source = _chunk_datasets(DM.sources, chunk=True, chunk_size=chunk_size, pad=pad)[0]
+        bank = [(f["func"], f.get("kwargs", dict()), f.get("inplace", False)) for f in filters]
+        logger.info(f"Applying a bank of {len(bank)} filters with padding {pad}")
+        scheduler = get_scheduler()
+        nbytes = scheduler.estimate([source], pad=pad, nout=len(bank))
+
+        if pad > 0:
+            depth = {i: pad for i in range(source.ndim)}
+            source = da.overlap.overlap(source, depth=depth, boundary="nearest")
+        result = source.map_blocks(
+            _filter_bank_block,
+            bank=bank,
+            context=block_context,
+            new_axis=0,
+            chunks=((len(bank),),) + source.chunks,
+            meta=np.empty((0,) * (source.ndim + 1), np.float32),
+        )
+        if pad > 0:
+            trim = {0: 0, **{i + 1: pad for i in range(source.ndim)}}
+            result = da.overlap.trim_internal(result, trim, boundary="nearest")
+
+        local = not _process_safe(DM.sources, outs)
+        with scheduler.admit(f"filter bank of {len(bank)}", nbytes), scheduler.threaded() if local else nullcontext():
+            store_blocks(
+                [result[i] for i in range(len(bank))],
+                outs,
+                normalize=[f.get("normalize", False) for f in filters],
+            )
+
+
 def _apply(
     func,
     datasets,
@@ -281,6 +556,8 @@ def _apply(
     compute=True,
     out=None,
     normalize=False,
+    stream=STREAM_STORE,
+    dirty=None,
     **kwargs,
 ):
     """
@@ -314,6 +591,17 @@ def _apply(
         otherwise a `dask.delayed` will be returned if `chunk = True`.
     out: None or numpy array-like
         if `out != None` then the result will be stored in there.
+    normalize: boolean or string
+        If `True` (or `'maxabs'`) the result is divided by its maximum absolute
+        value, if `'minmax'` it is rescaled to the `[0, 1]` range.
+    stream: boolean
+        If `True` and `out` is given, the blocks of the result are written
+        into `out` as they are computed (see `store_blocks`), otherwise the
+        whole result is computed in memory first.
+        Default: `computing.stream_store` in the config file.
+    dirty: None or list of tuples of slices
+        If given (and `stream=True`), only the blocks of `out` whose padded
+        footprint intersects any of these regions of the input are computed.
     **kwargs: other keyword arguments
         Arguments to be passed to `func`.
 
@@ -362,20 +650,35 @@ def _apply(
 
         logger.debug(f"Result of applying map blocks {result.shape}")
         rchunks = result.chunks
+        if relabel:
+            normalize = False
+
+        if out is not None and stream:
+            logger.debug(f"Streaming {result} output into {out}")
+            regions = None
+            if dirty is not None:
+                pads = np.broadcast_to(pad or 0, (result.ndim,))
+                regions = [
+                    tuple(slice(max(s.start - int(p), 0), s.stop + int(p)) for s, p in zip(region, pads))
+                    for region in dirty
+                ]
+            # blocks of local labels have to be kept as they are to be relabelled
+            store_blocks(result, out, normalize=normalize, align=not relabel, regions=regions)
+        else:
+            if normalize == "minmax":
+                vmin = da.nanmin(result)
+                result = (result - vmin) / (da.nanmax(result) - vmin)
+            elif normalize:
+                result = result / da.nanmax(da.fabs(result))
 
-        if not relabel and normalize:
-            result = result / da.nanmax(da.fabs(result))
-
-        if out is not None:
-            logger.debug(f"Storing {result} output in {out}")
-            result = result.compute()
-            # result.store(out) # , compute=True)
-            # result = result.compute()
-            logger.debug(f"Computed result of {result.shape}")
-            out[...] = result
-        elif compute:
-            result = result.compute()
-            return result
+            if out is not None:
+                logger.debug(f"Storing {result} output in {out}")
+                result = result.compute()
+                logger.debug(f"Computed result of {result.shape}")
+                out[...] = result
+            elif compute:
+                result = result.compute()
+                return result
 
         if relabel:
             logger.info("Relabeling chunks")
@@ -397,6 +700,24 @@ def _apply(
         return result
 
 
+__incremental__ = threading.local()
+
+
+@contextmanager
+def incremental(source, out, regions):
+    """
+    Within the context, the `map_blocks` calls that compute `out` from
+    `source` (both URIs) alone only recompute the blocks of `out` whose
+    padded footprint intersects `regions` (tuples of slices of `source`),
+    the rest of `out` being up to date. See `survos2.api.utils.save_metadata`.
+    """
+    __incremental__.restriction = (source, out, regions)
+    try:
+        yield
+    finally:
+        __incremental__.restriction = None
+
+
 def map_blocks(
     func,
     *args,
@@ -414,6 +735,7 @@ def map_blocks(
     timeit=False,
     stack=False,
     normalize=False,
+    stream=STREAM_STORE,
     **kwargs,
 ):
     """
@@ -465,6 +787,16 @@ def map_blocks(
         If `True` the function call will be timed and logged. Default: `False`.
     stack: boolean
         Whether to stack all the input datasets into a single ndim+1 dataset.
+    normalize: boolean or string
+        If `True` (or `'maxabs'`) the result is divided by its maximum absolute
+        value, if `'minmax'` it is rescaled to the `[0, 1]` range. With `out`
+        and `stream=True` the statistics are gathered while the blocks are
+        written and `out` is rescaled in place afterwards.
+    stream: boolean
+        If `True`, `chunk=True` and `out` is given, each block of the result is
+        written into `out` as soon as it is computed instead of computing the
+        whole result in memory first. Default: `computing.stream_store` in the
+        config file.
     **kwargs:
         other keyword arguments for the specific function being mapped.
     """
@@ -477,7 +809,7 @@ def map_blocks(
     params["params"] = parse_params(kwargs)
     params["blocks"] = parse_params(dict(chunk=chunk, chunk_size=chunk_size, pad=pad))
     params["preprocess"] = dict(scale=scale, stretch=stretch)
-    params["postprocess"] = dict(relabel=relabel, compute=compute)
+    params["postprocess"] = dict(relabel=relabel, compute=compute, normalize=normalize, stream=stream)
     params["misc"] = dict(uses_gpu=uses_gpu, timeit=timeit)
     params["out"] = dict(dtype=np.dtype(out_dtype).name, fill=out_fillvalue)
 
@@ -493,22 +825,42 @@ def map_blocks(
     if timeit:
         t0 = time.time()
 
+    dirty = None
+    restriction = getattr(__incremental__, "restriction", None)
+    if restriction is not None and not relabel and not stack:
+        source, target, regions = restriction
+        if len(args) == 1 and isinstance(args[0], str) and args[0] == source and out == target:
+            logger.info(f"Recomputing {len(regions)} changed source chunks and their surroundings")
+            dirty = regions
+
     with DatasetManager(*args, out=out, dtype=out_dtype, fillvalue=out_fillvalue) as DM:
-        datasets = _chunk_datasets(DM.sources, chunk=chunk, chunk_size=chunk_size, stack=stack)
+        datasets = _chunk_datasets(
+            DM.sources, chunk=chunk, chunk_size=chunk_size, stack=stack, pad=0 if stack else pad
+        )
         datasets = _preprocess_datasets(datasets, chunk=chunk, scale=scale, stretch=stretch)
-        result = _apply(
-            func,
-            datasets,
-            chunk=chunk,
-            pad=pad,
-            relabel=relabel,
-            stack=stack,
-            compute=compute,
-            out=DM.out,
-            normalize=normalize,
-            **kwargs,
-            dtype=out_dtype,
+        scheduler = get_scheduler()
+        in_memory = not (chunk and stream and out is not None) and (compute or out is not None)
+        nbytes = scheduler.estimate(
+            datasets, pad=pad, itemsize=np.dtype(out_dtype).itemsize, in_memory=in_memory
         )
+        # blocks of local labels are not chunk aligned, see `ComputeScheduler.threaded`
+        local = relabel or not _process_safe(DM.sources, [DM.out])
+        with scheduler.admit(func_showname, nbytes), scheduler.threaded() if local else nullcontext():
+            result = _apply(
+                func,
+                datasets,
+                chunk=chunk,
+                pad=pad,
+                relabel=relabel,
+                stack=stack,
+                compute=compute,
+                out=DM.out,
+                normalize=normalize,
+                stream=stream,
+                dirty=dirty,
+                **kwargs,
+                dtype=out_dtype,
+            )
 
     if timeit:
         t1 = time.time()
@@ -0,0 +1,107 @@
+"""
+Statistics of how datasets are read, to suggest chunk layouts.
+
+Every read of a `Dataset` (see `Dataset.get_data`) is recorded as either a
+plane along one axis, e.g. a slice of the viewer in any `order`, or a region,
+e.g. a block of a filter. `suggest_layout` turns them into the chunk shape
+that best serves the dominant access pattern, which can be applied with
+`survos2.model.rechunk.schedule_rechunk`. Statistics are kept in memory by
+the server process.
+
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from survos2.config import Config
+from survos2.improc.utils import SLICE_ASPECT, optimal_chunksize
+
+CHUNK_SIZE = Config["computing.chunk_size"]
+# fraction of the plane reads along the same axis for chunks thin along
+# that axis to be suggested
+SLICE_DOMINANCE = 2 / 3
+
+
+class AccessStats(object):
+    """Thread-safe counters of the plane and region reads of every dataset."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = dict()
+        self._local = threading.local()
+
+    def record(self, path, shape):
+        """Records a read of the region of `shape` of the dataset in `path`."""
+        if getattr(self._local, "paused", False):
+            return
+        shape = tuple(int(s) for s in shape)
+        planes = [axis for axis, s in enumerate(shape) if s == 1]
+        key = os.path.abspath(path)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = dict(planes=[0] * len(shape), regions=0)
+            if len(shape) >= 3 and len(planes) == 1:
+                stats["planes"][planes[0]] += 1
+            else:
+                stats["regions"] += 1
+
+    @contextmanager
+    def paused(self):
+        """Reads within the context (in this thread) are not recorded, e.g. copies."""
+        self._local.paused = True
+        try:
+            yield
+        finally:
+            self._local.paused = False
+
+    def get(self, path):
+        """Counters of the dataset in `path`: plane reads per axis and region reads."""
+        with self._lock:
+            stats = self._stats.get(os.path.abspath(path))
+            return None if stats is None else dict(planes=list(stats["planes"]), regions=stats["regions"])
+
+    def reset(self, path=None):
+        """Forgets the statistics of the dataset in `path`, or of every dataset."""
+        with self._lock:
+            if path is None:
+                self._stats.clear()
+            else:
+                self._stats.pop(os.path.abspath(path), None)
+
+
+access_stats = AccessStats()
+
+
+def suggest_layout(ds, max_size=CHUNK_SIZE, stats=None):
+    """
+    Suggests the chunk layout of the `Dataset` `ds` from its recorded reads
+    (or `stats`, see `AccessStats.get`):
+
+    - chunks `SLICE_ASPECT` times thinner along an axis, if most of the reads
+      are planes and at least `SLICE_DOMINANCE` of them are along that axis,
+    - cubic chunks otherwise, i.e. for region reads or planes along several
+      axes (e.g. the three orthogonal views), as they minimize the worst case.
+
+    Returns a dictionary with the suggested `chunks` (of up to `max_size` MB),
+    the `pattern`, whether it differs from the current layout (`changed`) and
+    the `stats` it is based on.
+    """
+    stats = stats or access_stats.get(ds._path)
+    current = [int(c) for c in ds.chunk_size]
+    if stats is None or sum(stats["planes"]) + stats["regions"] == 0:
+        return dict(chunks=current, pattern=None, changed=False, stats=stats)
+
+    planes = np.asarray(stats["planes"], float)
+    weight = np.ones(len(ds.shape))
+    pattern = "cubic"
+    if planes.sum() >= stats["regions"] and planes.max() >= SLICE_DOMINANCE * planes.sum():
+        axis = int(planes.argmax())
+        weight[:] = SLICE_ASPECT
+        weight[axis] = 1
+        pattern = "slice:{}".format(axis)
+    chunks = list(optimal_chunksize(ds.shape, max_size, item_size=np.dtype(ds.dtype).itemsize, axis_weight=weight))
+    return dict(chunks=chunks, pattern=pattern, changed=chunks != current, stats=stats)
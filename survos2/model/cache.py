@@ -0,0 +1,245 @@
+"""
+Content-addressed cache of computed datasets (e.g. features) of a workspace.
+
+Every entry is a copy of a computed dataset stored in
+`<workspace>/.feature_cache/<key>`, where `key` hashes the source datasets
+and their content versions, the function, its normalized parameters and the
+code version. Chunk files are hard-linked, not copied, both when an entry is
+stored and when it is restored, so a cache hit costs a few metadata
+operations. Writes to a chunk shared with an entry break the link first
+(see `ChunkHandlePool`), so entries are copy-on-write.
+
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+
+import survos2
+from survos2.config import Config
+from survos2.model.dataset import Dataset, drop_chunk_pool
+from survos2.utils import AttributeDB
+
+CACHE_DIR = ".feature_cache"
+CACHE_SIZE = Config["computing.feature_cache"]
+
+
+def _normalize_param(value):
+    if isinstance(value, np.ndarray):
+        return _normalize_param(value.tolist())
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (list, tuple)):
+        return [_normalize_param(v) for v in value]
+    elif isinstance(value, dict):
+        return {str(k): _normalize_param(v) for k, v in value.items()}
+    return value
+
+
+def normalize_params(params):
+    """Parameters as plain (yaml/json serializable) python types."""
+    return _normalize_param(dict(params))
+
+
+def code_version(func):
+    """Version of the code of `func`: the package version and its source."""
+    try:
+        code = inspect.getsource(func)
+    except (OSError, TypeError):
+        code = func.__code__.co_code.hex()
+    return "{}:{}".format(survos2.__version__, hashlib.sha1(code.encode()).hexdigest())
+
+
+def content_version(ds):
+    """
+    Hash of the content of the `Dataset` `ds`: its layout and the version of
+    every chunk on disk (see `Dataset.chunk_version`).
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps(normalize_params(ds.get_metadata(Dataset.__dsname__)), sort_keys=True).encode())
+    for idx in sorted(ds.existing_chunks()):
+        h.update(repr((tuple(idx), ds.chunk_version(idx))).encode())
+    return h.hexdigest()
+
+
+def workspace_path(path):
+    """Path of the workspace containing the dataset in `path`, or `None`."""
+    path = os.path.realpath(path)
+    for _ in range(4):
+        path = os.path.dirname(path)
+        if Dataset.exists(os.path.join(path, Dataset.__dsname__)):
+            return path
+    return None
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _is_metadata(name):
+    return name.startswith(".") or name.endswith(".yaml") or name.endswith(".json")
+
+
+def _link_tree(src, dst, skip=()):
+    """
+    Replicates the dataset directory `src` into `dst`, hard-linking the
+    chunk files and copying the (rewritable) metadata files. Pyramids and
+    temporary directories are skipped.
+    """
+    os.makedirs(dst, exist_ok=True)
+    for entry in os.scandir(src):
+        if entry.name in skip:
+            continue
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir():
+            if entry.name.startswith(".") or entry.name == "pyramid":
+                continue
+            _link_tree(entry.path, target)
+        elif _is_metadata(entry.name):
+            shutil.copy2(entry.path, target)
+        else:
+            try:
+                os.link(entry.path, target)
+            except OSError:  # e.g. the filesystem does not support hard links
+                shutil.copy2(entry.path, target)
+
+
+def _tree_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+__cache_locks__ = dict()
+__cache_locks_lock__ = threading.Lock()
+
+
+class FeatureCache(object):
+    """
+    Cache of computed datasets of the workspace in `path`, bounded to
+    `max_size` MB (`computing.feature_cache`) by evicting the least recently
+    used entries. The entries are listed in `<path>/.feature_cache/index.yaml`.
+    """
+
+    def __init__(self, path, max_size=CACHE_SIZE):
+        self._path = os.path.join(path, CACHE_DIR)
+        self._max_size = max_size
+        key = os.path.realpath(self._path)
+        with __cache_locks_lock__:
+            self._lock = __cache_locks__.setdefault(key, threading.RLock())
+
+    @staticmethod
+    def for_dataset(path, max_size=CACHE_SIZE):
+        """The cache of the workspace of the dataset in `path`, or `None`."""
+        if not max_size or max_size <= 0:
+            return None
+        ws_path = workspace_path(path)
+        return None if ws_path is None else FeatureCache(ws_path, max_size=max_size)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _index(self):
+        os.makedirs(self._path, exist_ok=True)
+        dbpath = os.path.join(self._path, "index")
+        if not os.path.isfile(dbpath + ".yaml"):
+            return AttributeDB.create(dbpath, dbtype="yaml")
+        return AttributeDB(dbpath, dbtype="yaml")
+
+    def key(self, func, sources, params):
+        """
+        Key of the result of `func(*sources, **params)`, where `sources` are
+        `Dataset`s. Returns `None` if any of the sources is not a `Dataset`.
+        """
+        if not all(isinstance(ds, Dataset) for ds in sources):
+            return None
+        desc = dict(
+            sources=[[ds.id, content_version(ds)] for ds in sources],
+            function="{}.{}".format(func.__module__, func.__qualname__),
+            params=normalize_params(params),
+            code=code_version(func),
+        )
+        return hashlib.sha1(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()
+
+    def entries(self):
+        """Description of every entry in the cache, by key."""
+        with self._lock:
+            return dict(self._index()) if os.path.isdir(self._path) else dict()
+
+    def restore(self, key, dst):
+        """
+        Replaces the content of the dataset in `dst` (a path) with the entry
+        `key`. Returns `False` if there is no such entry.
+        """
+        with self._lock:
+            index = self._index()
+            path = os.path.join(self._path, key)
+            if key not in index or not Dataset.exists(path):
+                return False
+            cached = Dataset(path, readonly=True)
+            dbname = os.path.basename(cached._db.filename)
+            drop_chunk_pool(dst)
+            for name in os.listdir(dst):
+                if name != dbname:
+                    _remove(os.path.join(dst, name))
+            _link_tree(path, dst, skip=(dbname,))
+            db = AttributeDB(os.path.join(dst, dbname), dbtype=dbname.rsplit(".", 1)[-1])
+            db[Dataset.__dsname__] = cached.get_metadata(Dataset.__dsname__)
+            db.save()
+            drop_chunk_pool(dst)
+            index[key]["last_used"] = time.time()
+            index.save()
+        logger.info("+ Restored {} from cache entry {}".format(dst, key))
+        return True
+
+    def store(self, key, src, **info):
+        """Stores the dataset in `src` (a path) as the entry `key`."""
+        with self._lock:
+            index = self._index()
+            path = os.path.join(self._path, key)
+            _remove(path)
+            drop_chunk_pool(src)  # no open handle can write through the links
+            _link_tree(src, path)
+            now = time.time()
+            index[key] = dict(normalize_params(info), size=_tree_size(path), created=now, last_used=now)
+            index.save()
+            self._evict(index, keep=key)
+
+    def _evict(self, index, keep=None):
+        total = sum(e["size"] for e in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= self._max_size * 2 ** 20:
+                break
+            if key == keep:
+                continue
+            total -= index[key]["size"]
+            self._remove_entry(index, key)
+        index.save()
+
+    def _remove_entry(self, index, key):
+        path = os.path.join(self._path, key)
+        drop_chunk_pool(path)
+        _remove(path)
+        index.pop(key, None)
+
+    def purge(self, key=None):
+        """Removes the entry `key`, or every entry if `key` is `None`."""
+        with self._lock:
+            index = self._index()
+            keys = list(index) if key is None else [k for k in [key] if k in index]
+            for k in keys:
+                self._remove_entry(index, k)
+            index.save()
+            return keys
@@ -9,7 +9,11 @@ import itertools
 import logging as log
 import numbers
 import os
+import re
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import dask.array as da
 import h5py as h5
@@ -18,10 +22,17 @@ from loguru import logger
 
 from survos2.config import Config
 from survos2.improc.utils import optimal_chunksize
+from survos2.model.access import access_stats
 from survos2.utils import AttributeDB
 
 CHUNKS = Config["computing.chunk_size"] if Config["computing.chunks"] else None
 CHUNKS_SPARSE = Config["computing.chunk_size_sparse"] if Config["computing.chunks"] else None
+CHUNK_HANDLES = Config["computing.chunk_handles"]
+IO_WORKERS = Config["computing.io_workers"]
+SPARSE = Config["computing.sparse_chunks"]
+COMPRESSION = Config["computing.compression"]
+SHUFFLE = Config["computing.compression_shuffle"]
+BACKEND = Config["model.backend"]
 
 
 class DatasetException(Exception):
@@ -47,6 +58,33 @@ class BaseDataset(object):
     def metadata(self):
         raise NotImplementedError()
 
+    def get_slice(self, slice_idx, order=(0, 1, 2)):
+        """
+        Returns the plane `slice_idx` of the dataset as seen with its axes
+        permuted by `order`, i.e. `np.transpose(ds[:], order)[slice_idx]`,
+        without reading anything outside of that plane.
+
+        Parameters
+        ----------
+        slice_idx: int
+            Index of the plane along the axis `order[0]`.
+        order: iterable of int
+            Permutation of the dataset axes (viewer order).
+
+        Returns
+        -------
+        data: numpy.ndarray
+            The requested plane, with the remaining axes in `order[1:]` order.
+        """
+        order = tuple(int(o) for o in order)
+        if sorted(order) != list(range(self.ndim)):
+            raise ValueError("Invalid axes order {} for a {}D dataset".format(order, self.ndim))
+        slices = [slice(None)] * self.ndim
+        slices[order[0]] = int(slice_idx)
+        data = self[tuple(slices)]
+        remaining = sorted(order[1:])
+        return np.transpose(data, [remaining.index(axis) for axis in order[1:]])
+
 
 class DatasetWrapper(BaseDataset):
     def __init__(self, fileobj, dataset):
@@ -97,13 +135,22 @@ class Dataset(BaseDataset):
     def __init__(self, path, readonly=False):
         if not os.path.isdir(path):
             raise DatasetException("Dataset '%s' does not exist." % path)
-        self._load(path)
         self._readonly = readonly
+        self._load(path)
 
     @property
     def id(self):
         return self._id
 
+    def __getstate__(self):
+        # sent to other processes by path (see `survos2.improc.scheduler`),
+        # after flushing the pending writes of this process
+        self._engine.flush()
+        return dict(path=self._path, readonly=self._readonly)
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], readonly=state["readonly"])
+
     def _load(self, path):
         self._id = os.path.basename(path)
         self._path = path
@@ -121,11 +168,17 @@ class Dataset(BaseDataset):
             self._chunk_grid = tuple(db[self.__dsname__]["chunk_grid"])
             self._chunk_size = tuple(db[self.__dsname__]["chunk_size"])
             self._fillvalue = db[self.__dsname__]["fillvalue"]
+            self._sparse = db[self.__dsname__].get("sparse", False)
+            self._compression = db[self.__dsname__].get("compression", None)
+            self._shuffle = db[self.__dsname__].get("shuffle", False)
+            self._backend = db[self.__dsname__].get("backend", "hdf5")
+            self._layout = db[self.__dsname__].get("layout", "")
         except:
             raise DatasetException("Unable to load dataset attributes: '%s'" % path)
 
         self._total_chunks = np.prod(self._chunk_grid)
         self._ndim = len(self._shape)
+        self._db_stamp = _file_version(db.filename)
 
         if not (len(self.shape) == len(self.chunk_grid) == len(self.chunk_size)):
             raise DatasetException(
@@ -133,6 +186,7 @@ class Dataset(BaseDataset):
                     self.shape, self.chunk_grid, self.chunk_size
                 )
             )
+        self._engine = get_engine(self._backend)(self)
 
     def save_file(self, fullname):
         fname = os.path.basename(fullname)
@@ -188,6 +242,43 @@ class Dataset(BaseDataset):
     def readonly(self):
         return self._readonly
 
+    @property
+    def sparse(self):
+        return self._sparse
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def shuffle(self):
+        return self._shuffle
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @property
+    def layout(self):
+        """Directory of the chunks, relative to the dataset (see `survos2.model.rechunk`)."""
+        return self._layout
+
+    @property
+    def chunk_path(self):
+        return os.path.join(self._path, self._layout) if self._layout else self._path
+
+    def reload(self):
+        """
+        Reloads the dataset if its metadata was changed on disk, e.g. when it
+        has been rechunked, so that open datasets follow the new layout.
+        """
+        if _file_version(self._db.filename) != self._db_stamp:
+            self._load(self._path)
+
+    def _save_db(self):
+        self._db.save()
+        self._db_stamp = _file_version(self._db.filename)
+
     # Access / Edit metadata
 
     def supports_metadata(self):
@@ -220,8 +311,9 @@ class Dataset(BaseDataset):
             raise DatasetException("Dataset metadata cannot be changed.")
         elif not self._db.isserializable(value):
             raise DatasetException("Metadata `{}` is not serializable".format(value))
+        self.reload()
         self._db[key] = value
-        self._db.save()
+        self._save_db()
 
     def update_metadata(self, key, value):
         if key == self.__dsname__:
@@ -229,15 +321,28 @@ class Dataset(BaseDataset):
         elif not self._db.isserializable(value):
             raise DatasetException("Metadata `{}` is not serializable".format(value))
         elif key in self._db:
+            self.reload()
             self._db.update(value)
-            self._db.save()
+            self._save_db()
         else:
             raise DatasetException("Metadata '%s' does not exist." % key)
 
     # Create
 
     @staticmethod
-    def create(path, shape=None, dtype=None, data=None, fillvalue=0, chunks=CHUNKS, **kwargs):
+    def create(
+        path,
+        shape=None,
+        dtype=None,
+        data=None,
+        fillvalue=0,
+        chunks=CHUNKS,
+        sparse=SPARSE,
+        compression=COMPRESSION,
+        shuffle=SHUFFLE,
+        backend=BACKEND,
+        **kwargs
+    ):
         logger.info(f"Creating dataset on {path} of shape {shape} of dtype {dtype} with data {data} in chunks {chunks}")
 
         database = kwargs.pop("database", "yaml")
@@ -269,6 +374,11 @@ class Dataset(BaseDataset):
             chunk_size = list(optimal_chunksize(shape, chunks, item_size=isize, **kwargs))
         chunk_grid = (np.ceil(np.asarray(shape, "f4") / chunk_size)).astype("i2").tolist()
 
+        if compression in (None, "", "none"):
+            compression, shuffle = None, False
+        engine = get_engine(backend)
+        engine.filters(compression, shuffle, dtype)  # validate before creating anything
+
         metadata = {
             Dataset.__dsname__: dict(
                 shape=shape,
@@ -276,6 +386,10 @@ class Dataset(BaseDataset):
                 fillvalue=fillvalue,
                 chunk_grid=chunk_grid,
                 chunk_size=chunk_size,
+                sparse=bool(sparse),
+                compression=compression,
+                shuffle=bool(shuffle),
+                backend=backend,
             )
         }
 
@@ -288,6 +402,7 @@ class Dataset(BaseDataset):
         db = AttributeDB.create(dbpath, dbtype=database)
         db.update(metadata)
         db.save()
+        engine.create(path, metadata[Dataset.__dsname__])
 
         ds = Dataset(path, readonly=readonly)
         if data is not None:
@@ -307,13 +422,47 @@ class Dataset(BaseDataset):
     def remove(path):
         Dataset(path).delete()
 
+    def close(self):
+        self._engine.close()
+
     def delete(self):
+        self._engine.close()
+        drop_chunk_pool(self._path)
         shutil.rmtree(self._path)
 
-    def _idx2name(self, idx):
-        if not all([type(i) == int for i in idx]) or len(idx) != self.ndim:
-            raise DatasetException("Invalid chunk idx: {}".format(idx))
-        return os.path.join(self._path, "chunk_%s.h5" % "x".join(map(str, idx)))
+    def existing_chunks(self):
+        """Returns the indexes of the chunks that are stored on disk."""
+        self._engine.refresh()
+        return self._engine.existing_chunks()
+
+    def to_dask(self):
+        """Returns the dataset as a `dask.array.Array` with one block per chunk."""
+        return self._engine.to_dask()
+
+    def chunk_version(self, idx):
+        """
+        Modification stamp of the chunk `idx` on disk, or `None` if the chunk
+        does not exist. The stamp changes whenever the chunk is written.
+        """
+        return self._engine.chunk_version(idx)
+
+    def chunk_versions(self):
+        """
+        Modification stamps of every chunk (see `chunk_version`), as a list in
+        flat chunk index order, so they can be stored as metadata.
+        """
+        return [
+            None if v is None else list(v)
+            for v in (self.chunk_version(idx) for idx in self._ndindex(self.chunk_grid))
+        ]
+
+    def region_version(self, slices=None):
+        """Modification stamps of all the chunks intersecting `slices`."""
+        slices = self._process_slices(slices)
+        ranges = [
+            range(s.start // c, max(s.start, s.stop - 1) // c + 1) for s, c in zip(slices, self.chunk_size)
+        ]
+        return tuple(self.chunk_version(idx) for idx in itertools.product(*ranges))
 
     def create_chunk(self, idx, data=None, cslices=None):
         # logger.debug(f"Creating chunk {idx} {data} {cslices}")
@@ -321,48 +470,64 @@ class Dataset(BaseDataset):
             raise DatasetException("Dataset is in readonly mode. Cannot create chunk.")
         if self.has_chunk(idx):
             raise DatasetException("DataChunk {} already exists".format(idx))
-        path = self._idx2name(idx)
-
-        #subchunk_size = optimal_chunksize(self.chunk_size, 8)
-
-        with h5.File(path, "w") as f:
-            #chunks = optimal_chunksize(self.chunk_size, 1)
-            f.create_dataset(
-                "data",
-                shape=self.chunk_size,
-                dtype=self.dtype,
-                fillvalue=self.fillvalue,
-                #chunks=chunks,
-            )
-            if data is not None:
-                slices = cslices or slice(None)
-                f["data"][slices] = data
-        return DataChunk(idx, path, self.chunk_size, self.dtype, self.fillvalue)
+        self._engine.create_chunk(idx, data=data, cslices=cslices)
+        return self._engine.chunk(idx)
 
-    def get_chunk(self, idx):
+    def get_chunk(self, idx, create=False):
+        """
+        Returns the `DataChunk` for `idx`. Chunks that do not exist on disk
+        are only created if `create=True`, otherwise `None` is returned.
+        """
         if self.has_chunk(idx):
-            path = self._idx2name(idx)
-            return DataChunk(idx, path, self.chunk_size, self.dtype, self.fillvalue)
-        return self.create_chunk(idx)
+            return self._engine.chunk(idx)
+        elif create:
+            return self.create_chunk(idx)
+        return None
 
     def has_chunk(self, idx):
-        return os.path.isfile(self._idx2name(idx))
+        return self._engine.has_chunk(idx)
 
     def del_chunk(self, idx):
         if self.readonly:
             raise DatasetException("Dataset is in readonly mode. Cannot delete chunk.")
-        if self.has_chunk(idx):
-            os.remove(self._idx2name(idx))
+        with self._engine.chunk_lock(idx):
+            if self.has_chunk(idx):
+                self._engine.del_chunk(idx)
 
     def get_chunk_data(self, idx, slices=None):
-        if self.has_chunk(idx):
-            return self.get_chunk(idx)[slices]
+        with self._engine.chunk_lock(idx):
+            if self.has_chunk(idx):
+                return self._engine.chunk(idx)[slices]
         return self._fillvalue
 
     def set_chunk_data(self, idx, values, slices=None):
         if self.readonly:
             raise DatasetException("Dataset is in readonly mode. Cannot modify chunk data.")
-        self.get_chunk(idx)[slices] = values
+        with self._engine.chunk_lock(idx):
+            if self.sparse and self._is_fill(values):
+                # pure fill-value blocks are never materialized on disk
+                if not self.has_chunk(idx):
+                    return
+                if self._covers_chunk(idx, slices):
+                    self.del_chunk(idx)
+                    return
+            self.get_chunk(idx, create=True)[slices] = values
+
+    def _is_fill(self, values):
+        values = np.asarray(values)
+        if self.fillvalue is not None and np.isnan(self.fillvalue):
+            return bool(np.isnan(values).all())
+        return bool((values == self.fillvalue).all())
+
+    def _covers_chunk(self, idx, slices):
+        if slices is None:
+            return True
+        if not isinstance(slices, (tuple, list)):
+            slices = (slices,)
+        for s, bounds in zip(slices, self.local_chunk_bounds(idx)):
+            if (s.start or 0) > 0 or (s.stop is not None and s.stop < bounds.stop):
+                return False
+        return True
 
     # Data setter/getters
 
@@ -372,14 +537,36 @@ class Dataset(BaseDataset):
     def __setitem__(self, slices, values):
         return self.set_data(values, slices=slices)
 
-    def get_data(self, slices=None):
+    def get_data(self, slices=None, copy=True):
+        """
+        Reads the region `slices` of the dataset. A region within a single
+        chunk is returned as read from that chunk, without copying it into a
+        new array. With `copy=False` and a storage engine mapping its chunks
+        (`npy`), that is a read-only view of the chunk on disk, which reflects
+        later writes to the dataset.
+        """
+        self.reload()
+        self._engine.refresh()
         slices, squeeze_axis = self._process_slices(slices, squeeze=True)
         tshape = tuple(x.stop - x.start for x in slices)
-        chunk_iterator = self._chunk_slice_iterator(slices, self.ndim)
+        access_stats.record(self._path, tshape)
+        chunks = [tuple(chunk) for chunk in self._chunk_slice_iterator(slices, self.ndim)]
+
+        if len(chunks) == 1:
+            idx, cslice, _ = chunks[0]
+            output = self.get_chunk_data(idx, slices=cslice)
+            if not isinstance(output, np.ndarray):  # chunk not stored
+                output = np.full(tshape, output, dtype=self.dtype)
+            elif copy and getattr(self._engine, "zero_copy", False):
+                output = output.copy()
+        else:
+            output = np.empty(tshape, dtype=self.dtype)
 
-        output = np.empty(tshape, dtype=self.dtype)
-        for idx, cslice, gslice in chunk_iterator:
-            output[gslice] = self.get_chunk_data(idx, slices=cslice)
+            def read_chunk(chunk):
+                idx, cslice, gslice = chunk
+                output[gslice] = self.get_chunk_data(idx, slices=cslice)
+
+            io_map(read_chunk, chunks)
 
         if len(squeeze_axis) > 0:
             logger.debug(f"Squeeze axis {squeeze_axis}")
@@ -402,16 +589,23 @@ class Dataset(BaseDataset):
                 )
             )
 
-        isscalar = np.isscalar(values)
-        ndim = self.ndim if isscalar else values.ndim
-        slices, squeeze_axis = self._process_slices(slices, squeeze=True)
-        chunk_iterator = self._chunk_slice_iterator(slices, ndim)
+        with layout_lock(self._path).shared():  # follows a layout switched to meanwhile
+            self.reload()
+            self._engine.refresh()
+            isscalar = np.isscalar(values)
+            ndim = self.ndim if isscalar else values.ndim
+            slices, squeeze_axis = self._process_slices(slices, squeeze=True)
+            chunk_iterator = self._chunk_slice_iterator(slices, ndim)
 
-        for idx, cslice, gslice in chunk_iterator:
-            if isscalar:
-                self.set_chunk_data(idx, values, slices=cslice)
-            else:
-                self.set_chunk_data(idx, values[gslice], slices=cslice)
+            def write_chunk(chunk):
+                idx, cslice, gslice = chunk
+                if isscalar:
+                    self.set_chunk_data(idx, values, slices=cslice)
+                else:
+                    self.set_chunk_data(idx, values[gslice], slices=cslice)
+
+            io_map(write_chunk, chunk_iterator)
+            self._engine.flush()
 
     def load(self, data):
         logger.debug(f"Loading dataset {data}")
@@ -420,13 +614,20 @@ class Dataset(BaseDataset):
                 "Data shape does not match: {} expected {}".format(self.shape, data.shape)
             )
         if isinstance(data, da.Array):
-            data.store(self)
+            data.store(self)  # block by block, see `set_data`
         else:
-            for idx in range(self.total_chunks):
-                idx = self.unravel_chunk_index(idx)
-                gslices = self.global_chunk_bounds(idx)
-                lslices = self.local_chunk_bounds(idx)
-                self.set_chunk_data(idx, data[gslices], slices=lslices)
+            with layout_lock(self._path).shared():
+                self.reload()
+                self._engine.refresh()
+
+                def load_chunk(flat_idx):
+                    idx = self.unravel_chunk_index(flat_idx)
+                    gslices = self.global_chunk_bounds(idx)
+                    lslices = self.local_chunk_bounds(idx)
+                    self.set_chunk_data(idx, data[gslices], slices=lslices)
+
+                io_map(load_chunk, range(self.total_chunks))
+                self._engine.flush()
 
     def local_chunk_bounds(self, idx):
         return tuple(
@@ -448,7 +649,7 @@ class Dataset(BaseDataset):
         return tuple(map(int, np.unravel_index(flat_idx, self.chunk_grid)))
 
     def ravel_chunk_index(self, idx):
-        return tuple(map(int, np.ravel_multi_index(idx, self.chunk_grid)))
+        return int(np.ravel_multi_index(idx, self.chunk_grid))
 
     def _process_slices(self, slices, squeeze=False):
         # logger.debug(f"_process_slices {slices}")
@@ -567,7 +768,7 @@ class Dataset(BaseDataset):
 
 
 class DataChunk(object):
-    def __init__(self, idx, path, shape, dtype, fillvalue):
+    def __init__(self, idx, path, shape, dtype, fillvalue, pool=None, readonly=True):
         if not os.path.isfile(path):
             raise Exception("Wrong initialization of a DataChunk({}): {}".format(idx, path))
         self._idx = idx
@@ -577,6 +778,10 @@ class DataChunk(object):
         self._dtype = dtype
         self._fillvalue = fillvalue
         self._ndim = len(shape)
+        self._pool = pool or ChunkHandlePool(max_handles=0)
+        # reads never open the file for writing, as closing a file opened for
+        # writing updates it on disk (and its version) even if not modified
+        self._read_mode = "r"
 
     @property
     def shape(self):
@@ -601,14 +806,15 @@ class DataChunk(object):
     def get_data(self, slices=None):
         if slices is None:
             slices = slice(None)
-        with h5.File(self._path, "r") as f:
+        with self._pool.open(self._path, self._read_mode) as f:
             data = f["data"][slices]
         return data
 
     def set_data(self, values, slices=None):
         if slices is None:
             slices = slice(None)
-        with h5.File(self._path, "a") as f:
+        self._pool.unshare(self._path)
+        with self._pool.open(self._path, "a") as f:
             f["data"][slices] = values
 
     def __getitem__(self, slices):
@@ -616,3 +822,903 @@ class DataChunk(object):
 
     def __setitem__(self, slices, values):
         self.set_data(values, slices=slices)
+
+
+def _is_shared(path):
+    try:
+        return os.stat(path).st_nlink > 1
+    except FileNotFoundError:
+        return False
+
+
+def _unshare(path, copy=True):
+    """
+    Breaks the hard link of the chunk file `path` if it is shared (e.g. with
+    an entry of the feature cache) before it is written, copying its content
+    unless `copy=False` (the file is about to be truncated).
+    """
+    if not _is_shared(path):
+        return
+    if copy:
+        tmp_path = path + ".cow"
+        shutil.copy2(path, tmp_path)
+        os.replace(tmp_path, path)
+    else:
+        os.remove(path)
+
+
+class _PooledHandle(object):
+    def __init__(self, fileobj, mode):
+        self.fileobj = fileobj
+        self.mode = mode
+        self.stat = self._stat(fileobj.filename)
+        self.pins = 0
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def writable(self):
+        return self.mode != "r"
+
+    def is_stale(self, path):
+        stat = self._stat(path)
+        if self.writable():  # our own writes update the modification time
+            return stat is None or stat[0] != self.stat[0]
+        return stat != self.stat
+
+
+class ChunkHandlePool(object):
+    """
+    Bounded LRU pool of open `h5py.File` handles to the chunk files of a
+    dataset, so consecutive chunk accesses do not pay the cost of opening
+    and closing the HDF5 file every time.
+
+    Handles are pinned while in use (see `open`) and only unpinned handles
+    are evicted, so the pool can be safely shared across threads. Writable
+    handles are flushed before being closed. Readonly handles are reopened
+    if the file was modified on disk since they were opened (e.g. by another
+    process), which costs a `stat` instead of a full HDF5 open.
+
+    Parameters
+    ----------
+    max_handles: int
+        Maximum number of idle handles kept open. If `0` every handle is
+        closed as soon as it is released.
+    """
+
+    def __init__(self, max_handles=CHUNK_HANDLES):
+        self._max_handles = max_handles
+        self._handles = collections.OrderedDict()
+        self._locks = collections.defaultdict(threading.RLock)
+        self._cond = threading.Condition(threading.RLock())
+
+    def __len__(self):
+        return len(self._handles)
+
+    def resize(self, max_handles):
+        """Changes the maximum number of idle handles, closing the excess."""
+        with self._cond:
+            self._max_handles = max_handles
+            self._evict()
+
+    @contextmanager
+    def open(self, path, mode="r"):
+        """
+        Context manager returning an open `h5py.File` for `path`. `mode` is
+        one of `'r'`, `'a'` or `'w'` (truncate). A readonly handle in the pool
+        is upgraded to read/write if needed.
+        """
+        fileobj = self._acquire(path, mode)
+        try:
+            yield fileobj
+        finally:
+            self._release(path)
+
+    def chunk_lock(self, path):
+        """
+        Returns the lock that serializes the creation and access of the
+        chunk file `path` across threads.
+        """
+        with self._cond:
+            return self._locks[path]
+
+    def _acquire(self, path, mode):
+        with self._cond:
+            while path in self._handles:
+                handle = self._handles[path]
+                if mode != "w" and (handle.writable() or mode == "r"):
+                    if not handle.is_stale(path):
+                        handle.pins += 1
+                        self._handles.move_to_end(path)
+                        return handle.fileobj
+                if handle.pins == 0:
+                    self._close(path)
+                else:
+                    self._cond.wait()
+
+            if mode == "w":
+                _unshare(path, copy=False)
+            handle = _PooledHandle(h5.File(path, mode), "a" if mode == "w" else mode)
+            handle.pins += 1
+            self._handles[path] = handle
+            self._evict()
+            return handle.fileobj
+
+    def _release(self, path):
+        with self._cond:
+            handle = self._handles.get(path)
+            if handle is not None:
+                handle.pins -= 1
+                self._evict()
+            self._cond.notify_all()
+
+    def _close(self, path):
+        handle = self._handles.pop(path)
+        if handle.writable():
+            handle.fileobj.flush()
+        handle.fileobj.close()
+
+    def _evict(self):
+        idle = [p for p, h in self._handles.items() if h.pins == 0]
+        for path in idle[: max(0, len(self._handles) - self._max_handles)]:
+            self._close(path)
+
+    def unshare(self, path):
+        """
+        Makes sure that writing to `path` does not modify the files it shares
+        a hard link with, copying it (and closing its handle) if needed.
+        """
+        if _is_shared(path):
+            with self.chunk_lock(path):
+                self.invalidate(path)
+                _unshare(path)
+
+    def flush(self):
+        """Flushes all the writable handles to disk."""
+        with self._cond:
+            for handle in self._handles.values():
+                if handle.writable():
+                    handle.fileobj.flush()
+
+    def invalidate(self, path):
+        """Closes the handle of `path` (if any), waiting for it to be released."""
+        with self._cond:
+            while path in self._handles:
+                if self._handles[path].pins == 0:
+                    self._close(path)
+                else:
+                    self._cond.wait()
+
+    def clear(self):
+        """Closes all the handles in the pool."""
+        with self._cond:
+            for path in list(self._handles):
+                self.invalidate(path)
+
+
+__io_executor__ = None
+__io_lock__ = threading.Lock()
+__io_local__ = threading.local()
+
+
+def _io_task(func, item):
+    __io_local__.active = True
+    try:
+        return func(item)
+    finally:
+        __io_local__.active = False
+
+
+def io_map(func, items, workers=None):
+    """
+    Applies `func` to every element of `items` using a shared thread pool of
+    `computing.io_workers` threads for chunk reads and writes, which overlap
+    as h5py releases the GIL during IO and decompression. Runs sequentially
+    if a single worker is configured or if called from an IO worker thread.
+    """
+    global __io_executor__
+    workers = IO_WORKERS if workers is None else workers
+    if workers <= 1 or getattr(__io_local__, "active", False):
+        return [func(item) for item in items]
+    if __io_executor__ is None:
+        with __io_lock__:
+            if __io_executor__ is None:
+                __io_executor__ = ThreadPoolExecutor(workers, thread_name_prefix="survos_io")
+    futures = [__io_executor__.submit(_io_task, func, item) for item in items]
+    return [f.result() for f in futures]
+
+
+__chunk_pools__ = dict()
+__chunk_pools_lock__ = threading.Lock()
+
+
+def get_chunk_pool(path):
+    """
+    Returns the `ChunkHandlePool` of the dataset stored in `path`. Pools are
+    shared by all the `Dataset` instances of the same path within a process,
+    so a chunk file is never opened twice with different modes.
+    """
+    key = os.path.realpath(path)
+    with __chunk_pools_lock__:
+        if key not in __chunk_pools__:
+            __chunk_pools__[key] = ChunkHandlePool(CHUNK_HANDLES)
+        return __chunk_pools__[key]
+
+
+def set_chunk_handles(max_handles):
+    """
+    Sets the maximum number of idle handles of the `ChunkHandlePool`s of the
+    process, e.g. `0` in worker processes that must not keep chunk files open
+    between tasks (see `survos2.improc.scheduler`).
+    """
+    global CHUNK_HANDLES
+    with __chunk_pools_lock__:
+        CHUNK_HANDLES = max_handles
+        pools = list(__chunk_pools__.values())
+    for pool in pools:
+        pool.resize(max_handles)
+
+
+def drop_chunk_pool(path, recursive=True):
+    """
+    Closes and forgets the `ChunkHandlePool`s (and `ChunkIndex`es) of the
+    dataset in `path` and, if `recursive`, of any dataset contained in it
+    (e.g. when removing a whole workspace).
+    """
+    key = os.path.realpath(path)
+
+    def match(k):
+        return k == key or (recursive and k.startswith(key + os.path.sep))
+
+    with __chunk_pools_lock__:
+        keys = [k for k in __chunk_pools__ if match(k)]
+        pools = [__chunk_pools__.pop(k) for k in keys]
+        keys = [k for k in __chunk_indexes__ if match(k)]
+        for k in keys:
+            del __chunk_indexes__[k]
+    for pool in pools:
+        pool.clear()
+
+
+class LayoutLock(object):
+    """
+    Shared/exclusive lock of the chunk layout of a dataset. Writes hold it
+    shared (see `Dataset.set_data`), the switch to a new layout exclusively
+    (see `survos2.model.rechunk`), so a write lands entirely either in the
+    previous layout, before the switch, or in the new one. Shared holds are
+    reentrant within a thread, and a pending switch blocks new writers.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._writers = 0
+        self._switching = False
+        self._local = threading.local()
+
+    @contextmanager
+    def shared(self):
+        depth = getattr(self._local, "depth", 0)
+        with self._cond:
+            if depth == 0:
+                self._cond.wait_for(lambda: not self._switching)
+            self._writers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            with self._cond:
+                self._writers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._switching)
+            self._switching = True
+            self._cond.wait_for(lambda: self._writers == 0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._switching = False
+                self._cond.notify_all()
+
+
+__layout_locks__ = dict()
+__layout_locks_lock__ = threading.Lock()
+
+
+def layout_lock(path):
+    """The `LayoutLock` of the dataset stored in `path`, shared within a process."""
+    key = os.path.realpath(path)
+    with __layout_locks_lock__:
+        return __layout_locks__.setdefault(key, LayoutLock())
+
+
+def compression_filters(compression, shuffle=False, dtype=None):
+    """
+    Translates a chunk compression spec into `h5py.create_dataset` arguments.
+
+    Parameters
+    ----------
+    compression : None or str
+        One of `None` (uncompressed), `"gzip[:level]"`, `"lzf"`,
+        `"blosc:lz4[:level]"` or `"blosc:zstd[:level]"`. Blosc codecs
+        require the optional `hdf5plugin` package.
+    shuffle : bool
+        Apply the byte shuffle filter before compressing (ignored for
+        single-byte dtypes).
+    dtype : None or numpy dtype
+        Data type of the chunks.
+
+    Returns
+    -------
+    filters : dict
+        Keyword arguments for `h5py.Group.create_dataset`.
+    """
+    if compression in (None, "", "none"):
+        return {}
+    codec, _, level = str(compression).partition(":")
+    shuffle = bool(shuffle) and (dtype is None or np.dtype(dtype).itemsize > 1)
+    try:
+        if codec == "gzip":
+            filters = dict(compression="gzip", compression_opts=int(level or 4))
+        elif codec == "lzf" and not level:
+            filters = dict(compression="lzf")
+        elif codec == "blosc":
+            cname, _, clevel = level.partition(":")
+            if cname not in ("lz4", "zstd"):
+                raise ValueError(cname)
+            try:
+                import hdf5plugin
+            except ImportError:
+                raise DatasetException("Compression '%s' requires the `hdf5plugin` package." % compression)
+            mode = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+            # blosc shuffles internally, no need for the HDF5 shuffle filter
+            return dict(hdf5plugin.Blosc(cname=cname, clevel=int(clevel or 5), shuffle=mode))
+        else:
+            raise ValueError(codec)
+    except ValueError:
+        raise DatasetException("Unknown chunk compression '%s'." % compression)
+    if shuffle:
+        filters["shuffle"] = True
+    return filters
+
+
+CHUNK_REGEXP = re.compile(r"^chunk_(?P<idx>\d+(x\d+)*)\.h5$")
+NPY_CHUNK_REGEXP = re.compile(r"^chunk_(?P<idx>\d+(x\d+)*)\.npy$")
+ZARR_CHUNK_REGEXP = re.compile(r"^(?P<idx>\d+(\.\d+)*)$")
+
+
+class ChunkIndex(object):
+    """
+    In-memory bitmap of the chunks of a dataset that exist on disk, so that
+    checking for a chunk does not require a `stat` per chunk. The dataset
+    directory is rescanned (see `refresh`) only when its modification time
+    changes, i.e. when chunk files are created or removed by someone else.
+    Chunk files are recognised by `pattern`, whose `idx` group holds the
+    chunk index joined by `sep`.
+    """
+
+    def __init__(self, path, chunk_grid, pattern=CHUNK_REGEXP, sep="x"):
+        self._path = path
+        self._chunk_grid = tuple(chunk_grid)
+        self._pattern = pattern
+        self._sep = sep
+        self._bitmap = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def chunk_grid(self):
+        return self._chunk_grid
+
+    def _dir_mtime(self):
+        return os.stat(self._path).st_mtime_ns
+
+    def _scan(self):
+        bitmap = np.zeros(self._chunk_grid, bool)
+        for entry in os.scandir(self._path):
+            match = self._pattern.match(entry.name)
+            if match is None:
+                continue
+            idx = tuple(int(i) for i in match.group("idx").split(self._sep))
+            if len(idx) == bitmap.ndim and all(i < n for i, n in zip(idx, self._chunk_grid)):
+                bitmap[idx] = True
+        self._bitmap = bitmap
+
+    def refresh(self):
+        with self._lock:
+            mtime = self._dir_mtime()
+            if self._bitmap is None or mtime != self._mtime:
+                self._scan()
+                self._mtime = mtime
+
+    def __contains__(self, idx):
+        if self._bitmap is None:
+            self.refresh()
+        return bool(self._bitmap[tuple(idx)])
+
+    def add(self, idx):
+        self._update(idx, True)
+
+    def discard(self, idx):
+        self._update(idx, False)
+
+    def _update(self, idx, value):
+        if self._bitmap is None:
+            self.refresh()
+        with self._lock:
+            self._bitmap[tuple(idx)] = value
+            self._mtime = self._dir_mtime()
+
+    def chunks(self):
+        if self._bitmap is None:
+            self.refresh()
+        return [tuple(map(int, idx)) for idx in np.argwhere(self._bitmap)]
+
+
+__chunk_indexes__ = dict()
+
+
+def get_chunk_index(path, chunk_grid, pattern=CHUNK_REGEXP, sep="x"):
+    """
+    Returns the `ChunkIndex` of the chunks stored in `path`, shared by all
+    the `Dataset` instances of the same path within a process.
+    """
+    key = os.path.realpath(path)
+    with __chunk_pools_lock__:
+        index = __chunk_indexes__.get(key)
+        if index is None or index.chunk_grid != tuple(chunk_grid):
+            index = __chunk_indexes__[key] = ChunkIndex(path, chunk_grid, pattern=pattern, sep=sep)
+        return index
+
+
+def zarr_compressor(compression, shuffle=False, dtype=None):
+    """
+    Translates a chunk compression spec (see `compression_filters`) into
+    `zarr.open_array` arguments. `lzf` is not available in Zarr.
+    """
+    if compression in (None, "", "none"):
+        return dict(compressor=None)
+    import numcodecs
+
+    codec, _, level = str(compression).partition(":")
+    shuffle = bool(shuffle) and (dtype is None or np.dtype(dtype).itemsize > 1)
+    try:
+        if codec == "gzip":
+            return dict(compressor=numcodecs.GZip(level=int(level or 4)))
+        elif codec == "blosc":
+            cname, _, clevel = level.partition(":")
+            if cname not in ("lz4", "zstd"):
+                raise ValueError(cname)
+            mode = numcodecs.Blosc.SHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE
+            return dict(compressor=numcodecs.Blosc(cname=cname, clevel=int(clevel or 5), shuffle=mode))
+        raise ValueError(codec)
+    except ValueError:
+        raise DatasetException("Unknown chunk compression '%s' for the zarr backend." % compression)
+
+
+def _file_version(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise DatasetException("The zarr storage backend requires the `zarr` package.")
+    return zarr
+
+
+class HDF5Engine(object):
+    """
+    Default storage engine of a `Dataset`: every chunk is stored in its own
+    HDF5 file (`chunk_AxBxC.h5`) next to the dataset metadata.
+
+    A storage engine takes care of the chunk level IO of a `Dataset`, while
+    the dataset handles metadata, slicing and the chunk iteration.
+    """
+
+    name = "hdf5"
+
+    def __init__(self, dataset):
+        self._ds = dataset
+        self._path = dataset.chunk_path
+        # also registers any external HDF5 filter needed to read the chunks
+        self._filters = compression_filters(dataset.compression, dataset.shuffle, dataset.dtype)
+        self._pool = get_chunk_pool(self._path)
+        self._index = get_chunk_index(self._path, dataset.chunk_grid)
+
+    @staticmethod
+    def filters(compression, shuffle=False, dtype=None):
+        return compression_filters(compression, shuffle, dtype)
+
+    @staticmethod
+    def create(path, metadata):
+        pass  # chunk files are created on demand
+
+    def _chunk_path(self, idx):
+        if not all([type(i) == int for i in idx]) or len(idx) != self._ds.ndim:
+            raise DatasetException("Invalid chunk idx: {}".format(idx))
+        return os.path.join(self._path, "chunk_%s.h5" % "x".join(map(str, idx)))
+
+    def refresh(self):
+        self._index.refresh()
+
+    def has_chunk(self, idx):
+        return tuple(idx) in self._index
+
+    def existing_chunks(self):
+        return self._index.chunks()
+
+    def chunk_lock(self, idx):
+        return self._pool.chunk_lock(self._chunk_path(idx))
+
+    def chunk_version(self, idx):
+        return _file_version(self._chunk_path(idx))
+
+    def chunk(self, idx):
+        ds = self._ds
+        return DataChunk(
+            idx,
+            self._chunk_path(idx),
+            ds.chunk_size,
+            ds.dtype,
+            ds.fillvalue,
+            pool=self._pool,
+            readonly=ds.readonly,
+        )
+
+    def create_chunk(self, idx, data=None, cslices=None):
+        ds = self._ds
+        # compressed chunks are stored in ~1MB HDF5 sub-chunks, so that reading
+        # a slice does not need to decompress the whole chunk
+        subchunks = None
+        if self._filters:
+            subchunks = optimal_chunksize(ds.chunk_size, 1, item_size=np.dtype(ds.dtype).itemsize)
+
+        with self._pool.open(self._chunk_path(idx), "w") as f:
+            f.create_dataset(
+                "data",
+                shape=ds.chunk_size,
+                dtype=ds.dtype,
+                fillvalue=ds.fillvalue,
+                chunks=subchunks,
+                **self._filters
+            )
+            if data is not None:
+                slices = cslices or slice(None)
+                f["data"][slices] = data
+        self._index.add(idx)
+
+    def del_chunk(self, idx):
+        path = self._chunk_path(idx)
+        self._pool.invalidate(path)
+        os.remove(path)
+        self._index.discard(idx)
+
+    def flush(self):
+        self._pool.flush()
+
+    def close(self):
+        self._pool.clear()
+
+    def to_dask(self):
+        return da.from_array(self._ds, chunks=self._ds.chunk_size)
+
+
+class ZarrEngine(object):
+    """
+    Storage engine that keeps the chunks of a `Dataset` in a Zarr array
+    (`data.zarr`) next to the dataset metadata, with one file per chunk and
+    Zarr's own compression. Requires the optional `zarr` package.
+    """
+
+    name = "zarr"
+    __store__ = "data.zarr"
+
+    def __init__(self, dataset):
+        zarr = _import_zarr()
+        self._ds = dataset
+        self._path = os.path.join(dataset.chunk_path, self.__store__)
+        self._array = zarr.open_array(self._path, mode="r" if dataset.readonly else "r+")
+        # zarr does not lock partial chunk writes, reuse the per chunk locks
+        self._locks = get_chunk_pool(dataset.chunk_path)
+        self._index = get_chunk_index(self._path, dataset.chunk_grid, pattern=ZARR_CHUNK_REGEXP, sep=".")
+
+    @staticmethod
+    def filters(compression, shuffle=False, dtype=None):
+        return zarr_compressor(compression, shuffle, dtype)
+
+    @staticmethod
+    def create(path, metadata):
+        zarr = _import_zarr()
+        zarr.open_array(
+            os.path.join(path, ZarrEngine.__store__),
+            mode="w",
+            shape=metadata["shape"],
+            chunks=metadata["chunk_size"],
+            dtype=metadata["dtype"],
+            fill_value=metadata["fillvalue"],
+            dimension_separator=".",
+            **zarr_compressor(metadata["compression"], metadata["shuffle"], metadata["dtype"])
+        )
+
+    def _chunk_key(self, idx):
+        if not all([type(i) == int for i in idx]) or len(idx) != self._ds.ndim:
+            raise DatasetException("Invalid chunk idx: {}".format(idx))
+        return ".".join(map(str, idx))
+
+    def refresh(self):
+        self._index.refresh()
+
+    def has_chunk(self, idx):
+        return tuple(idx) in self._index
+
+    def existing_chunks(self):
+        return self._index.chunks()
+
+    def chunk_lock(self, idx):
+        return self._locks.chunk_lock(os.path.join(self._path, self._chunk_key(idx)))
+
+    def chunk_version(self, idx):
+        return _file_version(os.path.join(self._path, self._chunk_key(idx)))
+
+    def chunk(self, idx):
+        ds = self._ds
+        return ZarrChunk(self._array, idx, ds.chunk_size, ds.dtype, ds.fillvalue)
+
+    def create_chunk(self, idx, data=None, cslices=None):
+        ds = self._ds
+        block = np.full(ds.chunk_size, ds.fillvalue, dtype=ds.dtype)
+        if data is not None:
+            block[cslices or slice(None)] = data
+        self.chunk(idx)[...] = block
+        self._index.add(idx)
+
+    def del_chunk(self, idx):
+        del self._array.store[self._chunk_key(idx)]
+        self._index.discard(idx)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def to_dask(self):
+        return da.from_zarr(self._array)
+
+
+class ZarrChunk(object):
+    """View of a single chunk of a Zarr array, with the `DataChunk` interface."""
+
+    def __init__(self, array, idx, shape, dtype, fillvalue):
+        self._array = array
+        self._idx = idx
+        self._shape = shape
+        self._dtype = dtype
+        self._fillvalue = fillvalue
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def fillvalue(self):
+        return self._fillvalue
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    def _global_slices(self, slices):
+        # chunks on the border of the array are clipped to its shape
+        if slices is None or slices is Ellipsis:
+            slices = ()
+        elif not isinstance(slices, (tuple, list)):
+            slices = (slices,)
+        slices = list(slices) + [slice(None)] * (self.ndim - len(slices))
+        gslices, lslices, shape = [], [], []
+        for s, i, size, total in zip(slices, self._idx, self._shape, self._array.shape):
+            start, stop, _ = s.indices(size)
+            stop = max(start, stop)
+            offset = i * size
+            gstop = max(min(offset + stop, total), offset + start)
+            gslices.append(slice(offset + start, gstop))
+            lslices.append(slice(0, gstop - offset - start))
+            shape.append(stop - start)
+        return tuple(gslices), tuple(lslices), tuple(shape)
+
+    def get_data(self, slices=None):
+        gslices, lslices, shape = self._global_slices(slices)
+        data = self._array[gslices]
+        if data.shape != shape:
+            padded = np.full(shape, self._fillvalue, dtype=self._dtype)
+            padded[lslices] = data
+            data = padded
+        return data
+
+    def set_data(self, values, slices=None):
+        gslices, lslices, _ = self._global_slices(slices)
+        values = np.asarray(values)
+        values = values[lslices] if values.ndim > 0 else values[()]
+        self._array[gslices] = values
+
+    def __getitem__(self, slices):
+        return self.get_data(slices=slices)
+
+    def __setitem__(self, slices, values):
+        self.set_data(values, slices=slices)
+
+
+class NpyEngine(object):
+    """
+    Storage engine that keeps every chunk of a `Dataset` as a raw,
+    C-contiguous `.npy` file (`chunk_AxBxC.npy`) next to the dataset
+    metadata, which is read through `np.memmap`. Reads do not allocate nor
+    decode anything, so that a region within a single chunk can be returned
+    as a view of the mapped file (see `Dataset.get_data`). Chunks cannot be
+    compressed.
+    """
+
+    name = "npy"
+    zero_copy = True
+
+    def __init__(self, dataset):
+        self._ds = dataset
+        self._path = dataset.chunk_path
+        self._locks = get_chunk_pool(self._path)
+        self._index = get_chunk_index(self._path, dataset.chunk_grid, pattern=NPY_CHUNK_REGEXP)
+
+    @staticmethod
+    def filters(compression, shuffle=False, dtype=None):
+        if compression not in (None, "", "none"):
+            raise DatasetException("The npy backend does not support chunk compression '%s'." % compression)
+        return dict()
+
+    @staticmethod
+    def create(path, metadata):
+        pass  # chunk files are created on demand
+
+    def _chunk_path(self, idx):
+        if not all([type(i) == int for i in idx]) or len(idx) != self._ds.ndim:
+            raise DatasetException("Invalid chunk idx: {}".format(idx))
+        return os.path.join(self._path, "chunk_%s.npy" % "x".join(map(str, idx)))
+
+    def refresh(self):
+        self._index.refresh()
+
+    def has_chunk(self, idx):
+        return tuple(idx) in self._index
+
+    def existing_chunks(self):
+        return self._index.chunks()
+
+    def chunk_lock(self, idx):
+        return self._locks.chunk_lock(self._chunk_path(idx))
+
+    def chunk_version(self, idx):
+        return _file_version(self._chunk_path(idx))
+
+    def chunk(self, idx):
+        ds = self._ds
+        return NpyChunk(idx, self._chunk_path(idx), ds.chunk_size, ds.dtype, ds.fillvalue)
+
+    def create_chunk(self, idx, data=None, cslices=None):
+        ds = self._ds
+        path = self._chunk_path(idx)
+        # written aside and renamed, readers never map a partial chunk
+        tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+        block = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=ds.dtype, shape=tuple(ds.chunk_size))
+        if ds.fillvalue:
+            block[...] = ds.fillvalue
+        if data is not None:
+            block[cslices or slice(None)] = data
+        block.flush()
+        del block
+        os.replace(tmp_path, path)
+        self._index.add(idx)
+
+    def del_chunk(self, idx):
+        os.remove(self._chunk_path(idx))
+        self._index.discard(idx)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def to_dask(self):
+        return da.from_array(self._ds, chunks=self._ds.chunk_size)
+
+
+class NpyChunk(object):
+    """
+    A chunk stored as a `.npy` file, with the `DataChunk` interface. Reads
+    return read-only views of the mapped file, which reflect later writes to
+    the chunk.
+    """
+
+    def __init__(self, idx, path, shape, dtype, fillvalue):
+        self._idx = idx
+        self._path = path
+        self._shape = tuple(shape)
+        self._dtype = dtype
+        self._fillvalue = fillvalue
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def fillvalue(self):
+        return self._fillvalue
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    def get_data(self, slices=None):
+        if slices is None:
+            slices = slice(None)
+        return np.asarray(np.load(self._path, mmap_mode="r")[slices])
+
+    def set_data(self, values, slices=None):
+        if slices is None:
+            slices = slice(None)
+        _unshare(self._path)  # e.g. linked with a feature cache entry, written through the mapping
+        block = np.load(self._path, mmap_mode="r+")
+        block[slices] = values
+        block.flush()
+        del block
+        os.utime(self._path)  # stores through a mapping update the mtime lazily
+
+    def __getitem__(self, slices):
+        return self.get_data(slices=slices)
+
+    def __setitem__(self, slices, values):
+        self.set_data(values, slices=slices)
+
+
+__engines__ = dict(hdf5=HDF5Engine, zarr=ZarrEngine, npy=NpyEngine)
+
+
+def get_engine(backend):
+    """Returns the storage engine class registered as `backend`."""
+    try:
+        return __engines__[backend]
+    except KeyError:
+        raise DatasetException("Unknown storage backend '%s'." % backend)
+
+
+def read_array(dataset, slices=Ellipsis):
+    """
+    Reads `slices` of any dataset-like object for read-only use: regions of
+    a `Dataset` are returned without copies where possible (see
+    `Dataset.get_data` with `copy=False`), e.g. as views of memory-mapped
+    `npy` chunks.
+    """
+    if isinstance(dataset, Dataset):
+        return dataset.get_data(slices, copy=False)
+    return dataset[slices]
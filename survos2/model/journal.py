@@ -0,0 +1,172 @@
+"""
+Sparse undo/redo journal of the edits of a dataset.
+
+Every edit is stored as an entry of the voxels it changed: their flat
+offsets (C order, grouped by chunk), their previous values and their new
+values, with the chunks they belong to in CSR form (`chunks` and
+`indptr`), so that undoing or redoing it only touches those voxels and
+chunks. The chunk size the entry was grouped with is stored too: as the
+offsets are global, an entry recorded with another chunk layout is grouped
+again by the chunks of the current one. Entries are `.npz` files in `<dataset>/journal`, listed in
+`journal.yaml` as an undo stack, bounded to `depth` entries, and a redo
+stack, which is cleared by a new edit.
+
+"""
+
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from survos2.config import Config
+from survos2.utils import AttributeDB
+
+JOURNAL_DIR = "journal"
+JOURNAL_DEPTH = Config["computing.annotation_journal_depth"]
+
+
+def journal_path(path):
+    return os.path.join(path, JOURNAL_DIR)
+
+
+class JournalEntry(object):
+    """The voxels changed by an edit, see the module documentation."""
+
+    def __init__(self, chunks, indptr, offsets, old, new, chunk_size=None):
+        self.chunks = chunks
+        self.indptr = indptr
+        self.offsets = offsets
+        self.old = old
+        self.new = new
+        self.chunk_size = None if chunk_size is None else tuple(int(c) for c in chunk_size)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def create(offsets, old, new, chunk_ids, chunk_size=None):
+        """Entry of the voxels at `offsets`, in chunks `chunk_ids` (of `chunk_size`), grouped by chunk."""
+        order = np.argsort(chunk_ids, kind="stable")
+        chunks, starts = np.unique(np.asarray(chunk_ids)[order], return_index=True)
+        indptr = np.append(starts, len(order)).astype(np.int64)
+        return JournalEntry(
+            chunks.astype(np.int64),
+            indptr,
+            np.asarray(offsets, np.int64)[order],
+            np.asarray(old)[order],
+            np.asarray(new)[order],
+            chunk_size,
+        )
+
+    def save(self, filename):
+        extra = dict() if self.chunk_size is None else dict(chunk_size=np.array(self.chunk_size, np.int64))
+        np.savez(
+            filename, chunks=self.chunks, indptr=self.indptr, offsets=self.offsets, old=self.old, new=self.new, **extra
+        )
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as f:
+            chunk_size = f["chunk_size"] if "chunk_size" in f.files else None
+            return JournalEntry(f["chunks"], f["indptr"], f["offsets"], f["old"], f["new"], chunk_size)
+
+
+__journal_locks__ = dict()
+__journal_locks_lock__ = threading.Lock()
+
+
+def _journal_lock(path):
+    key = os.path.realpath(path)
+    with __journal_locks_lock__:
+        return __journal_locks__.setdefault(key, threading.RLock())
+
+
+class UndoJournal(object):
+    """
+    Undo/redo journal of the dataset in `path` keeping the last `depth`
+    edits, see the module documentation. Operations on the journal of the
+    same dataset are serialized within a process.
+    """
+
+    def __init__(self, path, depth=JOURNAL_DEPTH):
+        self._path = journal_path(path)
+        self._depth = max(int(depth), 0)
+        self._lock = _journal_lock(self._path)
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def _db(self):
+        os.makedirs(self._path, exist_ok=True)
+        filename = os.path.join(self._path, "journal.yaml")
+        if not os.path.isfile(filename):
+            db = AttributeDB.create(filename)
+            db.update(undo=[], redo=[], next=0)
+            db.save()
+        return AttributeDB(filename)
+
+    def _entry_path(self, seq):
+        return os.path.join(self._path, "{:08d}.npz".format(seq))
+
+    def _remove(self, seqs):
+        for seq in seqs:
+            if os.path.isfile(self._entry_path(seq)):
+                os.remove(self._entry_path(seq))
+
+    def record(self, entry):
+        """Pushes the `JournalEntry` of a new edit, which clears the redo stack."""
+        with self._lock:
+            db = self._db()
+            self._remove(db["redo"])
+            undo = list(db["undo"])
+            if self._depth > 0:
+                seq = int(db["next"])
+                entry.save(self._entry_path(seq))
+                undo.append(seq)
+                db["next"] = seq + 1
+            self._remove(undo[: max(len(undo) - self._depth, 0)])
+            db.update(undo=undo[max(len(undo) - self._depth, 0) :], redo=[])
+            db.save()
+
+    def _move(self, source, target):
+        with self._lock:
+            db = self._db()
+            if len(db[source]) == 0:
+                return None
+            seq = db[source][-1]
+            entry = JournalEntry.load(self._entry_path(seq))
+            db[source] = db[source][:-1]
+            db[target] = db[target] + [seq]
+            db.save()
+            return entry
+
+    def undo(self):
+        """Moves the last edit to the redo stack and returns it, or `None`."""
+        return self._move("undo", "redo")
+
+    def redo(self):
+        """Moves the last undone edit back to the undo stack and returns it, or `None`."""
+        return self._move("redo", "undo")
+
+    def sizes(self):
+        """Number of edits that can be undone and redone."""
+        with self._lock:
+            db = self._db()
+            return len(db["undo"]), len(db["redo"])
+
+    def replace(self, value, by):
+        """Replaces `value` by `by` in the recorded values of every edit."""
+        with self._lock:
+            db = self._db()
+            for seq in db["undo"] + db["redo"]:
+                entry = JournalEntry.load(self._entry_path(seq))
+                if (entry.old == value).any() or (entry.new == value).any():
+                    entry.old[entry.old == value] = by
+                    entry.new[entry.new == value] = by
+                    entry.save(self._entry_path(seq))
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self._path, ignore_errors=True)
@@ -0,0 +1,286 @@
+"""
+Multiscale pyramids of datasets for level-of-detail reads.
+
+The pyramid of a dataset is stored next to its chunks, in
+`<dataset>/pyramid/<factor>`, as one `Dataset` per level downsampled by a
+factor of 2, 4, 8... (level 1, 2, 3...). Intensities are downsampled with
+the mean and labels by striding, so that label values are preserved.
+
+Every level stores the stamps of the chunks of the dataset it was built from
+(see `Dataset.chunk_versions`), so that a region whose chunks were written
+since (e.g. by annotating) is computed on the fly from full resolution
+instead of being read from the stale level, until the pyramid is rebuilt.
+
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from loguru import logger
+
+from survos2.config import Config
+from survos2.model.dataset import Dataset, drop_chunk_pool
+
+PYRAMID_DIR = "pyramid"
+PYRAMID_LEVELS = Config["computing.pyramid_levels"]
+PYRAMID_MIN_SIZE = 16
+PYRAMID_VERSIONS = "source_versions.npy"
+
+
+def level_factor(level):
+    return 2 ** int(level)
+
+
+def level_shape(shape, level):
+    factor = level_factor(level)
+    return tuple(int(np.ceil(s / factor)) for s in shape)
+
+
+def downsample_method(dtype):
+    """`mean` for intensities (floats) and `stride` for labels (integers)."""
+    return "mean" if np.issubdtype(np.dtype(dtype), np.floating) else "stride"
+
+
+def downsample(data, factor, method="mean"):
+    """
+    Downsamples `data` by `factor` along every axis. Borders that are not a
+    multiple of `factor` are averaged over the available voxels.
+    """
+    if factor == 1:
+        return data
+    if method == "stride":
+        return data[tuple(slice(None, None, factor) for _ in range(data.ndim))]
+    elif method != "mean":
+        raise ValueError("Unknown downsampling method: {}".format(method))
+    pad = [(0, -s % factor) for s in data.shape]
+    padded = np.pad(data.astype(np.float32, copy=False), pad, mode="edge")
+    shape = []
+    for s in padded.shape:
+        shape += [s // factor, factor]
+    return padded.reshape(shape).mean(axis=tuple(range(1, 2 * data.ndim, 2))).astype(data.dtype)
+
+
+def pyramid_path(path):
+    return os.path.join(path, PYRAMID_DIR)
+
+
+def _versions_array(versions):
+    """`Dataset.chunk_versions` as an `(chunks, 3)` array, `-1` for missing chunks."""
+    return np.array([(-1, -1, -1) if v is None else v for v in versions], np.int64).reshape(-1, 3)
+
+
+def level_current(ds, path, slices=Ellipsis):
+    """
+    Whether the pyramid level stored in `path` was built from the current
+    data of the chunks of `ds` intersecting `slices` (full resolution).
+    """
+    filename = os.path.join(path, PYRAMID_VERSIONS)
+    if not os.path.isfile(filename):
+        return False
+    versions = np.load(filename)
+    if len(versions) != ds.total_chunks:  # e.g. rechunked since
+        return False
+    slices = ds._process_slices(slices)
+    ranges = [range(s.start // c, max(s.start, s.stop - 1) // c + 1) for s, c in zip(slices, ds.chunk_size)]
+    for idx in itertools.product(*ranges):
+        version = ds.chunk_version(idx)
+        if tuple(versions[ds.ravel_chunk_index(idx)]) != ((-1, -1, -1) if version is None else tuple(version)):
+            return False
+    return True
+
+
+def level_version(ds, level):
+    """
+    Stamp of the build of the pyramid `level` of `ds`, which changes when the
+    pyramid is rebuilt, or `None` if it has not been built (and for level 0).
+    """
+    if level == 0 or not isinstance(ds, Dataset):
+        return None
+    try:
+        st = os.stat(os.path.join(pyramid_path(ds._path), str(level_factor(level)), PYRAMID_VERSIONS))
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def open_level(ds, level, slices=Ellipsis):
+    """
+    Returns the `Dataset` of the pyramid `level` of `ds` (`ds` itself for
+    level 0), or `None` if it has not been built or if the chunks of `ds`
+    intersecting the region `slices` (full resolution) changed since.
+    """
+    if level == 0:
+        return ds
+    if not isinstance(ds, Dataset):
+        return None
+    path = os.path.join(pyramid_path(ds._path), str(level_factor(level)))
+    if not Dataset.exists(path) or not level_current(ds, path, slices):
+        return None
+    return Dataset(path, readonly=True)
+
+
+def level_region(ds, level, slices):
+    """
+    Returns `(source, slices)` to read the region `slices` (a slice per
+    axis, in the coordinates of `level`) of the pyramid `level` of `ds`:
+    the `Dataset` of the level and the slices if the level has been built,
+    otherwise the region computed on the fly from full resolution and `None`.
+    """
+    factor = level_factor(level)
+    slices = [slice(*s.indices(n)[:2]) for s, n in zip(slices, level_shape(ds.shape, level))]
+    full = tuple(slice(s.start * factor, min(s.stop * factor, n)) for s, n in zip(slices, ds.shape))
+    lds = open_level(ds, level, full)
+    if lds is not None:
+        return lds, tuple(slices)
+    return downsample(ds[full], factor, downsample_method(ds.dtype)), None
+
+
+def read_level(ds, level, slices):
+    """Reads the region `slices` of the pyramid `level` of `ds`, see `level_region`."""
+    source, slices = level_region(ds, level, slices)
+    return source if slices is None else source[slices]
+
+
+def roi_slices(roi, level=0):
+    """
+    Slices of the region `roi` (`[z0, z1, y0, y1, x0, x1]` in full resolution
+    coordinates) in the coordinates of the pyramid `level`.
+    """
+    factor = level_factor(level)
+    return [slice(int(roi[2 * i]) // factor, -(-int(roi[2 * i + 1]) // factor)) for i in range(len(roi) // 2)]
+
+
+def get_level_slice(ds, slice_idx, order=(0, 1, 2), level=0):
+    """
+    Returns the slice `slice_idx` (a full resolution index) along axis
+    `order[0]` of the pyramid `level` of `ds`, with the remaining axes
+    transposed as in `Dataset.get_slice`.
+    """
+    factor = level_factor(level)
+    idx = slice_idx // factor
+    full = [slice(None)] * ds.ndim
+    full[order[0]] = slice(idx * factor, min((idx + 1) * factor, ds.shape[order[0]]))
+    lds = open_level(ds, level, full)
+    if lds is not None:
+        return lds.get_slice(idx, order)
+    slices = [slice(None)] * ds.ndim
+    slices[order[0]] = slice(idx, idx + 1)
+    return np.transpose(read_level(ds, level, slices), order)[0]
+
+
+def get_level_crop(ds, roi, level=0):
+    """
+    Returns the region `roi` (`[z0, z1, y0, y1, x0, x1]` in full resolution
+    coordinates) of the pyramid `level` of `ds`.
+    """
+    return read_level(ds, level, roi_slices(roi, level))
+
+
+def get_level_volume(ds, level=0):
+    return read_level(ds, level, [slice(None)] * ds.ndim)
+
+
+def build_pyramid(path, levels=PYRAMID_LEVELS, method=None, min_size=PYRAMID_MIN_SIZE):
+    """
+    Builds the pyramid of the dataset in `path`. Each level is computed from
+    the previous one, a slab of chunks at a time, into a temporary directory
+    that atomically replaces the current pyramid when finished.
+    """
+    ds = Dataset(path, readonly=True)
+    ds.close()  # closing writable handles updates the stamps of their chunks
+    versions = _versions_array(ds.chunk_versions())  # before reading, so later writes are seen
+    method = method or downsample_method(ds.dtype)
+    tmp_path = tempfile.mkdtemp(prefix=".pyramid-", dir=path)
+    try:
+        src = ds
+        for level in range(1, levels + 1):
+            shape = level_shape(ds.shape, level)
+            if min(shape) < min_size:
+                break
+            factor = level_factor(level)
+            lds = Dataset.create(
+                os.path.join(tmp_path, str(factor)),
+                shape=shape,
+                dtype=ds.dtype,
+                fillvalue=ds.fillvalue,
+                sparse=ds.sparse,
+                compression=ds.compression,
+                shuffle=ds.shuffle,
+                backend=ds.backend,
+            )
+            # slabs of whole source chunks along the first axis, of even thickness
+            step = src.chunk_size[0] + src.chunk_size[0] % 2
+            for start in range(0, src.shape[0], step):
+                block = downsample(src[start : start + step], 2, method)
+                lds[start // 2 : start // 2 + block.shape[0]] = block
+            lds.set_attr("factor", factor)
+            lds.set_attr("method", method)
+            np.save(os.path.join(lds._path, PYRAMID_VERSIONS), versions)
+            src = lds
+
+        drop_chunk_pool(tmp_path)
+        old_path = None
+        final_path = pyramid_path(path)
+        if os.path.isdir(final_path):
+            old_path = tempfile.mkdtemp(prefix=".pyramid-old-", dir=path)
+            os.rename(final_path, os.path.join(old_path, PYRAMID_DIR))
+        os.rename(tmp_path, final_path)
+        drop_chunk_pool(final_path)
+        if old_path is not None:
+            shutil.rmtree(old_path)
+    except Exception:
+        drop_chunk_pool(tmp_path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        ds.close()
+
+
+def remove_pyramid(path):
+    """Removes the (now stale) pyramid of the dataset in `path`."""
+    final_path = pyramid_path(path)
+    if os.path.isdir(final_path):
+        drop_chunk_pool(final_path)
+        shutil.rmtree(final_path, ignore_errors=True)
+
+
+__builds__ = dict()
+__builds_lock__ = threading.Lock()
+
+
+def schedule_pyramid(path, **kwargs):
+    """
+    Rebuilds the pyramid of the dataset in `path` in a background thread.
+    The current pyramid is removed right away, as it no longer matches the
+    data. If a build of the same dataset is already running, a new one is
+    started once it finishes.
+    """
+    remove_pyramid(path)
+    key = os.path.realpath(path)
+    with __builds_lock__:
+        if key in __builds__:
+            __builds__[key] = kwargs  # pending rebuild
+            return
+        __builds__[key] = kwargs
+
+    def run():
+        while True:
+            with __builds_lock__:
+                params = __builds__[key]
+                __builds__[key] = None
+            try:
+                build_pyramid(path, **params)
+                logger.info("+ Built pyramid of {}".format(path))
+            except Exception as e:
+                logger.warning("Unable to build pyramid of {}: {}".format(path, e))
+            with __builds_lock__:
+                if __builds__[key] is None:
+                    del __builds__[key]
+                    return
+            remove_pyramid(path)
+
+    threading.Thread(target=run, name="survos_pyramid", daemon=True).start()
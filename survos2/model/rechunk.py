@@ -0,0 +1,250 @@
+"""
+Online rechunking of datasets to a new chunk layout.
+
+The chunks of a dataset are stored in the directory of its *layout*: the
+dataset directory itself or `<dataset>/layout-<n>` (the `layout` entry of its
+metadata, see `Dataset.chunk_path`). A dataset is rechunked by copying it,
+with bounded memory, into a new layout next to the current one, which is
+switched to by atomically replacing `dataset.yaml`. Readers keep working
+during the migration: they read the current layout until the switch and
+follow the new one from their next access (see `Dataset.reload`), while the
+previous layout is only removed `RECHUNK_GRACE` seconds later, for the reads
+in flight. Chunks written during the copy are copied again before the switch,
+and the last copy and the switch hold the `layout_lock` of the dataset, so
+writes wait for the switch and then follow the new layout.
+
+Annotation levels are not rechunked: their undo history (the `modified`
+chunk bitmap and the undo journal) is indexed by chunk.
+
+"""
+
+import os
+import re
+import shutil
+import threading
+from itertools import product
+
+import numpy as np
+from loguru import logger
+
+from survos2.config import Config
+from survos2.improc.utils import optimal_chunksize
+from survos2.model.access import access_stats
+from survos2.model.dataset import (
+    CHUNK_REGEXP,
+    NPY_CHUNK_REGEXP,
+    Dataset,
+    DatasetException,
+    ZarrEngine,
+    drop_chunk_pool,
+    layout_lock,
+)
+from survos2.utils import AttributeDB
+
+RECHUNK_MEMORY = Config["computing.rechunk_memory"]
+RECHUNK_GRACE = 60  # seconds the previous layout is kept for the reads in flight
+RECHUNK_PASSES = 3  # copies of the chunks written during the migration
+LAYOUT_REGEXP = re.compile(r"^\.?layout-(?P<n>\d+)$")
+
+
+def copy_block(shape, chunk_size, new_chunk_size, item_size=4, max_memory=RECHUNK_MEMORY):
+    """
+    Shape of the blocks in which a dataset is copied from `chunk_size` to
+    `new_chunk_size` chunks: whole new chunks spanning at least a chunk of
+    the source along every axis, so that source chunks are read a few times
+    at most and new chunks are written once, if it fits in `max_memory` MB,
+    and a single new chunk otherwise.
+    """
+    block = [-(-max(c, n) // n) * n for c, n in zip(chunk_size, new_chunk_size)]
+    block = [min(b, s) for b, s in zip(block, shape)]
+    if np.prod(block, dtype=np.float64) * item_size > max_memory * 2**20:
+        block = list(new_chunk_size)
+    return block
+
+
+def _blocks(shape, block):
+    ranges = [range(0, s, b) for s, b in zip(shape, block)]
+    for starts in product(*ranges):
+        yield tuple(slice(i, min(i + b, s)) for i, b, s in zip(starts, block, shape))
+
+
+def _next_layout(path):
+    names = [m.group("n") for m in map(LAYOUT_REGEXP.match, os.listdir(path)) if m is not None]
+    return "layout-{}".format(max(map(int, names), default=0) + 1)
+
+
+def remove_stale_layouts(path):
+    """Removes the chunks of every layout of the dataset in `path` but the current one."""
+    ds = Dataset(path, readonly=True)
+    for name in os.listdir(path):
+        if LAYOUT_REGEXP.match(name) and name != ds.layout:
+            drop_chunk_pool(os.path.join(path, name))
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    if ds.layout:  # chunks of the original layout, in the dataset directory
+        drop_chunk_pool(path, recursive=False)
+        for entry in os.scandir(path):
+            if CHUNK_REGEXP.match(entry.name) or NPY_CHUNK_REGEXP.match(entry.name):
+                os.remove(entry.path)
+            elif entry.name == ZarrEngine.__store__:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _remove_stale_layouts(path):
+    try:
+        remove_stale_layouts(path)
+    except Exception as e:  # e.g. the dataset was removed meanwhile
+        logger.warning("Unable to remove the previous layouts of {}: {}".format(path, e))
+
+
+def check_rechunk(ds):
+    """Raises a `DatasetException` if the dataset `ds` cannot be rechunked."""
+    if ds.get_metadata("kind") == "level" or ds.has_attr("modified") or ds.has_attr("history"):
+        raise DatasetException(
+            "Dataset '{}' is an annotation level, whose undo history is indexed by chunk.".format(ds._path)
+        )
+
+
+def _copy_changed(ds, new, versions):
+    """Copies the chunks of `ds` changed since `versions` into `new`, returns the current versions."""
+    ds.close()  # closing writable handles updates the stamps of their chunks
+    current = ds.chunk_versions()
+    changed = [i for i, (a, b) in enumerate(zip(versions, current)) if a != b]
+    if len(changed) > 0:
+        logger.debug("Copying {} chunks of {} written during the migration".format(len(changed), ds._path))
+    for flat_idx in changed:
+        block = ds.global_chunk_bounds(ds.unravel_chunk_index(flat_idx))
+        new[block] = ds[block]
+    return current, len(changed)
+
+
+def rechunk_dataset(path, chunks, pattern=None, max_memory=RECHUNK_MEMORY, progress=None):
+    """
+    Rechunks the dataset in `path`, see the module documentation.
+
+    Parameters
+    ----------
+    path: string
+        Path of the dataset.
+    chunks: number or iterable
+        The new chunk size, or the maximum size in MB of the chunks planned by
+        `optimal_chunksize` for the access `pattern`.
+    pattern: None or string
+        See `optimal_chunksize`.
+    max_memory: number
+        Maximum size in MB of the blocks copied at once.
+        Default: `computing.rechunk_memory` in the config file.
+    progress: callable
+        Called with the fraction of the dataset copied so far.
+
+    Returns
+    -------
+    chunk_size: list
+        The new chunk size, which is the current one if nothing was done.
+    """
+    ds = Dataset(path, readonly=True)
+    check_rechunk(ds)
+    item_size = np.dtype(ds.dtype).itemsize
+    if np.isscalar(chunks):
+        chunk_size = list(optimal_chunksize(ds.shape, chunks, item_size=item_size, pattern=pattern))
+    elif len(chunks) != ds.ndim:
+        raise DatasetException("Chunk size {} does not match the dataset shape {}".format(chunks, ds.shape))
+    else:
+        chunk_size = [min(int(c), s) for c, s in zip(chunks, ds.shape)]
+    if chunk_size == list(ds.chunk_size):
+        return chunk_size
+
+    remove_stale_layouts(path)
+    layout = _next_layout(path)
+    tmp_path = os.path.join(path, "." + layout)
+    new = Dataset.create(
+        tmp_path,
+        shape=ds.shape,
+        dtype=ds.dtype,
+        fillvalue=ds.fillvalue,
+        chunks=chunk_size,
+        sparse=ds.sparse,
+        compression=ds.compression,
+        shuffle=ds.shuffle,
+        backend=ds.backend,
+    )
+    logger.info("Rechunking {} from {} to {}".format(path, list(ds.chunk_size), chunk_size))
+    try:
+        with access_stats.paused():
+            ds.close()  # closing writable handles updates the stamps of their chunks
+            versions = ds.chunk_versions()
+            blocks = list(_blocks(ds.shape, copy_block(ds.shape, ds.chunk_size, chunk_size, item_size, max_memory)))
+            for i, block in enumerate(blocks):
+                new[block] = ds[block]
+                if progress is not None:
+                    progress((i + 1) / len(blocks))
+
+            for _ in range(RECHUNK_PASSES):
+                versions, changed = _copy_changed(ds, new, versions)
+                if changed == 0:
+                    break
+
+            # writers wait from the last copy of their chunks until the switch
+            with layout_lock(path).exclusive():
+                _copy_changed(ds, new, versions)
+                new.close()
+                drop_chunk_pool(tmp_path)
+                os.remove(new._db.filename)
+                os.rename(tmp_path, os.path.join(path, layout))
+
+                # the switch: a single atomic replacement of the dataset metadata
+                db = AttributeDB(ds._db.filename, dbtype=ds._db.filename.rsplit(".", 1)[-1])
+                metadata = db[Dataset.__dsname__]
+                metadata.update(chunk_size=chunk_size, chunk_grid=list(new.chunk_grid), layout=layout)
+                db[Dataset.__dsname__] = metadata
+                db.save()
+    except Exception:
+        drop_chunk_pool(tmp_path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        ds.close()
+
+    timer = threading.Timer(RECHUNK_GRACE, _remove_stale_layouts, args=(path,))
+    timer.daemon = True
+    timer.start()
+    return chunk_size
+
+
+__rechunks__ = dict()
+__rechunks_lock__ = threading.Lock()
+
+
+def rechunk_status(path):
+    """Status of the last rechunking of the dataset in `path`, or `None`."""
+    with __rechunks_lock__:
+        status = __rechunks__.get(os.path.realpath(path))
+        return None if status is None else dict(status)
+
+
+def schedule_rechunk(path, chunks, **kwargs):
+    """
+    Rechunks the dataset in `path` (see `rechunk_dataset`) in a background
+    thread and returns its status, see `rechunk_status`.
+    """
+    check_rechunk(Dataset(path, readonly=True))
+    key = os.path.realpath(path)
+    with __rechunks_lock__:
+        if __rechunks__.get(key, {}).get("state") == "running":
+            raise DatasetException("Dataset '{}' is already being rechunked.".format(path))
+        status = __rechunks__[key] = dict(state="running", progress=0.0, chunks=None, error=None)
+
+    def update(**values):
+        with __rechunks_lock__:
+            status.update(values)
+
+    def run():
+        try:
+            chunk_size = rechunk_dataset(path, chunks, progress=lambda p: update(progress=p), **kwargs)
+            update(state="done", progress=1.0, chunks=chunk_size)
+            logger.info("+ Rechunked {} to {}".format(path, chunk_size))
+        except Exception as e:
+            update(state="failed", error=str(e))
+            logger.warning("Unable to rechunk {}: {}".format(path, e))
+
+    threading.Thread(target=run, name="survos_rechunk", daemon=True).start()
+    return dict(status)
@@ -0,0 +1,242 @@
+"""
+Region to voxel inverted index of superregion datasets.
+
+The index of a dataset of superregion labels is stored next to its chunks,
+in `<dataset>/region_index`, as `.npy` files read through memory maps:
+
+- `indptr.npy`: offsets of the voxels of every region in `offsets`, i.e.
+  the voxels of region `r` are `offsets[indptr[r]:indptr[r + 1]]` (CSR),
+- `offsets.npy`: flat voxel offsets (C order) of every region, in chunk
+  order and increasing within a chunk,
+- `bounds.npy`: bounding box of every region, `[z0, y0, x0, z1, y1, x1]`
+  with exclusive ends (empty regions have `z0 > z1`),
+
+and `index.yaml`, with the chunk versions of the dataset it was built from.
+An index whose dataset has been modified since is stale and not used. The
+voxels of a few regions are then found in time proportional to their size,
+instead of comparing every voxel of the volume with every region.
+
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from loguru import logger
+
+from survos2.model.dataset import Dataset, read_array
+from survos2.utils import AttributeDB
+
+INDEX_DIR = "region_index"
+
+
+def index_path(path):
+    return os.path.join(path, INDEX_DIR)
+
+
+class RegionIndex(object):
+    """Inverted index of the voxels of every region of a volume of `shape`."""
+
+    def __init__(self, shape, indptr, offsets, bounds):
+        self.shape = tuple(int(s) for s in shape)
+        self.indptr = indptr
+        self.offsets = offsets
+        self.bounds = bounds
+
+    @property
+    def nr(self):
+        return len(self.indptr) - 1
+
+    def _valid(self, regions):
+        regions = np.unique(np.asarray(regions, np.int64).ravel())
+        return regions[(regions >= 0) & (regions < self.nr)]
+
+    def sizes(self, regions):
+        """Number of voxels of each of `regions`."""
+        regions = np.asarray(regions, np.int64)
+        return np.asarray(self.indptr[regions + 1] - self.indptr[regions])
+
+    def voxels(self, regions, bounds=None):
+        """
+        Sorted flat offsets of the voxels of `regions` (labels without voxels
+        are ignored), only of those regions whose bounding box intersects
+        `bounds` (`[z0, y0, x0, z1, y1, x1]`) if given.
+        """
+        regions = self._valid(regions)
+        if bounds is not None and len(regions) > 0:
+            ndim = len(self.shape)
+            lo, hi = np.asarray(bounds[:ndim]), np.asarray(bounds[ndim:])
+            rb = np.asarray(self.bounds[regions])
+            regions = regions[((rb[:, :ndim] < hi) & (rb[:, ndim:] > lo)).all(axis=1)]
+        parts = [self.offsets[self.indptr[r] : self.indptr[r + 1]] for r in regions]
+        if len(parts) == 0:
+            return np.zeros(0, np.int64)
+        return np.sort(np.concatenate(parts).astype(np.int64))
+
+    def coords(self, regions, bounds=None):
+        """Coordinates, `(voxels, ndim)`, of the voxels of `regions`, see `voxels`."""
+        voxels = self.voxels(regions, bounds=bounds)
+        return np.stack(np.unravel_index(voxels, self.shape), axis=1)
+
+    @staticmethod
+    def load(path, shape):
+        """Opens the index stored in `path` through memory maps."""
+        names = ("indptr", "offsets", "bounds")
+        return RegionIndex(shape, *[np.load(os.path.join(path, n + ".npy"), mmap_mode="r") for n in names])
+
+
+def _blocks(ds):
+    for flat_idx in range(ds.total_chunks):
+        yield ds.global_chunk_bounds(ds.unravel_chunk_index(flat_idx))
+
+
+def _block_offsets(slices, shape):
+    axes = np.ix_(*[np.arange(s.start, s.stop, dtype=np.int64) for s in slices])
+    offsets = np.zeros([s.stop - s.start for s in slices], np.int64)
+    for axis, coords in enumerate(axes):
+        offsets += coords * int(np.prod(shape[axis + 1 :], dtype=np.int64))
+    return offsets.ravel()
+
+
+def _sorted_labels(ds, slices):
+    labels = np.asarray(read_array(ds, slices)).ravel().astype(np.int64)
+    order = np.argsort(labels, kind="stable")
+    regions, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    return order, regions, starts, counts
+
+
+def compute_region_index(ds, path):
+    """
+    Computes the `RegionIndex` of the `Dataset` `ds` into `path`, with two
+    passes over its chunks: one counting the voxels and bounding box of
+    every region and one scattering the voxel offsets into the index. Only a
+    chunk is held in memory, the offsets are written to a memory map.
+    """
+    shape = tuple(ds.shape)
+    ndim = len(shape)
+    counts = np.zeros(0, np.int64)
+    bounds = np.zeros((0, 2 * ndim), np.int64)
+
+    for slices in _blocks(ds):
+        order, regions, starts, rcounts = _sorted_labels(ds, slices)
+        if len(regions) == 0:
+            continue
+        nr = int(regions[-1]) + 1
+        if nr > len(counts):
+            extra = nr - len(counts)
+            counts = np.pad(counts, (0, extra))
+            empty = np.tile(np.r_[np.asarray(shape), np.zeros(ndim, np.int64)], (extra, 1))
+            bounds = np.concatenate([bounds, empty])
+        counts[regions] += rcounts
+        coords = np.unravel_index(order, [s.stop - s.start for s in slices])
+        for axis, (c, s) in enumerate(zip(coords, slices)):
+            lo, hi = np.minimum.reduceat(c, starts) + s.start, np.maximum.reduceat(c, starts) + s.start + 1
+            bounds[regions, axis] = np.minimum(bounds[regions, axis], lo)
+            bounds[regions, ndim + axis] = np.maximum(bounds[regions, ndim + axis], hi)
+
+    indptr = np.zeros(len(counts) + 1, np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    dtype = np.uint32 if np.prod(shape, dtype=np.float64) < 2**32 else np.int64
+    os.makedirs(path, exist_ok=True)
+    offsets = np.lib.format.open_memmap(
+        os.path.join(path, "offsets.npy"), mode="w+", dtype=dtype, shape=(int(indptr[-1]),)
+    )
+    cursor = indptr[:-1].copy()
+    for slices in _blocks(ds):
+        order, regions, starts, rcounts = _sorted_labels(ds, slices)
+        if len(regions) == 0:
+            continue
+        dest = np.repeat(cursor[regions] - starts, rcounts) + np.arange(len(order))
+        offsets[dest] = _block_offsets(slices, shape)[order]
+        cursor[regions] += rcounts
+    offsets.flush()
+    del offsets
+
+    np.save(os.path.join(path, "indptr.npy"), indptr)
+    np.save(os.path.join(path, "bounds.npy"), bounds)
+    return RegionIndex.load(path, shape)
+
+
+def build_region_index(path):
+    """
+    Builds the region index of the dataset in `path` into a temporary
+    directory that atomically replaces the current index when finished.
+    """
+    ds = Dataset(path, readonly=True)
+    tmp_path = tempfile.mkdtemp(prefix=".region_index-", dir=path)
+    try:
+        ds.close()  # closing writable handles updates the stamps of their chunks
+        versions = ds.chunk_versions()
+        index = compute_region_index(ds, tmp_path)
+        db = AttributeDB.create(os.path.join(tmp_path, "index"))
+        db.update(shape=list(ds.shape), regions=index.nr, versions=versions)
+        db.save()
+
+        old_path = None
+        final_path = index_path(path)
+        if os.path.isdir(final_path):
+            old_path = tempfile.mkdtemp(prefix=".region_index-old-", dir=path)
+            os.rename(final_path, os.path.join(old_path, INDEX_DIR))
+        os.rename(tmp_path, final_path)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        ds.close()
+    logger.debug("Built the index of {} regions of {}".format(index.nr, path))
+
+
+def load_region_index(ds):
+    """
+    Returns the `RegionIndex` of the `Dataset` `ds`, or `None` if it has not
+    been built or is stale.
+    """
+    if not isinstance(ds, Dataset):
+        return None
+    path = index_path(ds._path)
+    try:
+        db = AttributeDB(os.path.join(path, "index"))
+        index = RegionIndex.load(path, db["shape"])
+    except (OSError, KeyError, ValueError):
+        return None
+    if tuple(db["shape"]) != tuple(ds.shape) or db["versions"] != ds.chunk_versions():
+        return None
+    return index
+
+
+__builds__ = dict()
+__builds_lock__ = threading.Lock()
+
+
+def schedule_region_index(path):
+    """
+    (Re)builds the region index of the dataset in `path` in a background
+    thread. If a build of the same dataset is already running, a new one is
+    started once it finishes.
+    """
+    key = os.path.realpath(path)
+    with __builds_lock__:
+        if key in __builds__:
+            __builds__[key] = True  # pending rebuild
+            return
+        __builds__[key] = True
+
+    def run():
+        while True:
+            with __builds_lock__:
+                __builds__[key] = False
+            try:
+                build_region_index(path)
+                logger.info("+ Built region index of {}".format(path))
+            except Exception as e:
+                logger.warning("Unable to build the region index of {}: {}".format(path, e))
+            with __builds_lock__:
+                if not __builds__[key]:
+                    del __builds__[key]
+                    return
+
+    threading.Thread(target=run, name="survos_region_index", daemon=True).start()
@@ -4,8 +4,9 @@ import shutil
 import numpy as np
 import tempfile
 
+from survos2.config import Config
 from survos2.utils import check_relpath
-from survos2.model.dataset import Dataset
+from survos2.model.dataset import Dataset, drop_chunk_pool
 from survos2.model.model import DataModel
 
 from loguru import logger
@@ -79,6 +80,7 @@ class Workspace(object):
         Workspace(path).delete()
 
     def delete(self):
+        drop_chunk_pool(self._path)
         shutil.rmtree(self._path)
 
     @staticmethod
@@ -168,6 +170,7 @@ class Workspace(object):
             raise WorkspaceException("Session '{}' does not exists.".format(session))
         # Update filesystem
         path = self.genpath(session)
+        drop_chunk_pool(path)
         shutil.rmtree(path)
 
     def has_session(self, session):
@@ -184,7 +187,7 @@ class Workspace(object):
 
         chunks = DataModel.g.CHUNK_SIZE if DataModel.g.CHUNK_DATA else None
         path = self.genpath(self.__dsname__)
-        Dataset.create(path, data=data_fname, chunks=chunks)
+        Dataset.create(path, data=data_fname, chunks=chunks, backend=Config["model.backend"])
 
         # self.add_session('default')
 
@@ -199,7 +202,18 @@ class Workspace(object):
         fillvalue=0,
         chunks=None,
         shape=None,
+        compression=None,
+        shuffle=None,
     ):
+        """
+        Creates a new dataset in `session`. If `compression` is `None` the
+        chunk compression configured for the dataset's group (e.g.
+        `annotations`) in `computing.group_compression` is used. Datasets
+        use the same storage backend as the workspace data, or the one
+        configured for their group in `model.group_backend` if they are not
+        compressed, e.g. `npy` for features read through memory maps.
+        """
+        group = dataset_name.split("/")[0]
         dataset_name = dataset_name.replace("/", os.path.sep)
 
         if self.has_dataset(dataset_name, session=session):
@@ -212,6 +226,13 @@ class Workspace(object):
         chunk_size = chunks or metadata["chunk_size"]
         dtype = np.dtype(dtype).name
         path = self.genpath(session, dataset_name)
+        if compression is None:
+            compression = Config["computing.group_compression"].get(group, Config["computing.compression"])
+        if shuffle is None:
+            shuffle = Config["computing.compression_shuffle"]
+        backend = metadata.get("backend", "hdf5")
+        if compression in (None, "", "none"):
+            backend = Config["model.group_backend"].get(group, backend)
 
         return Dataset.create(
             path,
@@ -219,6 +240,9 @@ class Workspace(object):
             dtype=dtype,
             chunks=chunk_size,
             fillvalue=fillvalue,
+            compression=compression,
+            shuffle=shuffle,
+            backend=backend,
             database=DataModel.g.DATABASE,
         )
 
@@ -229,7 +253,7 @@ class Workspace(object):
                 "Dataset '{}::{}' does not exist.".format(session, dataset_name)
             )
         path = self.genpath(session, dataset_name)
-        shutil.rmtree(path)
+        Dataset.remove(path)
 
     def has_dataset(self, dataset_name, session="default"):
         # logger.debug(f'has_dataset {dataset_name} for session {session}')
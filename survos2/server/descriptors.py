@@ -0,0 +1,185 @@
+"""
+Superregion descriptors accumulated chunk by chunk.
+
+The descriptors of `superregion_factory` (`rmeans` and `rstats`) need the
+features of every voxel stacked into a `(voxels, features)` matrix.
+`RegionMoments` computes the same descriptors from per-superregion counts,
+sums and second moments accumulated over blocks of the supervoxel and
+feature volumes (arrays or workspace datasets, read chunk by chunk), so
+that the memory used is proportional to the number of superregions and
+the size of a block, not to voxels times features.
+
+"""
+
+import numpy as np
+from loguru import logger
+
+from survos2.config import Config
+from survos2.improc.utils import optimal_chunksize
+from survos2.model.dataset import read_array
+
+CHUNK_SIZE = Config["computing.chunk_size"]
+DESCRIPTORS = ("Mean", "Covar", "Sigma Set")
+
+
+def _blocks(shape, block):
+    grid = [range(0, s, b) for s, b in zip(shape, block)]
+    for starts in np.ndindex(*[len(g) for g in grid]):
+        yield tuple(slice(g[i], min(g[i] + b, s)) for g, i, b, s in zip(grid, starts, block, shape))
+
+
+class RegionMoments(object):
+    """
+    Per-superregion voxel counts, feature sums and, if `second_order`, sums
+    of the pairwise feature products, accumulated with `update`. Features
+    are shifted by their mean in the first block before accumulating, which
+    keeps the covariances accurate for features far from zero.
+    """
+
+    def __init__(self, nfeatures, nr=0, second_order=False):
+        self.nfeatures = int(nfeatures)
+        self.second_order = second_order
+        self._pairs = np.triu_indices(self.nfeatures)
+        self._shift = None
+        self.counts = np.zeros(nr, np.int64)
+        self.sums = np.zeros((nr, self.nfeatures))
+        self.products = np.zeros((nr, len(self._pairs[0]))) if second_order else None
+
+    @property
+    def nr(self):
+        return len(self.counts)
+
+    def _grow(self, nr):
+        pad = nr - self.nr
+        self.counts = np.pad(self.counts, (0, pad))
+        self.sums = np.pad(self.sums, ((0, pad), (0, 0)))
+        if self.second_order:
+            self.products = np.pad(self.products, ((0, pad), (0, 0)))
+
+    def update(self, regions, features):
+        """
+        Accumulates a block of the supervoxel volume `regions` and the blocks
+        of the same region of every feature in `features`.
+        """
+        R = np.asarray(regions).ravel().astype(np.intp, copy=False)
+        if R.size == 0:
+            return
+        if R.max() >= self.nr:
+            self._grow(int(R.max()) + 1)
+        X = [np.asarray(f, np.float64).ravel() for f in features]
+        if len(X) != self.nfeatures:
+            raise ValueError("Expected {} features, got {}".format(self.nfeatures, len(X)))
+        if self._shift is None:
+            self._shift = np.array([x.mean() for x in X])
+        X = [x - s for x, s in zip(X, self._shift)]
+
+        self.counts += np.bincount(R, minlength=self.nr)
+        for k, x in enumerate(X):
+            self.sums[:, k] += np.bincount(R, weights=x, minlength=self.nr)
+        if self.second_order:
+            for p, (j, k) in enumerate(zip(*self._pairs)):
+                self.products[:, p] += np.bincount(R, weights=X[j] * X[k], minlength=self.nr)
+
+    def _centered_means(self):
+        n = np.maximum(self.counts, 1)[:, None]
+        return self.sums / n
+
+    def means(self):
+        """Mean features of every superregion, as `rmeans` (`0` for empty ones)."""
+        means = self._centered_means()
+        if self._shift is not None:
+            means[self.counts > 0] += self._shift
+        return means.astype(np.float32)
+
+    def covariances(self):
+        """Covariance matrices of the features of every superregion, as `rstats`."""
+        if not self.second_order:
+            raise ValueError("Covariances require the second order moments.")
+        n = np.maximum(self.counts, 1)[:, None]
+        centered = self._centered_means()
+        j, k = self._pairs
+        upper = self.products / n - centered[:, j] * centered[:, k]
+        covars = np.zeros((self.nr, self.nfeatures, self.nfeatures))
+        covars[:, j, k] = upper
+        covars[:, k, j] = upper
+        return covars.astype(np.float32)
+
+    def descriptors(self, desc_type="Mean"):
+        """
+        Superregion descriptors of `desc_type`, equal to those computed by
+        `superregion_factory` on the stacked features.
+        """
+        if desc_type not in DESCRIPTORS:
+            raise ValueError("Unknown descriptor type {}, expected one of {}".format(desc_type, DESCRIPTORS))
+        means = self.means()
+        if desc_type == "Mean":
+            return means
+
+        covars = self.covariances()
+        if desc_type == "Sigma Set":
+            # Add small constant to covars to make them positive-definite
+            covars += np.eye(self.nfeatures, dtype=np.float32)[None, ...] * 1e-5
+            covars = np.linalg.cholesky(covars) * np.sqrt(self.nfeatures)
+            y1, x1 = np.tril_indices(self.nfeatures, k=-1)
+            y2, x2 = np.triu_indices(self.nfeatures, k=1)
+            covars[:, y2, x2] = covars[:, y1, x1]
+        covars += means[:, :, None]
+        return covars.reshape(self.nr, -1)
+
+
+def region_moments(supervoxels, features, second_order=False, nr=None, block=None):
+    """
+    Accumulates the `RegionMoments` of the supervoxel volume `supervoxels`
+    over the list of feature volumes `features` (arrays or `Dataset`s),
+    block by block.
+
+    Parameters
+    ----------
+    supervoxels: numpy.ndarray or Dataset
+        The superregion label of every voxel.
+    features: list
+        Feature volumes, of the same shape as `supervoxels`.
+    second_order: bool
+        Whether to accumulate the second moments, needed by the `Covar` and
+        `Sigma Set` descriptors.
+    nr: int
+        Number of superregions, otherwise one more than the maximum label.
+    block: iterable
+        Shape of the blocks read at once. Default: the chunks of the first
+        dataset, or blocks of `computing.chunk_size` MB for arrays.
+
+    Returns
+    -------
+    moments: RegionMoments
+    """
+    shape = tuple(supervoxels.shape)
+    for f in features:
+        if tuple(f.shape) != shape:
+            raise ValueError("Feature of shape {} does not match the superregions {}".format(f.shape, shape))
+    if block is None:
+        chunked = [d for d in list(features) + [supervoxels] if hasattr(d, "chunk_size")]
+        if chunked:
+            block = chunked[0].chunk_size
+        else:
+            block = optimal_chunksize(shape, CHUNK_SIZE, item_size=4 * (len(features) + 1))
+
+    moments = RegionMoments(len(features), nr=nr or 0, second_order=second_order)
+    nblocks = 0
+    for slices in _blocks(shape, block):
+        moments.update(read_array(supervoxels, slices), [read_array(f, slices) for f in features])
+        nblocks += 1
+    logger.debug(
+        "Accumulated the moments of {} superregions and {} features in {} blocks".format(
+            moments.nr, len(features), nblocks
+        )
+    )
+    return moments
+
+
+def region_descriptors(supervoxels, features, desc_type="Mean", nr=None, block=None):
+    """
+    Descriptors of `desc_type` (`Mean`, `Covar` or `Sigma Set`) of every
+    superregion, computed block by block, see `region_moments`.
+    """
+    moments = region_moments(supervoxels, features, second_order=desc_type != "Mean", nr=nr, block=block)
+    return moments.descriptors(desc_type)
@@ -1,5 +1,8 @@
 import math
 import numbers
+import threading
+from contextlib import contextmanager
+
 import numpy as np
 
 from skimage.filters import gaussian
@@ -76,6 +79,28 @@ def gaussian_blur_t(img_t: torch.Tensor, sigma, device=None):
     return output_t
 
 
+__shared__ = threading.local()
+
+
+@contextmanager
+def shared_gaussian(block):
+    """Within the context, the Gaussian blurs of `block` computed with
+    `gaussian_blur_kornia` are computed once per sigma and reused, so that the
+    filters of a filter bank applied to the same block share them. The shared
+    results are readonly.
+
+    Only blurs of `block` itself are shared (Gaussian blur, difference of
+    Gaussians, Hessian based filters): the structure tensor blurs products of
+    gradients and the laplacian smooths with `skimage.filters.gaussian`, so
+    they compute their own.
+    """
+    __shared__.block, __shared__.blurs = block, dict()
+    try:
+        yield
+    finally:
+        __shared__.block = __shared__.blurs = None
+
+
 def gaussian_blur_kornia(img: np.ndarray, sigma, device=None):
     """Gaussian blur using Kornia Filter3D
 
@@ -92,11 +117,20 @@ def gaussian_blur_kornia(img: np.ndarray, sigma, device=None):
         filtered numpy array
     """
 
+    shared = getattr(__shared__, "block", None) is img
+    if shared:
+        key = tuple(np.ravel(sigma).tolist())
+        if key in __shared__.blurs:
+            return __shared__.blurs[key]
+
     img_t = kornia.utils.image_to_tensor(np.array(img)).float().unsqueeze(0).unsqueeze(0)
     output = gaussian_blur_t(img_t, sigma, device=DataModel.g.device)
     # print(f"Calculating gaussian blur on device {DataModel.g.device}")
     output: np.ndarray = kornia.tensor_to_image(output.squeeze(0).squeeze(0).float())
 
+    if shared:
+        output.setflags(write=False)
+        __shared__.blurs[key] = output
     return output
 
 
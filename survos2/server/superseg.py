@@ -31,6 +31,7 @@ from sklearn.svm import SVC
 from survos2.improc.segmentation._qpbo import solve_aexpansion, solve_binary
 from survos2.improc.segmentation.appearance import refine
 from survos2.improc.segmentation.mappings import rmeans
+from survos2.server.descriptors import region_moments
 from survos2.server.features import features_factory
 from survos2.server.model import SRData, SRPrediction
 from survos2.server.region_labeling import rlabels
@@ -155,7 +156,7 @@ def train_and_classify_regions(
         (volume, volume, volume) -- tuple of raw prediction, prediction mapped to labels and confidence map
     """
 
-    logger.debug(f"Feature stack: {features_stack.shape}")
+    logger.debug(f"Superregion descriptors: {sr.supervoxel_features.shape}")
     logger.debug(f"Using annotation volume of shape {annotation_volume.shape}")
 
     Yr = rlabels(
@@ -225,37 +226,43 @@ def prepare_rag_and_features(
 def sr_predict(
     supervoxel_image: np.ndarray,  # Supervoxel label image
     anno_image: np.ndarray,  # Annotation label image
-    feature_images: List[np.ndarray],  # List of feature volumes
+    feature_images: List[np.ndarray],  # List of feature volumes or datasets
     mask: Optional[np.ndarray],
     superseg_cfg: dict,
     refine: bool,
     lam: float,  # lambda parameter to MRF Refinement
 ) -> np.ndarray:  # Volume of predicted region labels
-    """Region classification combined with MRF Refinement"""
+    """Region classification combined with MRF Refinement
 
-    feats = features_factory(feature_images)
-    logger.debug(f"Number of features calculated: {len(feats.features_stack)}")
-    sr = superregion_factory(supervoxel_image.astype(np.uint32), feats.features_stack)
-    srprediction = train_and_classify_regions(
-        feats.features_stack, anno_image.astype(np.uint16), sr, mask, superseg_cfg
-    )
+    The superregion descriptors are accumulated chunk by chunk from the feature volumes,
+    without stacking them, so that feature datasets are never loaded as a whole.
+    """
+
+    supervoxel_image = np.asarray(supervoxel_image).astype(np.uint32)
+    moments = region_moments(supervoxel_image, feature_images)
+    logger.debug(f"Calculated the descriptors of {moments.nr} superregions from {moments.nfeatures} features")
+    sr = superregion_factory(supervoxel_image, None, descriptors=moments.descriptors("Mean"))
+    srprediction = train_and_classify_regions(None, anno_image.astype(np.uint16), sr, mask, superseg_cfg)
 
     prob_map = srprediction.prob_map
 
     if refine:
-        prob_map = mrf_refinement(srprediction.P, supervoxel_image, feats.features_stack, lam=lam)
+        prob_map = mrf_refinement(
+            srprediction.P, supervoxel_image, None, lam=lam, supervoxel_features=sr.supervoxel_features
+        )
         logger.debug(f"Calculated MRF Refinement")
 
     return prob_map, srprediction.conf_map
 
 
-def mrf_refinement(P, supervoxel_vol, features_stack, lam=0.5, gamma=False):
+def mrf_refinement(P, supervoxel_vol, features_stack, lam=0.5, gamma=False, supervoxel_features=None):
 
     from survos2.improc.regions.rag import create_rag
 
     try:
         supervoxel_vol = np.array(supervoxel_vol).astype(np.uint32)
-        supervoxel_features = rmeans(features_stack.astype(np.float32), supervoxel_vol)
+        if supervoxel_features is None:
+            supervoxel_features = rmeans(features_stack.astype(np.float32), supervoxel_vol)
         supervoxel_rag = create_rag(np.array(supervoxel_vol).astype(np.uint32), connectivity=26)
 
         unary = (-np.ma.log(P["probs"])).filled()
@@ -86,16 +86,22 @@ def superregion_factory(
     supervoxel_vol: np.ndarray,
     features_stack: np.ndarray,
     desc_type="Mean",
+    descriptors: np.ndarray = None,
 ) -> SRData:
+    """Bundle the supervoxels, their descriptors of `desc_type` computed from
+    the stacked features (or the precomputed `descriptors`, see
+    `survos2.server.descriptors`) and their region adjacency graph as SRData.
+    """
 
     supervoxel_vol = np.array(supervoxel_vol).astype(np.uint32, copy=True)
 
-    if desc_type == "Mean":
-        descriptors = rmeans(features_stack, supervoxel_vol.astype(np.uint32))
-    elif desc_type == "Covar":
-        descriptors = rstats(features_stack, supervoxel_vol, mode="add", norm=None)
-    elif desc_type == "Sigma Set":
-        descriptors = rstats(features_stack, supervoxel_vol, mode="add", sigmaset=True, norm=None)
+    if descriptors is None:
+        if desc_type == "Mean":
+            descriptors = rmeans(features_stack, supervoxel_vol.astype(np.uint32))
+        elif desc_type == "Covar":
+            descriptors = rstats(features_stack, supervoxel_vol, mode="add", norm=None)
+        elif desc_type == "Sigma Set":
+            descriptors = rstats(features_stack, supervoxel_vol, mode="add", sigmaset=True, norm=None)
 
     logger.debug(f"Finished calculating superregion descriptors of shape {descriptors.shape}")
 
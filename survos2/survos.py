@@ -6,6 +6,7 @@ Service and HTTP class taken from Hug
 
 import re
 
+import numpy as np
 import hug
 from hug import _empty as empty
 from hug.defaults import input_format
@@ -177,12 +178,15 @@ class HTTP(Service):
         kwargs = {"json" if json_transport else "params": params}
         # kwargs = params
         response = self.session.request(
-            method, self.endpoint + url.format(url_params), headers=headers, **kwargs
+            method, self.endpoint + url.format(url_params), headers=headers, stream=True, **kwargs
         )
-        data = BytesIO(response.content)
         content_type, content_params = parse_content_type(response.headers.get("content-type", ""))
-        if content_type in input_format:
-            data = input_format[content_type](data, **content_params)
+        if content_type == "application/octet-stream" and "X-Array-Dtype" in response.headers:
+            data = read_array_stream(response)
+        else:
+            data = BytesIO(response.content)
+            if content_type in input_format:
+                data = input_format[content_type](data, **content_params)
 
         if response.status_code in self.raise_on:
             raise requests.HTTPError(
@@ -192,6 +196,28 @@ class HTTP(Service):
         return Response(data, response.status_code, response.headers)
 
 
+def read_array_stream(response, block_size=2**20):
+    """
+    Reads an array streamed as raw bytes (see `survos2.api.utils.array_response`)
+    directly into its final buffer, without intermediate copies of the whole
+    payload. Returns it in the same form as `encode_numpy`, so it can be
+    passed to `decode_numpy`.
+    """
+    dtype = response.headers["X-Array-Dtype"]
+    shape = tuple(int(s) for s in response.headers["X-Array-Shape"].split(",") if s)
+    data = np.empty(shape, dtype=dtype)
+    buffer = memoryview(data.reshape(-1).view(np.uint8))
+    offset = 0
+    for block in response.iter_content(chunk_size=block_size):
+        buffer[offset : offset + len(block)] = block
+        offset += len(block)
+    if offset != data.nbytes:
+        raise requests.HTTPError(
+            "Incomplete array received: {} of {} bytes".format(offset, data.nbytes)
+        )
+    return dict(data=data, dtype=dtype, shape=shape)
+
+
 def run_command(plugin, command, uri=None, json_transport=False, **kwargs):
     if uri is None:
         # same as Launcher.run
@@ -8,6 +8,7 @@ import base64
 import numpy as np
 
 import io
+import threading
 import time
 import logging
 from loguru import logger
@@ -31,37 +32,124 @@ def encode_numpy(ndarray):
 
 
 def decode_numpy(dictarray):
-    data = base64.b64decode(dictarray.pop("data"))
+    data = dictarray.pop("data")
+    if isinstance(data, np.ndarray):  # streamed as raw bytes, already decoded
+        return data
+    data = base64.b64decode(data)
     data = np.frombuffer(data, dtype=dictarray["dtype"])
     data.shape = dictarray["shape"]
     return data
 
 
-def encode_numpy_slice(ndarray, convert_float=True):
-    ndarray = ndarray.copy(order="C")
+# Slice codecs, in the order they are tried when negotiating:
+#  - lz4: raw bytes compressed with lz4 (requires the `lz4` package), lossless
+#  - raw: raw bytes, lossless
+#  - png: 16-bit PNG, lossless for integer slices with a value range < 2**16
+#  - webp: lossless WebP of the 16-bit slice packed in two channels, as `png`
+#  - jpeg: 8-bit JPEG, lossy (legacy)
+# The 16-bit codecs quantize float slices to their value range.
+SLICE_CODECS = ("lz4", "raw", "png", "webp", "jpeg")
+
+
+def _has_lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        return False
+    return True
+
+
+def select_slice_codec(ndarray, codecs="jpeg"):
+    """
+    Returns the first of the (comma separated) `codecs` that is available
+    and can encode `ndarray`, falling back to `raw`.
+    """
+    if isinstance(codecs, str):
+        codecs = codecs.split(",")
+    for codec in (c.strip().lower() for c in codecs):
+        if codec not in SLICE_CODECS:
+            continue
+        if codec == "lz4" and not _has_lz4():
+            continue
+        if codec in ("png", "webp") and np.issubdtype(ndarray.dtype, np.integer):
+            if ndarray.size and int(ndarray.max()) - int(ndarray.min()) >= 2**16:
+                continue
+        return codec
+    return "raw"
+
+
+def _quantize16(ndarray):
+    vmin = float(ndarray.min()) if ndarray.size else 0.0
+    vmax = float(ndarray.max()) if ndarray.size else 0.0
+    if np.issubdtype(ndarray.dtype, np.integer) or ndarray.dtype == bool:
+        data = ndarray.astype(np.int64) - int(vmin)
+    else:
+        data = np.round((ndarray - vmin) * (65535.0 / ((vmax - vmin) or 1.0)))
+    return data.astype(np.uint16), vmin, vmax
+
+
+def _dequantize16(data, dtype, vmin, vmax):
+    if np.issubdtype(np.dtype(dtype), np.integer) or np.dtype(dtype) == bool:
+        return (data.astype(np.int64) + int(vmin)).astype(dtype)
+    return (data * (((vmax - vmin) or 1.0) / 65535.0) + vmin).astype(dtype)
+
+
+def encode_numpy_slice(ndarray, convert_float=True, codec="jpeg"):
+    """
+    Encodes a 2D slice for transport with the first available of the
+    (comma separated) `codec`s, see `SLICE_CODECS`. All the codecs except
+    `jpeg` keep the dtype and value range of the slice.
+    """
+    ndarray = np.ascontiguousarray(ndarray)
     dtype = np.dtype(ndarray.dtype).name
+    codec = select_slice_codec(ndarray, codec)
+    result = dict(dtype=dtype, shape=ndarray.shape, codec=codec)
     output = io.BytesIO()
-    if convert_float:
+    if codec == "lz4":
+        import lz4.frame
+
+        output.write(lz4.frame.compress(ndarray.tobytes()))
+    elif codec == "raw":
+        output.write(ndarray.tobytes())
+    elif codec in ("png", "webp"):
+        data, result["vmin"], result["vmax"] = _quantize16(ndarray)
+        if codec == "png":
+            with Image.fromarray(data) as im:
+                im.save(output, format="PNG", compress_level=1)
+        else:
+            rgb = np.zeros(data.shape + (3,), np.uint8)
+            rgb[..., 0] = data >> 8
+            rgb[..., 1] = data & 0xFF
+            with Image.fromarray(rgb) as im:
+                im.save(output, format="WEBP", lossless=True, quality=0, method=0)
+    elif convert_float:
         with Image.fromarray(img_as_ubyte(ndarray)) as im:
             im.save(output, format="JPEG")
     else:
         with Image.fromarray(ndarray) as im:
             im.save(output, format="JPEG")
-    output.seek(0)
-    # data = base64.b64encode(output.read())
-    data = output.read()
-    data = base64.b64encode(data)
-    return dict(data=data, dtype=dtype, shape=ndarray.shape)
+    result["data"] = base64.b64encode(output.getvalue())
+    return result
 
 
 def decode_numpy_slice(dictarray):
-    # data = dictarray.pop("data")
     data = base64.b64decode(dictarray.pop("data"))
-    # print(data.shape)
+    codec = dictarray.get("codec", "jpeg")
+    shape = tuple(dictarray["shape"])
+    if codec == "lz4":
+        import lz4.frame
+
+        return np.frombuffer(lz4.frame.decompress(data), dtype=dictarray["dtype"]).reshape(shape)
+    elif codec == "raw":
+        return np.frombuffer(data, dtype=dictarray["dtype"]).reshape(shape)
+    elif codec in ("png", "webp"):
+        with Image.open(io.BytesIO(data), formats=[codec.upper()]) as im:
+            data = np.asarray(im)
+        if codec == "webp":
+            data = (data[..., 0].astype(np.uint16) << 8) | data[..., 1]
+        return _dequantize16(data.astype(np.uint16), dictarray["dtype"], dictarray["vmin"], dictarray["vmax"])
     data = io.BytesIO(data)
     data = Image.open(data, formats=["JPEG"])
-    # data = np.frombuffer(data, dtype=dictarray["dtype"])
-    # data.shape = dictarray["shape"]
     data = np.asarray(data)
     data = img_as_float(data)
     return data
@@ -236,12 +324,20 @@ class AttributeDB(dict):
             return False
 
     def save(self, filename=None):
+        # written to a temporary file that atomically replaces the database,
+        # so that concurrent readers never see a partially written file
         filename = filename or self.filename
-        with open(filename, "w") as handle:
-            if self.use_yaml:
-                yaml.dump(dict(self), handle, indent=4, explicit_start=True, explicit_end=True)
-            else:
-                json.dump(dict(self), handle, sort_keys=True, indent=4)
+        tmp_filename = "{}.{}-{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_filename, "w") as handle:
+                if self.use_yaml:
+                    yaml.dump(dict(self), handle, indent=4, explicit_start=True, explicit_end=True)
+                else:
+                    json.dump(dict(self), handle, sort_keys=True, indent=4)
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
 
 
 def _canpickle(obj):
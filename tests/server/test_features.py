@@ -175,6 +175,24 @@ class Tests(object):
                 == '{"001_gaussian_blur":{"kind":"gaussian_blur","name":"001_gblur","sigma":[1],"source":"__data__","id":"001_gaussian_blur"},"002_gaussian_blur":{"kind":"gaussian_blur","name":"gaussian_blur","sigma":[2],"source":"__data__","id":"002_gaussian_blur"}}'
             )
 
+    @pytest.mark.asyncio
+    async def test_get_volume_streaming(self, datamodel, monkeypatch):
+        import survos2.api.utils
+
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            DataModel = datamodel
+            src = DataModel.g.dataset_uri("__data__", None)
+            with DatasetManager(src, out=None, dtype="float32", fillvalue=0) as DM:
+                src_arr = DM.sources[0][:]
+
+            monkeypatch.setattr(survos2.api.utils, "STREAM_THRESHOLD", 0)
+            params = {"workspace": "testworkspace_tmp1", "src": src}
+            response = await ac.get("/features/get_volume", params=params)
+            assert response.headers["content-type"] == "application/octet-stream"
+            shape = tuple(int(s) for s in response.headers["x-array-shape"].split(","))
+            data = np.frombuffer(response.content, dtype=response.headers["x-array-dtype"])
+            assert np.array_equal(data.reshape(shape), src_arr)
+
 
 if __name__ == "__main__":
     pytest.main()
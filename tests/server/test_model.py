@@ -1,7 +1,9 @@
+import os
 from survos2.model.workspace import Workspace
 from survos2.data_io import dataset_from_uri
 from survos2.config import Config
 import dask.array as da
+import numpy as np
 from survos2.improc.utils import optimal_chunksize
 
 
@@ -27,3 +29,782 @@ def test_datamodel():
     assert ws.has_session("newsesh")
 
     ws.delete()
+
+
+def test_dataset_get_slice(tmp_path):
+    from itertools import permutations
+    from survos2.model.dataset import Dataset
+
+    data = np.random.rand(9, 11, 7).astype(np.float32)
+    ds = Dataset.create(str(tmp_path / "ds"), data=data, chunks=(4, 4, 4))
+
+    for order in permutations(range(3)):
+        data_t = np.transpose(data, order)
+        for slice_idx in (0, data_t.shape[0] // 2, data_t.shape[0] - 1):
+            assert np.array_equal(ds.get_slice(slice_idx, order), data_t[slice_idx])
+
+
+def test_dataset_chunk_handle_pool(tmp_path):
+    from survos2.model.dataset import ChunkHandlePool, Dataset
+
+    data = np.random.rand(8, 8, 8).astype(np.float32)
+    ds = Dataset.create(str(tmp_path / "ds"), data=data, chunks=(4, 4, 4))
+    pool = ds._engine._pool = ChunkHandlePool(max_handles=2)
+
+    ro = Dataset(str(tmp_path / "ds"), readonly=True)
+    ro._engine._pool = pool
+    assert np.array_equal(ro[:], data)
+    assert len(pool) <= 2
+
+    ds[0:4, 0:4, 0:4] = np.ones((4, 4, 4), np.float32)
+    data[0:4, 0:4, 0:4] = 1
+    assert np.array_equal(ro[:], data)
+
+    ds.del_chunk((1, 1, 1))
+    data[4:, 4:, 4:] = 0
+    assert np.array_equal(ro[:], data)
+    ds.close()
+    assert len(pool) == 0
+
+
+def test_dataset_parallel_overlapping_writes(tmp_path):
+    from survos2.model.dataset import Dataset
+
+    data = np.random.rand(32, 32, 32).astype(np.float32)
+    ds = Dataset.create(str(tmp_path / "ds"), shape=data.shape, dtype="float32", chunks=(8, 8, 8))
+    # blocks not aligned with the dataset chunks: several writers per chunk
+    da.from_array(data, chunks=(5, 7, 9)).store(ds, lock=False)
+    assert np.array_equal(ds[:], data)
+
+
+def test_dataset_sparse_chunks(tmp_path):
+    from survos2.model.dataset import Dataset
+
+    ds = Dataset.create(str(tmp_path / "ds"), shape=(16, 16, 16), dtype="uint8", chunks=(8, 8, 8), sparse=True)
+    ds[:] = 0
+    assert ds.existing_chunks() == []
+    ds[0:4, 0:4, 0:4] = 1
+    assert ds.existing_chunks() == [(0, 0, 0)]
+    assert ds[:].sum() == 64
+    assert ds.get_chunk((1, 1, 1)) is None
+    # writing the fill value over a whole chunk removes it from disk
+    ds[0:8, 0:8, 0:8] = 0
+    assert ds.existing_chunks() == []
+    assert not any(f.endswith(".h5") for f in os.listdir(str(tmp_path / "ds")))
+    # chunks created by another instance are picked up
+    Dataset(str(tmp_path / "ds"), readonly=False)[8:, 8:, 8:] = 2
+    assert ds.has_chunk((1, 1, 1))
+    assert ds[:].sum() == 2 * 8 ** 3
+
+
+def test_dataset_compression(tmp_path):
+    import h5py
+    import pytest
+    from survos2.model.dataset import Dataset, DatasetException
+
+    data = np.random.randint(0, 4, (32, 32, 32)).astype(np.uint32)
+    for codec in ("gzip:6", "lzf"):
+        path = str(tmp_path / codec.replace(":", "_"))
+        Dataset.create(path, data=data, chunks=(16, 16, 16), compression=codec, shuffle=True)
+        ds = Dataset(path)
+        assert ds.compression == codec
+        assert np.array_equal(ds[:], data)
+        with h5py.File(os.path.join(path, "chunk_0x0x0.h5"), "r") as f:
+            assert f["data"].compression == codec.split(":")[0]
+            assert f["data"].shuffle
+    with pytest.raises(DatasetException):
+        Dataset.create(str(tmp_path / "bad"), data=data, compression="rar")
+
+
+def test_dataset_zarr_backend(tmp_path):
+    import pytest
+    from survos2.model.dataset import Dataset
+
+    pytest.importorskip("zarr")
+    data = np.random.randint(0, 10, (20, 20, 20)).astype(np.uint16)
+    path = str(tmp_path / "ds")
+    ds = Dataset.create(path, data=data, chunks=(8, 8, 8), backend="zarr", compression="gzip:4")
+    assert os.path.isdir(os.path.join(path, "data.zarr"))
+    assert ds.backend == "zarr"
+    assert np.array_equal(ds[:], data)
+    assert np.array_equal(ds.get_slice(5, (1, 0, 2)), data.transpose(1, 0, 2)[5])
+
+    # border chunks are padded like the HDF5 ones
+    assert ds.get_chunk_data((2, 2, 2)).shape == (8, 8, 8)
+    ds[2:18, 3:9, 7:19] = 11
+    data[2:18, 3:9, 7:19] = 11
+    ds.del_chunk((0, 0, 0))
+    data[:8, :8, :8] = 0
+    assert np.array_equal(Dataset(path, readonly=True)[:], data)
+    assert np.array_equal(ds.to_dask().compute(), data)
+
+
+def test_dataset_npy_backend(tmp_path):
+    import pytest
+    from survos2.model.dataset import Dataset, DatasetException, read_array
+
+    data = np.random.rand(20, 20, 20).astype(np.float32)
+    path = str(tmp_path / "ds")
+    ds = Dataset.create(path, data=data, chunks=(8, 8, 8), backend="npy", compression="none", sparse=True)
+    assert os.path.isfile(os.path.join(path, "chunk_0x0x0.npy"))
+    assert np.array_equal(ds[:], data)
+    assert np.array_equal(ds.get_slice(5, (1, 0, 2)), data.transpose(1, 0, 2)[5])
+
+    # reads within a chunk are views of the mapped chunk, which follow writes
+    view = ds.get_data((slice(1, 7), slice(0, 8), 3), copy=False)
+    assert not view.flags.owndata and not view.flags.writeable
+    assert np.array_equal(view, data[1:7, :8, 3])
+    copied = ds[1:7, :8, 3]
+    assert copied.flags.writeable
+    version = ds.chunk_version((0, 0, 0))
+    ds[2:4, 2:4, 3] = -1
+    data[2:4, 2:4, 3] = -1
+    assert np.array_equal(view, data[1:7, :8, 3])
+    assert not np.array_equal(copied, data[1:7, :8, 3])
+    assert ds.chunk_version((0, 0, 0)) != version
+
+    ds[:8, :8, :8] = 0
+    data[:8, :8, :8] = 0
+    assert not ds.has_chunk((0, 0, 0))
+    assert np.array_equal(read_array(Dataset(path, readonly=True)), data)
+    assert (read_array(ds, (slice(0, 4), slice(0, 4), slice(0, 4))) == 0).all()
+    assert np.array_equal(ds.to_dask().compute(), data)
+
+    with pytest.raises(DatasetException):
+        Dataset.create(str(tmp_path / "bad"), data=data, backend="npy", compression="gzip:4")
+
+    # writes through the mapping do not modify the feature cache entries linked to the chunks
+    from survos2.model.cache import FeatureCache
+
+    cache = FeatureCache(str(tmp_path))
+    cache.store("entry", path)
+    entry = os.path.join(cache.path, "entry")
+    assert os.stat(os.path.join(entry, "chunk_1x1x1.npy")).st_nlink == 2
+    ds[9:12, 9:12, 9:12] = 5
+    assert np.array_equal(Dataset(entry, readonly=True)[:], data)
+    assert cache.restore("entry", path) and np.array_equal(Dataset(path)[:], data)
+
+
+def test_dataset_pyramid(tmp_path):
+    from survos2.model.dataset import Dataset
+    from survos2.model import pyramid
+
+    data = np.random.rand(64, 48, 32).astype(np.float32)
+    labels = np.random.randint(0, 5, data.shape).astype(np.uint32)
+    feature = Dataset.create(str(tmp_path / "feature"), data=data, chunks=(16, 16, 16))
+    regions = Dataset.create(str(tmp_path / "regions"), data=labels, chunks=(16, 16, 16))
+
+    # on the fly, before the pyramid is built
+    expected = data.reshape(16, 4, 12, 4, 8, 4).mean(axis=(1, 3, 5))
+    assert pyramid.open_level(feature, 2) is None
+    assert np.allclose(pyramid.get_level_volume(feature, 2), expected, atol=1e-6)
+
+    pyramid.build_pyramid(feature._path, levels=3, min_size=4)
+    pyramid.build_pyramid(regions._path, levels=3, min_size=4)
+    assert sorted(os.listdir(pyramid.pyramid_path(feature._path))) == ["2", "4", "8"]
+    assert pyramid.open_level(feature, 2).shape == (16, 12, 8)
+    assert np.allclose(pyramid.get_level_volume(feature, 2), expected, atol=1e-6)
+    assert np.allclose(pyramid.get_level_slice(feature, 21, (1, 0, 2), 2), expected.transpose(1, 0, 2)[5])
+    assert np.allclose(pyramid.get_level_crop(feature, [8, 24, 0, 48, 4, 12], 2), expected[2:6, :, 1:3])
+    assert np.array_equal(pyramid.get_level_volume(regions, 3), labels[::8, ::8, ::8])
+
+    # regions written since the pyramid was built are computed on the fly
+    regions[0:8, 0:8, 0:8] = 9
+    labels[0:8, 0:8, 0:8] = 9
+    assert pyramid.open_level(regions, 3) is None
+    assert pyramid.open_level(regions, 3, (slice(32, 64), slice(16, 48), slice(16, 32))) is not None
+    assert np.array_equal(pyramid.get_level_volume(regions, 3), labels[::8, ::8, ::8])
+    assert np.array_equal(pyramid.get_level_slice(regions, 0, (0, 1, 2), 3), labels[0, ::8, ::8])
+    assert np.array_equal(pyramid.get_level_slice(regions, 40, (0, 1, 2), 3), labels[40, ::8, ::8])
+
+    # rebuilding replaces the previous pyramid
+    pyramid.build_pyramid(feature._path, levels=1, min_size=4)
+    assert os.listdir(pyramid.pyramid_path(feature._path)) == ["2"]
+    assert [f for f in os.listdir(feature._path) if f.startswith(".pyramid")] == []
+
+
+def test_slice_codecs_and_cache(tmp_path):
+    from survos2.api.utils import __slice_cache__, encoded_slice
+    from survos2.model.dataset import Dataset
+    from survos2.utils import decode_numpy_slice, encode_numpy_slice
+
+    labels = np.random.randint(0, 1000, (32, 40)).astype(np.uint32)
+    for codec in ("lz4", "raw", "png", "webp"):
+        encoded = encode_numpy_slice(labels, codec=codec)
+        assert encoded["codec"] in (codec, "raw")
+        decoded = decode_numpy_slice(encoded)
+        assert decoded.dtype == labels.dtype and np.array_equal(decoded, labels)
+    assert encode_numpy_slice(labels * 100, codec="png,raw")["codec"] == "raw"
+
+    data = np.random.rand(16, 32, 32).astype(np.float32)
+    ds = Dataset.create(str(tmp_path / "ds"), data=data, chunks=(8, 16, 16))
+    __slice_cache__.clear()
+    first = encoded_slice(ds, 3, (0, 1, 2), codec="raw")
+    assert encoded_slice(ds, 3, (0, 1, 2), codec="raw") is first
+    assert np.array_equal(decode_numpy_slice(dict(first)), data[3])
+    # modifying a chunk on the plane invalidates the cached slice
+    ds[3:5, 0:4, 0:4] = 0
+    data[3:5, 0:4, 0:4] = 0
+    second = encoded_slice(ds, 3, (0, 1, 2), codec="raw")
+    assert second is not first
+    assert np.array_equal(decode_numpy_slice(dict(second)), data[3])
+
+    # slices of a pyramid level follow the writes since its build, and its rebuilds
+    from survos2.model.pyramid import build_pyramid
+
+    build_pyramid(ds._path, levels=1, min_size=4)
+    order = np.array([1, 0, 2])
+    encoded_slice(ds, 6, order, level=1, codec="raw")
+    ds[:, 6:8, :] = 1
+    level = encoded_slice(ds, 6, order, level=1, codec="raw")
+    assert np.allclose(decode_numpy_slice(dict(level)), 1)
+    build_pyramid(ds._path, levels=1, min_size=4)
+    rebuilt = encoded_slice(ds, 6, order, level=1, codec="raw")
+    assert rebuilt is not level and np.allclose(decode_numpy_slice(dict(rebuilt)), 1)
+
+
+def test_annotate_voxels_chunks(tmp_path):
+    from survos2.api.annotate import annotate_voxels, undo_annotation
+    from survos2.model.dataset import Dataset
+
+    ds = Dataset.create(str(tmp_path / "level"), shape=(16, 16, 16), dtype="uint32", chunks=(8, 8, 8))
+    ds.set_attr("modified", [0] * ds.total_chunks)
+    annotate_voxels(ds, slice_idx=2, yy=[1, 2, 3], xx=[1, 1, 12], label=3)
+    data = ds[:]
+    assert list(data[2, [1, 2, 3], [1, 1, 12]]) == [3, 3, 3]
+    assert data.sum() == 9
+    assert ds.get_attr("modified") == [1, 1, 0, 0, 0, 0, 0, 0]
+
+    # strokes painted in another viewer order are mapped back to storage order
+    annotate_voxels(ds, slice_idx=10, yy=[4], xx=[5], label=2, viewer_order=(2, 0, 1))
+    assert ds[4, 5, 10] == 2
+    assert ds.get_attr("modified") == [2, 3, 0, 0, 0, 0, 0, 0]
+    # only the chunk touched by the stroke had its history shifted
+    assert ds[2, 1, 1] == 3 and ds[2, 3, 12] == (3 << 4) | 3
+
+    undo_annotation(ds)
+    assert ds[4, 5, 10] == 0 and ds[2, 1, 1] == 3 and ds[2, 3, 12] == 3
+    assert ds.get_attr("modified") == [1, 1, 0, 0, 0, 0, 0, 0]
+    undo_annotation(ds)
+    assert ds[:].sum() == 0
+
+
+def test_annotation_journal(tmp_path):
+    from survos2.api.annotate import (
+        annotate_voxels,
+        erase_label,
+        redo_annotation,
+        store_annotation,
+        undo_annotation,
+    )
+    from survos2.model.dataset import Dataset
+
+    ds = Dataset.create(str(tmp_path / "level"), shape=(16, 16, 16), dtype="uint32", chunks=(8, 8, 8))
+    ds.set_attr("history", "journal")
+    ds.set_attr("history_depth", 2)
+    annotate_voxels(ds, slice_idx=2, yy=[1, 2, 3], xx=[1, 1, 12], label=3)
+    annotate_voxels(ds, slice_idx=2, yy=[1, 9], xx=[1, 9], label=5)
+    # only the current labels are stored, without history bits
+    assert ds[2, 1, 1] == 5 and ds[2, 9, 9] == 5 and ds[2, 3, 12] == 3
+    assert ds[:].max() == 5
+
+    undo_annotation(ds)
+    assert ds[2, 1, 1] == 3 and ds[2, 9, 9] == 0
+    redo_annotation(ds)
+    assert ds[2, 1, 1] == 5 and ds[2, 9, 9] == 5
+
+    # whole volume edits only record the voxels they change, the oldest edit is dropped
+    anno = ds[:] | (ds[:] << 4)
+    anno[0, 0, 0] = 7
+    store_annotation(ds, anno)
+    assert ds[0, 0, 0] == 7 and ds[2, 1, 1] == 5
+    erase_label(ds, label=5)
+    assert ds[2, 1, 1] == 0 and ds[2, 9, 9] == 0
+    undo_annotation(ds)
+    undo_annotation(ds)
+    undo_annotation(ds)  # beyond the journal depth, nothing left to undo
+    assert ds[0, 0, 0] == 0 and ds[2, 1, 1] == 3 and ds[2, 3, 12] == 3
+
+    # entries recorded with another chunk layout are grouped by the current chunks
+    import shutil
+
+    other = Dataset.create(str(tmp_path / "other"), data=ds[:], chunks=(4, 4, 4))
+    for name in ("history", "history_depth"):
+        other.set_attr(name, ds.get_attr(name))
+    shutil.copytree(str(tmp_path / "level" / "journal"), str(tmp_path / "other" / "journal"))
+    for level in (ds, other):
+        redo_annotation(level)
+        redo_annotation(level)
+    assert np.array_equal(other[:], ds[:]) and ds[0, 0, 0] == 7
+
+
+def test_parent_mask(tmp_path):
+    from survos2.api.annotate import ParentMask, ParentMaskCache, annotate_voxels
+    from survos2.model.dataset import Dataset
+
+    parent = Dataset.create(str(tmp_path / "parent"), shape=(12, 20, 16), dtype="uint32", chunks=(8, 8, 8))
+    labels = np.random.randint(0, 3, parent.shape).astype(np.uint32)
+    parent[:] = labels | (1 << 4)  # history bits are ignored
+    cache = ParentMaskCache()
+    mask = ParentMask(parent, 2, cache=cache)
+    assert np.array_equal(mask.crop(), labels == 2)
+    assert np.array_equal(mask.crop((slice(3, 10), slice(5, 17), slice(7, 8))), labels[3:10, 5:17, 7:8] == 2)
+    coords = np.argwhere(np.ones((4, 4, 4), bool)) * 3
+    assert np.array_equal(mask.contains(coords), labels[tuple(coords.T)] == 2)
+    assert len(cache) == parent.total_chunks
+
+    # strokes are constrained to the parent label, using only the chunks they touch
+    level = Dataset.create(str(tmp_path / "level"), shape=parent.shape, dtype="uint32", chunks=(8, 8, 8))
+    level.set_attr("modified", [0] * level.total_chunks)
+    cache.clear()
+    annotate_voxels(level, slice_idx=1, yy=[0, 1, 2, 3], xx=[4, 4, 4, 4], label=5, parent_mask=mask)
+    assert np.array_equal(level[:][1, :4, 4] == 5, labels[1, :4, 4] == 2)
+    assert len(cache) == 1
+
+    # cached chunk masks are recomputed once the parent is modified
+    parent[1, 0, 4] = 2
+    assert mask.contains(np.array([[1, 0, 4]]))[0]
+
+
+def test_stroke_batches(tmp_path):
+    import threading
+
+    from survos2.api.annotate import annotate_strokes, annotate_voxels, undo_annotation
+    from survos2.api.strokes import StrokeQueue, decode_strokes, encode_strokes, stroke_from_points
+    from survos2.model.dataset import Dataset
+
+    strokes = [
+        stroke_from_points(3, [1, 2, 2, 9], [4, 4, 5, 12], 2),
+        stroke_from_points(3, [2, 3], [5, 5], 4),
+        stroke_from_points(10, [0], [15], 1),
+    ]
+    decoded, params = decode_strokes(encode_strokes(strokes, level="001_level", viewer_order=[2, 0, 1]))
+    assert params == dict(level="001_level", viewer_order=[2, 0, 1])
+    for a, b in zip(strokes, decoded):
+        assert a[:4] == b[:4] and np.array_equal(a.mask, b.mask)
+
+    # a batch paints as its strokes one by one, but is a single edit
+    shape, chunks = (16, 16, 16), (8, 8, 8)
+    expected = Dataset.create(str(tmp_path / "expected"), shape=shape, dtype="uint32", chunks=chunks)
+    level = Dataset.create(str(tmp_path / "level"), shape=shape, dtype="uint32", chunks=chunks)
+    for ds in (expected, level):
+        ds.set_attr("modified", [0] * ds.total_chunks)
+    for s in strokes:
+        yy, xx = s.points()
+        annotate_voxels(expected, s.slice_idx, yy, xx, label=s.label, viewer_order=(2, 0, 1))
+    annotate_strokes(level, decoded, viewer_order=(2, 0, 1))
+    assert np.array_equal(level[:] & 15, expected[:] & 15)
+    assert level[:][2, 5, 3] == 4
+    undo_annotation(level)
+    assert level[:].sum() == 0
+
+    # batches queued while others are applied are applied together, in order
+    applied, release = [], threading.Event()
+
+    def apply(batches):
+        release.wait()
+        applied.append(batches)
+
+    queue = StrokeQueue(apply)
+    tickets = [queue.submit(i) for i in range(3)]
+    release.set()
+    assert queue.wait(tickets[-1], timeout=10) == (True, None)
+    assert [b for batches in applied for b in batches] == [0, 1, 2] and len(applied) <= 2
+
+    # only the errors of the last batches are kept until waited for
+    def fail(batches):
+        raise ValueError("failed")
+
+    queue = StrokeQueue(fail, max_errors=2)
+    tickets = [queue.submit(i) for i in range(5)]
+    assert queue.wait(timeout=10) == (True, "failed")
+    assert queue.wait(tickets[0], timeout=10) == (True, None)
+    assert len(queue._errors) == 1
+
+
+def test_annotate_from_slice(tmp_path):
+    from scipy.ndimage import binary_erosion
+    from survos2.api.annotate import annotate_from_slice, undo_annotation
+    from survos2.model.dataset import Dataset
+    from survos2.model.region_index import build_region_index
+
+    labels = np.random.randint(0, 60, (16, 20, 24)).astype(np.uint32)
+    source = np.zeros((20, 24), np.uint32)
+    source[2:12, 3:15], source[8:18, 10:22] = 2, 5
+
+    # superregions under the eroded mask of each label, painted in increasing label order
+    expected = np.full(labels.shape, 7, np.uint32)
+    for label in np.unique(source):
+        for r in np.unique(labels[6][binary_erosion(source == label, iterations=2)]):
+            expected[labels == r] = label
+
+    regions = Dataset.create(str(tmp_path / "regions"), data=labels, chunks=(8, 8, 8))
+    for name, index in (("level", False), ("indexed", True)):
+        if index:
+            build_region_index(regions._path)
+        level = Dataset.create(str(tmp_path / name), shape=labels.shape, dtype="uint32", chunks=(8, 8, 8))
+        level[:] = 7
+        level.set_attr("modified", [0] * level.total_chunks)
+        annotate_from_slice(level, regions, source, 6)
+        assert np.array_equal(level[:] & 15, expected)
+        # the history is shifted once, a single undo restores the level
+        undo_annotation(level)
+        assert (level[:] == 7).all()
+
+    # superregion 0 is only annotated if it is under a label, not under every label
+    from survos2.api.annotate import slice_region_labels
+
+    region_slice = np.ones((20, 24), np.uint32)
+    region_slice[:, 18:] = 0
+    source = np.zeros((20, 24), np.uint32)
+    source[2:12, 3:15] = 2
+    assert slice_region_labels(source, region_slice).tolist() == [0, 2]
+    source[:, 16:] = 3
+    assert slice_region_labels(source, region_slice).tolist() == [3, 2]
+
+
+def test_region_index(tmp_path):
+    from survos2.api.annotate import annotate_indexed_regions, annotate_regions
+    from survos2.model.dataset import Dataset
+    from survos2.model.region_index import build_region_index, load_region_index
+
+    labels = np.random.randint(0, 40, (20, 24, 16)).astype(np.uint32)
+    labels[labels == 7] = 3
+    regions = Dataset.create(str(tmp_path / "regions"), data=labels, chunks=(8, 8, 8))
+    assert load_region_index(regions) is None
+    build_region_index(regions._path)
+    index = load_region_index(regions)
+    assert index.nr == 40
+    for r in (0, 3, 7, 39):
+        assert np.array_equal(index.voxels([r]), np.flatnonzero(labels.ravel() == r))
+    coords = np.argwhere(labels == 3)
+    assert list(index.bounds[3]) == list(coords.min(0)) + list(coords.max(0) + 1)
+
+    # painting with the index matches painting with per-region masks
+    level = Dataset.create(str(tmp_path / "level"), shape=labels.shape, dtype="uint32", chunks=(8, 8, 8))
+    level[:] = np.random.randint(0, 4, labels.shape).astype(np.uint32)
+    params = dict(r=[1, 3, 5], label=6, bb=[2, 0, 1, 12, 24, 10], viewer_order=(2, 0, 1))
+    expected = annotate_regions(level, labels, **params)
+    annotate_indexed_regions(level, index, **params)
+    assert np.array_equal(level[:] & 15, expected & 15)
+
+    # modifying the regions makes the index stale
+    regions[0, 0, 0] = 5
+    assert load_region_index(regions) is None
+
+
+def test_map_blocks_stream_store(tmp_path):
+    from scipy import ndimage as ndi
+    from survos2.improc.utils import map_blocks
+    from survos2.model.dataset import Dataset
+
+    def smooth(data):
+        return ndi.gaussian_filter(data, 1) - 0.5
+
+    data = np.random.rand(32, 32, 32).astype(np.float32)
+    expected = map_blocks(smooth, data, pad=4, chunk_size=(16, 16, 16), normalize=True)
+    for stream in (True, False):
+        out = Dataset.create(str(tmp_path / str(stream)), shape=data.shape, dtype="float32", chunks=(8, 8, 8))
+        map_blocks(smooth, data, out=out, pad=4, chunk_size=(16, 16, 16), normalize=True, stream=stream)
+        result = Dataset(str(tmp_path / str(stream)))[:]
+        assert np.allclose(result, expected, atol=1e-6)
+        assert np.isclose(np.abs(result).max(), 1)
+
+    # min/max normalization fused with the block writes
+    raw = map_blocks(smooth, data, pad=4, chunk_size=(16, 16, 16))
+    out = Dataset.create(str(tmp_path / "minmax"), shape=data.shape, dtype="float32", chunks=(8, 8, 8))
+    map_blocks(smooth, data, out=out, pad=4, chunk_size=(16, 16, 16), normalize="minmax")
+    expected = (raw - raw.min()) / (raw.max() - raw.min())
+    assert np.allclose(Dataset(str(tmp_path / "minmax"))[:], expected, atol=1e-6)
+
+
+def test_feature_cache(tmp_path):
+    from survos2.api.utils import cache_result
+    from survos2.model.cache import FeatureCache
+    from survos2.model.dataset import Dataset
+
+    data = np.random.rand(16, 16, 16).astype(np.float32)
+    Dataset.create(str(tmp_path / "__data__"), data=data, chunks=(8, 8, 8))
+    src = "survos://" + str(tmp_path / "__data__")
+    dst = [str(tmp_path / "default" / "features" / "00{}_scale".format(i)) for i in range(3)]
+    calls = []
+
+    @cache_result
+    def scale(src, dst, factor=1):
+        calls.append(dst)
+        out = dataset_from_uri(dst, mode="r+")
+        out[:] = dataset_from_uri(src, mode="r")[:] * factor
+
+    for path in dst:
+        Dataset.create(path, shape=data.shape, dtype="float32", chunks=(8, 8, 8))
+    scale(src, "survos://" + dst[0], factor=2)
+    scale(src, "survos://" + dst[1], factor=2)  # cache hit
+    scale(src, "survos://" + dst[2], factor=3)
+    assert len(calls) == 2
+    assert np.array_equal(Dataset(dst[1])[:], data * 2)
+    assert os.stat(os.path.join(dst[1], "chunk_0x0x0.h5")).st_nlink == 3
+
+    # writes are copy-on-write: the cache entry and the other copies are unchanged
+    Dataset(dst[1])[0:2] = -1
+    assert np.array_equal(Dataset(dst[0])[:], data * 2)
+    scale(src, "survos://" + dst[2], factor=2)
+    assert len(calls) == 2 and np.array_equal(Dataset(dst[2])[:], data * 2)
+
+    # modified sources invalidate the entries
+    Dataset(str(tmp_path / "__data__"))[0:2] = 0
+    scale(src, "survos://" + dst[2], factor=2)
+    assert len(calls) == 3
+
+    cache = FeatureCache(str(tmp_path))
+    assert len(cache.entries()) == 3
+    cache._max_size = 0
+    cache.store("last", dst[2], function="scale")
+    assert list(cache.entries()) == ["last"]
+    assert cache.purge() == ["last"] and cache.entries() == {}
+
+
+def test_map_filter_bank(tmp_path):
+    from contextlib import contextmanager
+
+    import pytest
+    from scipy import ndimage as ndi
+    from survos2.improc.utils import map_blocks, map_filter_bank
+    from survos2.model.dataset import Dataset
+
+    class CountingDataset(Dataset):
+        reads = 0
+
+        def get_data(self, slices=None):
+            data = super().get_data(slices)
+            CountingDataset.reads += data.size > 0  # not dask's meta probes
+            return data
+
+    data = np.random.rand(32, 32, 32).astype(np.float32)
+    Dataset.create(str(tmp_path / "src"), data=data, chunks=(16, 16, 16))
+    src = CountingDataset(str(tmp_path / "src"), readonly=True)
+    blocks = []
+
+    @contextmanager
+    def context(block):
+        blocks.append(block.shape)
+        yield
+
+    filters = [
+        dict(func=ndi.gaussian_filter, kwargs=dict(sigma=2), pad=8),
+        dict(func=ndi.median_filter, kwargs=dict(size=3), pad=4, normalize="minmax"),
+        dict(func=np.negative, normalize=True),
+    ]
+    for i, f in enumerate(filters):
+        f["out"] = Dataset.create(str(tmp_path / str(i)), shape=data.shape, dtype="float32", chunks=(16, 16, 16))
+    map_filter_bank(src, filters, chunk_size=(16, 16, 16), block_context=context)
+    # every source chunk is read once, and each padded block is filtered once
+    assert CountingDataset.reads == 8
+    assert blocks == [(32, 32, 32)] * 8
+
+    for i, f in enumerate(filters):
+        expected = map_blocks(
+            f["func"], data, pad=8, chunk_size=(16, 16, 16), normalize=f.get("normalize", False), **f.get("kwargs", {})
+        )
+        assert np.allclose(Dataset(str(tmp_path / str(i)))[:], expected, atol=1e-5)
+
+    # filters modifying the block in place get a copy, the block is readonly otherwise
+    def shift(x):
+        x -= 5
+        return x
+
+    filters = [dict(func=shift, inplace=True), dict(func=np.array), dict(func=shift)]
+    for i, f in enumerate(filters):
+        f["out"] = Dataset.create(str(tmp_path / "inplace{}".format(i)), shape=data.shape, dtype="float32")
+    with pytest.raises(ValueError):
+        map_filter_bank(src, filters, chunk_size=(16, 16, 16))
+    map_filter_bank(src, filters[:2], chunk_size=(16, 16, 16))
+    assert np.allclose(Dataset(str(tmp_path / "inplace0"))[:], data - 5)
+    assert np.allclose(Dataset(str(tmp_path / "inplace1"))[:], data)
+
+
+def test_incremental_recomputation(tmp_path):
+    from scipy import ndimage as ndi
+    from survos2.api.utils import save_metadata
+    from survos2.improc.utils import map_blocks
+    from survos2.model.dataset import Dataset
+
+    data = np.random.rand(32, 32, 32).astype(np.float32)
+    Dataset.create(str(tmp_path / "src"), data=data, chunks=(8, 8, 8))
+    Dataset.create(str(tmp_path / "dst"), shape=data.shape, dtype="float32", chunks=(8, 8, 8))
+    src, dst = ["survos://" + str(tmp_path / name) for name in ("src", "dst")]
+    blocks = []
+
+    def smooth(x, sigma=1):
+        if x.size > 0:  # not dask's meta probes
+            blocks.append(x.shape)
+        return ndi.gaussian_filter(x, sigma)
+
+    @save_metadata(incremental=True)
+    def feature(src, dst, sigma=1):
+        map_blocks(smooth, src, out=dst, pad=2, sigma=sigma, chunk_size=(8, 8, 8), normalize="minmax")
+
+    def expected():
+        raw = map_blocks(ndi.gaussian_filter, data, pad=2, sigma=1, chunk_size=(8, 8, 8))
+        return (raw - raw.min()) / (raw.max() - raw.min())
+
+    feature(src, dst, sigma=1)
+    assert len(blocks) == 64
+    assert np.allclose(Dataset(str(tmp_path / "dst"))[:], expected(), atol=1e-5)
+
+    # nothing changed: nothing is recomputed
+    blocks.clear()
+    feature(src, dst, sigma=1)
+    assert len(blocks) == 0
+
+    # one source chunk changed: only it and its neighbours within the padding
+    data[0:8, 0:8, 0:8] *= 3
+    Dataset(str(tmp_path / "src"))[0:8, 0:8, 0:8] = data[0:8, 0:8, 0:8]
+    feature(src, dst, sigma=1)
+    assert len(blocks) == 8
+    assert np.allclose(Dataset(str(tmp_path / "dst"))[:], expected(), atol=1e-5)
+
+    # different parameters: computed from scratch
+    blocks.clear()
+    feature(src, dst, sigma=2)
+    assert len(blocks) == 64
+
+    # functions reading other datasets than `src` are always computed
+    other = np.random.rand(32, 32, 32).astype(np.float32)
+    Dataset.create(str(tmp_path / "other"), data=other, chunks=(8, 8, 8))
+    calls = []
+
+    @save_metadata
+    def combine(src, dst, other_id=None):
+        calls.append(other_id)
+        rhs = Dataset(str(tmp_path / other_id))[:]
+        Dataset(str(tmp_path / "dst"))[:] = Dataset(str(tmp_path / "src"))[:] + rhs
+
+    combine(src, dst, other_id="other")
+    other[:] = 0
+    Dataset(str(tmp_path / "other"))[:] = other
+    combine(src, dst, other_id="other")
+    assert len(calls) == 2
+    assert np.allclose(Dataset(str(tmp_path / "dst"))[:], data)
+
+
+def test_compute_scheduler(tmp_path):
+    import threading
+    from survos2.improc.scheduler import ComputeScheduler, get_scheduler
+    from survos2.improc.utils import map_blocks
+    from survos2.model.dataset import Dataset
+
+    # admission control: the second computation waits for the first one
+    scheduler = ComputeScheduler("threads", workers=2, memory_budget=1)
+    started, release, order = threading.Event(), threading.Event(), []
+
+    def run(name):
+        with scheduler.admit(name, 2 ** 19 + 1):
+            order.append(name)
+            started.set()
+            release.wait(5)
+
+    first = threading.Thread(target=run, args=("first",))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=run, args=("second",))
+    second.start()
+    second.join(0.2)
+    assert order == ["first"]
+    assert [t["state"] for t in scheduler.tasks()] == ["queued", "running"]
+    release.set()
+    first.join()
+    second.join()
+    assert order == ["first", "second"]
+    assert scheduler.memory_used == 0
+
+    # progress of the computations of map_blocks
+    data = np.random.rand(32, 32, 32).astype(np.float32)
+    map_blocks(np.negative, data, chunk_size=(16, 16, 16))
+    task = get_scheduler().tasks()[-1]
+    assert task["state"] == "done" and task["progress"] == 1
+    assert task["tasks"] > 0 and task["tasks_done"] == task["tasks"]
+
+    # process pool, datasets are reopened by path in the workers
+    scheduler = ComputeScheduler("processes", workers=2)
+    out = Dataset.create(str(tmp_path / "out"), shape=data.shape, dtype="float32", chunks=(16, 16, 16))
+    try:
+        da.store(da.from_array(data, chunks=16) * 2, out, lock=False, scheduler=scheduler.get)
+    finally:
+        scheduler.close()
+    assert np.allclose(Dataset(str(tmp_path / "out"))[:], data * 2)
+
+
+def test_optimal_chunksize():
+    for shape in [(64, 64, 64), (100, 512, 512), (40000, 2048, 2048), (8192, 8192, 8192)]:
+        for pattern, pad in [(None, 0), ("cubic", 8), ("slice", 0)]:
+            chunks = optimal_chunksize(shape, 32, pattern=pattern, pad=pad)
+            assert all(1 <= c <= s for c, s in zip(chunks, shape))
+            assert np.prod(np.add(chunks, 2 * pad), dtype=np.float64) * 4 <= 32 * 2**20
+
+    assert optimal_chunksize((4, 4, 4), 32) == (4, 4, 4)
+    cubic = optimal_chunksize((2048, 2048, 2048), 32, pattern="cubic")
+    assert max(cubic) < 1.2 * min(cubic)
+    sliced = optimal_chunksize((2048, 2048, 2048), 32, pattern="slice")
+    assert sliced[0] * 3 < min(sliced[1:])
+
+
+def test_rechunk_dataset(tmp_path):
+    import threading
+
+    import pytest
+
+    from survos2.model.access import access_stats, suggest_layout
+    from survos2.model.dataset import Dataset
+    from survos2.model.rechunk import rechunk_dataset, remove_stale_layouts
+
+    path = str(tmp_path / "ds")
+    data = np.random.rand(24, 40, 40).astype(np.float32)
+    Dataset.create(path, data=data, chunks=(8, 8, 8))
+    reader = Dataset(path, readonly=True)
+
+    # planes along axis 1 dominate: chunks thin along that axis
+    access_stats.reset(path)
+    for i in range(10):
+        reader.get_slice(i, order=(1, 0, 2))
+    reader[0:8, 0:8, 0:8]
+    assert access_stats.get(path) == dict(planes=[0, 10, 0], regions=1)
+    suggestion = suggest_layout(reader, max_size=0.01)
+    assert suggestion["pattern"] == "slice:1" and suggestion["changed"]
+    assert suggestion["chunks"][1] < min(suggestion["chunks"][0], suggestion["chunks"][2])
+
+    assert rechunk_dataset(path, (24, 4, 40), max_memory=0.05) == [24, 4, 40]
+    assert reader.chunk_size == (8, 8, 8)
+    assert np.array_equal(reader[:], data)  # follows the new layout
+    assert reader.chunk_size == (24, 4, 40) and reader.layout == "layout-1"
+    assert access_stats.get(path)["regions"] == 2  # the copy is not recorded
+
+    remove_stale_layouts(path)
+    assert not any(name.startswith("chunk_") for name in os.listdir(path))
+    assert sorted(os.listdir(os.path.join(path, "layout-1")))[0] == "chunk_0x0x0.h5"
+    ds = Dataset(path)
+    ds[0, 0, 0:3] = 5
+    data[0, 0, 0:3] = 5
+    assert np.array_equal(Dataset(path, readonly=True)[:], data)
+
+    # writes during the migration are copied, writes during the switch wait for it
+    from survos2.model.dataset import DatasetException, layout_lock
+
+    def write(p):
+        ds[23, 39, 39] = p
+        data[23, 39, 39] = p
+
+    assert rechunk_dataset(path, (8, 8, 8), progress=write) == [8, 8, 8]
+    assert np.array_equal(Dataset(path, readonly=True)[:], data)
+    writer = threading.Thread(target=write, args=(7,))
+    with layout_lock(path).exclusive():
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+    writer.join()
+    assert Dataset(path, readonly=True)[23, 39, 39] == 7
+
+    # the undo history of annotation levels is indexed by chunk
+    level = Dataset.create(str(tmp_path / "level"), shape=(8, 8, 8), dtype="uint32", chunks=(4, 4, 4))
+    level.set_attr("modified", [0] * level.total_chunks)
+    with pytest.raises(DatasetException):
+        rechunk_dataset(level._path, (8, 8, 8))
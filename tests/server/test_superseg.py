@@ -53,3 +53,22 @@ def test_predict():
     clf, proj = train(X, y, predict_params)
     result = predict(X, clf)
     assert isinstance(result["class"], np.ndarray)
+
+
+def test_region_descriptors(tmp_path):
+    from survos2.model.dataset import Dataset
+    from survos2.server.descriptors import region_descriptors
+
+    R = np.random.randint(0, 30, (20, 24, 16)).astype(np.uint32)
+    feats = [np.random.rand(*R.shape).astype(np.float32) * 10 + 100 for _ in range(3)]
+    datasets = [
+        Dataset.create(str(tmp_path / str(i)), data=f, chunks=(8, 8, 8), backend="npy", compression="none")
+        for i, f in enumerate(feats)
+    ]
+    X = np.stack([f.ravel() for f in feats], axis=1).astype(np.float64)
+    means = np.array([X[R.ravel() == r].mean(0) for r in range(30)])
+    covars = np.array([np.cov(X[R.ravel() == r].T, bias=True) for r in range(30)])
+
+    assert np.allclose(region_descriptors(R, datasets, "Mean"), means, atol=1e-4)
+    covar = region_descriptors(R, feats, "Covar", block=(5, 7, 16))
+    assert np.allclose(covar, (covars + means[:, :, None]).reshape(30, -1), atol=1e-4)